@@ -0,0 +1,436 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Approximate nearest neighbor index for large galleries: an inverted file
+# (IVF) index in NumPy. The embeddings are clustered with spherical k-means,
+# each row is stored in the list of its closest centroid and a search only
+# scans the nprobe lists closest to the probe, instead of the whole gallery.
+# nprobe is the recall/latency knob: more lists, higher recall, slower
+# search. The lists only hold row numbers, the vectors are read from the
+# attached matrix, e.g., the embedding store's memory-mapped (and possibly
+# int8) matrix, i.e., the index doesn't hold a second float32 copy of the
+# gallery in every worker. Rows can be added/removed at any time, the index
+# (centroids + list assignments) is persisted to a single .npz file.
+import os
+import tempfile
+import numpy as np
+from logging_util import logger
+
+# list number of the rows that aren't in the index, -1 is the buffer
+NOT_INDEXED = -2
+
+
+class InvertedList:
+
+    def __init__(self):
+
+        # preallocated row numbers, only the first size are in use
+        self.rows = np.empty(0, dtype=np.int64)
+        self.size = 0
+
+    def data(self) -> np.ndarray:
+
+        return self.rows[:self.size]
+
+    # append a block of rows, returns the position of the first one
+    def append(self, rows: np.ndarray) -> int:
+
+        start = self.size
+        needed = start + len(rows)
+
+        # grow by doubling, so a series of single inserts isn't quadratic
+        if needed > len(self.rows):
+            grown = np.empty(max(needed, 2 * len(self.rows), 16),
+                             dtype=np.int64)
+            grown[:start] = self.rows[:start]
+            self.rows = grown
+
+        self.rows[start:needed] = rows
+        self.size = needed
+
+        return start
+
+    # remove the row at a position by moving the last one into its place,
+    # returns the moved row, None if nothing moved
+    def remove(self, position: int) -> object:
+
+        last = self.size - 1
+        moved = None
+
+        if position != last:
+            self.rows[position] = self.rows[last]
+            moved = int(self.rows[position])
+
+        self.size = last
+
+        return moved
+
+
+class IVFIndex:
+
+    # rows per block when reading vectors from the matrix, e.g., to assign
+    # them to centroids
+    CHUNK_SIZE = 4096
+
+    # k-means settings: iterations, and training rows per centroid, the
+    # index trains itself once it holds MIN_TRAIN_PER_LIST rows per list
+    KMEANS_ITERATIONS = 20
+    MIN_TRAIN_PER_LIST = 39
+    MAX_TRAIN_PER_LIST = 256
+
+    def __init__(self, nlist: int = 1024, nprobe: int = 16,
+                 path: str = None, seed: int = 0):
+
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.path = path
+        self.rng = np.random.default_rng(seed)
+
+        # (N x D) matrix the rows are read from, plus a scale per row for
+        # int8 matrices, see attach()
+        self.vectors = None
+        self.scales = None
+        self.dim = None
+
+        # (nlist x dim) normalized centroids, None until trained
+        self.centroids = None
+        self.lists = []
+
+        # rows added before the index is trained, scanned in full
+        self.buffer = InvertedList()
+
+        # per row: list number (NOT_INDEXED if it isn't in the index) and
+        # position in that list
+        self.list_numbers = np.empty(0, dtype=np.int32)
+        self.positions = np.empty(0, dtype=np.int64)
+        self.size = 0
+
+        # changes since the index was last saved
+        self.unsaved = 0
+
+    def __len__(self):
+
+        return self.size
+
+    @property
+    def trained(self) -> bool:
+
+        return self.centroids is not None
+
+    # load the index from path if it exists, otherwise start an empty one
+    # that will be saved there
+    @classmethod
+    def open(cls, path: str, nlist: int = 1024, nprobe: int = 16):
+
+        if os.path.exists(path):
+            index = cls.load(path)
+            index.nprobe = nprobe
+
+            return index
+
+        return cls(nlist, nprobe, path)
+
+    @staticmethod
+    def normalize(embeddings: np.ndarray) -> np.ndarray:
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings = embeddings.reshape(len(embeddings), -1)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        return embeddings / np.maximum(norms, 1e-12)
+
+    # set the (N x D) matrix the index's rows refer to, float32, float16 or
+    # int8 (with a float32 scale per row), the rows should be L2 normalized.
+    # Call it again whenever the matrix is re-mapped, e.g., after it grew.
+    def attach(self, vectors: np.ndarray, scales: np.ndarray = None):
+
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f'Embedding width {vectors.shape[1]} does not match index width {self.dim}')  # noqa: E501
+
+        self.vectors = vectors
+        self.scales = scales
+        self.dim = vectors.shape[1]
+
+    # float32 copy of some of the attached matrix's rows
+    def get_vectors(self, rows: np.ndarray) -> np.ndarray:
+
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+
+        if self.scales is not None:
+            vectors *= np.asarray(self.scales[rows],
+                                  dtype=np.float32)[:, None]
+
+        return vectors
+
+    def get_list(self, list_number: int) -> InvertedList:
+
+        return self.buffer if list_number == -1 else self.lists[list_number]
+
+    # all the rows in the index
+    def rows(self) -> np.ndarray:
+
+        return np.flatnonzero(self.list_numbers != NOT_INDEXED)
+
+    def __contains__(self, row: int) -> bool:
+
+        return row < len(self.list_numbers) and \
+            self.list_numbers[row] != NOT_INDEXED
+
+    # make room in the per row arrays for rows up to count
+    def reserve(self, count: int):
+
+        if count <= len(self.list_numbers):
+            return
+
+        count = max(count, 2 * len(self.list_numbers))
+        extra = count - len(self.list_numbers)
+
+        self.list_numbers = np.concatenate(
+            (self.list_numbers, np.full(extra, NOT_INDEXED, dtype=np.int32)))
+        self.positions = np.concatenate(
+            (self.positions, np.zeros(extra, dtype=np.int64)))
+
+    # add rows of the attached matrix, a row that's already in the index is
+    # re-assigned
+    def add(self, rows: np.ndarray):
+
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if len(rows) == 0:
+            return
+
+        self.reserve(int(rows.max()) + 1)
+
+        for row in rows[self.list_numbers[rows] != NOT_INDEXED]:
+            self.remove(int(row))
+
+        self.unsaved += len(rows)
+
+        if not self.trained:
+            self.append(-1, rows)
+
+            if self.buffer.size >= self.MIN_TRAIN_PER_LIST * self.nlist:
+                self.train()
+
+            return
+
+        for i in range(0, len(rows), self.CHUNK_SIZE):
+            chunk = rows[i:i + self.CHUNK_SIZE]
+            assignments = self.assign(self.get_vectors(chunk))
+
+            for list_number in np.unique(assignments):
+                self.append(int(list_number),
+                            chunk[assignments == list_number])
+
+    def append(self, list_number: int, rows: np.ndarray):
+
+        start = self.get_list(list_number).append(rows)
+
+        self.list_numbers[rows] = list_number
+        self.positions[rows] = np.arange(start, start + len(rows))
+        self.size += len(rows)
+
+    # remove a row, returns False if it isn't in the index
+    def remove(self, row: int) -> bool:
+
+        if row not in self:
+            return False
+
+        list_number = int(self.list_numbers[row])
+        position = int(self.positions[row])
+        moved = self.get_list(list_number).remove(position)
+
+        if moved is not None:
+            self.positions[moved] = position
+
+        self.list_numbers[row] = NOT_INDEXED
+        self.size -= 1
+        self.unsaved += 1
+
+        return True
+
+    # (re)train the centroids on a sample of the rows and reassign every
+    # row, called automatically once there is enough data, call it again if
+    # the gallery has drifted a lot since
+    def train(self):
+
+        rows = self.rows()
+
+        if len(rows) == 0:
+            raise ValueError('Cannot train an empty index')
+
+        sample_size = min(len(rows), self.MAX_TRAIN_PER_LIST * self.nlist)
+        sample = np.sort(self.rng.choice(rows, sample_size, replace=False))
+
+        self.centroids = self.kmeans(self.normalize(self.get_vectors(sample)),
+                                     min(self.nlist, len(sample)))
+        self.lists = [InvertedList() for centroid in self.centroids]
+        self.buffer = InvertedList()
+        self.list_numbers[:] = NOT_INDEXED
+        self.size = 0
+
+        self.add(rows)
+
+        logger.info(f'IVF index trained: {len(self.centroids)} lists, {len(self)} embeddings')  # noqa: E501
+
+    # spherical k-means, i.e., on normalized vectors with cosine similarity
+    def kmeans(self, vectors: np.ndarray, clusters: int) -> np.ndarray:
+
+        centroids = vectors[self.rng.choice(len(vectors), clusters,
+                                            replace=False)].copy()
+
+        for iteration in range(self.KMEANS_ITERATIONS):
+            assignments = self.assign(vectors, centroids)
+
+            # sum each cluster's vectors, sorted so each cluster is one
+            # contiguous block
+            order = np.argsort(assignments, kind='stable')
+            present, starts = np.unique(assignments[order],
+                                        return_index=True)
+
+            sums = np.zeros_like(centroids)
+            sums[present] = np.add.reduceat(vectors[order], starts)
+
+            # re-seed empty clusters with random vectors
+            empty = np.setdiff1d(np.arange(clusters), present)
+            sums[empty] = vectors[self.rng.choice(len(vectors), len(empty))]
+
+            centroids = self.normalize(sums)
+
+        return centroids
+
+    # closest centroid for each embedding
+    def assign(self, embeddings: np.ndarray,
+               centroids: np.ndarray = None) -> np.ndarray:
+
+        centroids = self.centroids if centroids is None else centroids
+
+        return np.concatenate([
+            np.argmax(embeddings[i:i + self.CHUNK_SIZE] @ centroids.T, axis=1)
+            for i in range(0, len(embeddings), self.CHUNK_SIZE)])
+
+    # the k closest rows for each of a (N x D) block of probes, scanning the
+    # nprobe closest lists (defaults to the index's nprobe). Returns a list
+    # of (rows, distances) per probe, closest first, with fewer than k
+    # entries if the probed lists hold fewer rows. Distances are cosine, or
+    # euclidean between the normalized embeddings.
+    def search(self, probes: np.ndarray, k: int, nprobe: int = None,
+               score_type: str = 'cosine') -> list:
+
+        probes = self.normalize(probes)
+
+        # per probe: (similarities, rows) of the candidates, one entry per
+        # scanned list
+        candidates = [[] for probe in probes]
+
+        if self.buffer.size:
+            self.scan(-1, probes, np.arange(len(probes)), candidates)
+
+        if self.trained:
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            closest = np.argpartition(-(probes @ self.centroids.T),
+                                      nprobe - 1, axis=1)[:, :nprobe]
+
+            # scan each list once for all the probes that selected it
+            for list_number in np.unique(closest):
+                probe_rows = np.flatnonzero((closest == list_number).
+                                            any(axis=1))
+                self.scan(int(list_number), probes, probe_rows, candidates)
+
+        return [self.select(probe_candidates, k, score_type)
+                for probe_candidates in candidates]
+
+    def scan(self, list_number: int, probes: np.ndarray,
+             probe_rows: np.ndarray, candidates: list):
+
+        inverted = self.get_list(list_number)
+
+        if inverted.size == 0:
+            return
+
+        rows = inverted.data()
+        similarities = probes[probe_rows] @ self.get_vectors(rows).T
+
+        for probe_row, row_similarities in zip(probe_rows, similarities):
+            candidates[probe_row].append((row_similarities, rows))
+
+    def select(self, candidates: list, k: int, score_type: str) -> tuple:
+
+        if not candidates:
+            return [], []
+
+        similarities = np.concatenate([block for block, rows
+                                       in candidates])
+        rows = np.concatenate([rows for block, rows in candidates])
+
+        k = min(k, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+
+        if score_type == 'euclidean':
+            distances = np.sqrt(np.maximum(2 - 2 * similarities[top], 0))
+
+        else:
+            distances = 1 - similarities[top]
+
+        return rows[top].tolist(), distances.tolist()
+
+    # write the index to a uniquely named temp file in the same folder and
+    # swap it in, i.e., processes saving at the same time can't write into
+    # each other's temp file, the last one wins
+    def save(self, path: str = None):
+
+        path = path or self.path
+        rows = self.rows()
+        dim = self.dim or 0
+
+        centroids = self.centroids if self.trained \
+            else np.empty((0, dim), dtype=np.float32)
+
+        descriptor, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                np.savez(file, config=np.array([dim, self.nlist, self.nprobe]),
+                         centroids=centroids, rows=rows,
+                         list_numbers=self.list_numbers[rows])
+
+            os.replace(temp_path, path)
+
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self.unsaved = 0
+
+        logger.info(f'IVF index with {len(self)} embeddings saved to {path}')
+
+    @classmethod
+    def load(cls, path: str):
+
+        with np.load(path, allow_pickle=False) as data:
+            dim, nlist, nprobe = data['config'].tolist()
+            index = cls(nlist, nprobe, path)
+
+            if dim:
+                index.dim = dim
+
+            if len(data['centroids']):
+                index.centroids = data['centroids']
+                index.lists = [InvertedList()
+                               for centroid in index.centroids]
+
+            rows = data['rows']
+            list_numbers = data['list_numbers']
+
+        if len(rows):
+            index.reserve(int(rows.max()) + 1)
+
+        for list_number in np.unique(list_numbers):
+            index.append(int(list_number), rows[list_numbers == list_number])
+
+        logger.info(f'IVF index with {len(index)} embeddings loaded from {path}')  # noqa: E501
+
+        return index
@@ -0,0 +1,295 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# asyncio (aiohttp) based alternative to server.py with the same /ping,
+# /identity and /cached_data contract. Requests are parsed and photos decoded
+# concurrently, while all the model work goes to a small, bounded executor
+# that shares a single instance of the models, i.e., more concurrent
+# connections per node without a copy of the models per worker process. When
+# the model queue is full requests are rejected with a 429 rather than piling
+# up. Run with: python async_server.py
+import asyncio
+import contextvars
+import json
+import os
+import time
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from batching import BatchScheduler
+from metrics import Metrics
+from photo_inferencing import Inferencing
+from readiness import Readiness
+from response_builder import ResponseBuilder
+from score_service import SCORE_TYPES, SimilarityScore
+from logging_util import begin_request, logger
+
+# threads running model work against the shared model instance
+MODEL_WORKERS = int(os.environ.get('MODEL_WORKERS', 1))
+
+# max model jobs queued or running before requests are rejected
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 32))
+
+# threads for decoding photos and loading cached tensors
+DECODE_WORKERS = int(os.environ.get('DECODE_WORKERS', 4))
+
+# aiohttp caps request bodies at 1 MB by default
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024
+
+
+# executor with a cap on the number of jobs queued or running, only used from
+# the event loop thread, so the counter doesn't need a lock
+class BoundedExecutor:
+
+    def __init__(self, workers: int, max_depth: int, name: str):
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.max_depth = max_depth
+        self.depth = 0
+
+    async def run(self, function: object, *args) -> object:
+
+        if self.depth >= self.max_depth:
+            raise web.HTTPTooManyRequests(
+                text=json.dumps({"error": "inferencing queue is full"}),
+                content_type='application/json',
+                headers={'Retry-After': '1'})
+
+        self.depth += 1
+
+        try:
+            # in the request's context, i.e., with its correlation ID
+            return await asyncio.get_running_loop().\
+                run_in_executor(self.executor, contextvars.copy_context().run,
+                                function, *args)
+
+        finally:
+            self.depth -= 1
+
+
+# instantiate the class with the ML models
+photo_match = Inferencing()
+logger.info('ML models instantiated')
+
+# with more than one model worker, their embedding passes can be batched
+if os.environ.get('EMBEDDING_BATCHING', 'false').lower() == 'true':
+    inferencing = BatchScheduler(
+        photo_match,
+        int(os.environ.get('MAX_BATCH_SIZE', 32)),
+        float(os.environ.get('MAX_BATCH_WAIT_MS', 5)))
+
+else:
+    inferencing = photo_match
+
+# warm-up on a background thread, "/ready" reports ready once it's done
+readiness = Readiness(
+    photo_match,
+    [int(size) for size in
+     os.environ.get('WARM_UP_BATCH_SIZES', '1,2,8').split(',')],
+    inferencing if inferencing is not photo_match else None)
+
+# fork the detection pool's processes before any other thread starts
+if photo_match.detection_pool is not None:
+    photo_match.detection_pool.start()
+
+readiness.start()
+
+# instantiate the class with the scoring functionality
+scoring = SimilarityScore()
+responses = ResponseBuilder(scoring)
+logger.info('Scoring/similarity class instantiated')
+
+model_executor = BoundedExecutor(MODEL_WORKERS, MAX_QUEUE_DEPTH, 'model')
+decode_executor = ThreadPoolExecutor(DECODE_WORKERS,
+                                     thread_name_prefix='decode')
+
+# same metrics as server.py, detection and embedding run as one model job
+# here, so they're timed together as the "inference" stage (incl. the wait
+# for a model worker)
+metrics = Metrics()
+metrics.register_gauge('model_queue_depth',
+                       'Model jobs queued or running',
+                       lambda: model_executor.depth)
+
+if isinstance(inferencing, BatchScheduler):
+    metrics.register_gauge('embedding_queue_depth',
+                           'Embedding requests waiting for a batch',
+                           inferencing.queue_depth)
+
+
+async def decode(function: object, *args) -> object:
+
+    return await asyncio.get_running_loop().\
+        run_in_executor(decode_executor, contextvars.copy_context().run,
+                        function, *args)
+
+
+# request counters, in-flight gauge and end to end latency, the endpoint is
+# the handler's name, same as the Flask endpoint names. Also sets the
+# request's correlation ID for its log lines, each request runs in its own
+# task, i.e., its own context.
+@web.middleware
+async def track_requests(request: web.Request, handler: object) -> object:
+
+    endpoint = request.match_info.handler.__name__
+    status = 500
+    start = time.perf_counter()
+    request_id = begin_request(request.headers.get('X-Request-ID'))
+    metrics.request_started(endpoint)
+
+    try:
+        response = await handler(request)
+        status = response.status
+        response.headers['X-Request-ID'] = request_id
+
+        return response
+
+    except web.HTTPException as e:
+        status = e.status
+        raise
+
+    finally:
+        metrics.request_finished(endpoint, status,
+                                 time.perf_counter() - start)
+
+
+def json_response(resultjson: str, status: int = 200) -> web.Response:
+
+    return web.Response(text=resultjson, status=status,
+                        content_type='application/json')
+
+
+# a 400 with a JSON error for a score type other than cosine/euclidean
+def unknown_score_type(score_type: str) -> web.Response:
+
+    return json_response(json.dumps({"error": f'unknown score type {score_type}, expected one of {", ".join(SCORE_TYPES)}'}), 400)  # noqa: E501
+
+
+# endpoint for API health check
+# the "ping" endpoint is one that is required by AWS
+async def health(request: web.Request) -> web.Response:
+
+    logger.info('health check request received')
+
+    results = {"API Status": 200}
+    resultjson = json.dumps(results)
+
+    return json_response(resultjson)
+
+
+# readiness endpoint, 503 until the models are warmed up
+async def ready(request: web.Request) -> web.Response:
+
+    return json_response(json.dumps(readiness.report()),
+                         200 if readiness.ready else 503)
+
+
+# this process' metrics, in the Prometheus text format
+async def prometheus_metrics(request: web.Request) -> web.Response:
+
+    return web.Response(text=metrics.render(),
+                        content_type='text/plain')
+
+
+# endpoint for matches from two photos
+async def embeddings(request: web.Request) -> web.Response:
+
+    with metrics.stage('embeddings', 'parse'):
+        form = await request.post()
+
+        score_type = form.get('type', 'cosine')
+        threshold = float(form.get('threshold'))
+
+    logger.info('Request received at endpoint for photo pairs, score type: %s, and match threshold: %s', score_type, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
+    # decode both photos concurrently
+    with metrics.stage('embeddings', 'decode'):
+        ref_img, sample_img = await asyncio.gather(
+            decode(responses.load_images, form['reference'].file),
+            decode(responses.load_images, form['sample'].file))
+
+    start = time.perf_counter()
+
+    with metrics.stage('embeddings', 'inference'):
+        ref_tensor, sample_tensor = await model_executor.run(
+            inferencing.identity_verify, ref_img, sample_img)
+
+    end = time.perf_counter()
+
+    latency = round(1000 * (end - start), 2)
+    logger.info('Facial embeddings generated, inferencing latency: %s ms', latency, extra={'latency_ms': latency})  # noqa: E501
+
+    with metrics.stage('embeddings', 'scoring'):
+        results = responses.build_results(latency, ref_tensor,
+                                          sample_tensor, score_type,
+                                          threshold)
+
+    with metrics.stage('embeddings', 'serialization'):
+        resultjson = json.dumps(results)
+
+    return json_response(resultjson)
+
+
+# endpoint for presenting a pre-processed/cached tensor and a sample photo
+async def cached(request: web.Request) -> web.Response:
+
+    with metrics.stage('cached', 'parse'):
+        form = await request.post()
+
+        score_type = form.get('type', 'cosine')
+        threshold = float(form.get('threshold'))
+
+    logger.info('Request received at cached data endpoint, score type: %s, match threshold: %s', score_type, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
+    with metrics.stage('cached', 'decode'):
+        cached_tensor, sample_img = await asyncio.gather(
+            decode(responses.load_reference, form['reference'].file),
+            decode(responses.load_images, form['sample'].file))
+
+    start = time.perf_counter()
+
+    cached_tensor = cached_tensor.to(photo_match.device)
+
+    # score in the same space as the reference, see server.py
+    logits = photo_match.logit_space(cached_tensor.shape[-1])
+
+    with metrics.stage('cached', 'inference'):
+        sample_tensor = await model_executor.run(
+            inferencing.cached_reference, sample_img, logits)
+
+    if sample_tensor is None:
+        return json_response(json.dumps(
+            {"error": "no face detected in the sample photo"}), 422)
+
+    end = time.perf_counter()
+
+    latency = round(1000 * (end - start), 2)
+
+    logger.info('Facial embedding generated for sample photo, inferencing latency: %s', latency, extra={'latency_ms': latency})  # noqa: E501
+
+    with metrics.stage('cached', 'scoring'):
+        results = responses.build_results(latency, cached_tensor,
+                                          sample_tensor, score_type,
+                                          threshold)
+
+    with metrics.stage('cached', 'serialization'):
+        resultjson = json.dumps(results)
+
+    return json_response(resultjson)
+
+
+app = web.Application(client_max_size=MAX_UPLOAD_SIZE,
+                      middlewares=[track_requests])
+app.add_routes([web.get('/ping', health),
+                web.get('/ready', ready),
+                web.get('/metrics', prometheus_metrics),
+                web.post('/identity', embeddings),
+                web.post('/cached_data', cached)])
+
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=int(os.environ.get('PORT', 6000)))
@@ -0,0 +1,193 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Dynamic micro-batching for the embedding network: cropped faces from
+# concurrent requests are collected until either the max batch size or the
+# max wait time is reached, then run through InceptionResnetV1 in a single
+# batched forward pass and each caller gets its own slice of the results.
+# Face detection still runs on the request threads.
+import os
+import queue
+import threading
+import time
+import torch
+from concurrent.futures import Future
+from logging_util import logger
+
+
+class BatchScheduler:
+
+    def __init__(self, engine: object, max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0):
+
+        # the Inferencing instance that does detection and embeddings
+        self.engine = engine
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        # the batching thread is started on first use, as threads don't
+        # survive a fork, e.g., when gunicorn preloads the app
+        self.requests = None
+        self.worker = None
+        self.pid = None
+
+        self.start_lock = threading.Lock()
+
+        # request that didn't fit in the previous batch
+        self.carry_over = None
+
+        logger.info('Batch scheduler configured, max batch size: %s, max wait: %s ms', max_batch_size, max_wait_ms)  # noqa: E501
+
+    # same signature as Inferencing.identity_verify
+    def identity_verify(self, reference: object, sample: object) -> object:
+
+        faces = torch.stack((self.engine.detect_face(reference),
+                             self.engine.detect_face(sample)))
+
+        embeddings = self.embed_faces(faces)
+
+        return embeddings[0:1], embeddings[1:2]
+
+    # same signature as Inferencing.cached_reference
+    def cached_reference(self, sample: object, logits: bool = None) -> object:
+
+        sample_cropped = self.engine.detect_face(sample)
+
+        if sample_cropped is None:
+            return None
+
+        return self.embed_faces(sample_cropped.unsqueeze(0), logits)
+
+    # queue a (N x 3 x 160 x 160) batch of faces for the next forward pass
+    # and block until its embeddings are ready
+    def embed_faces(self, faces: object, logits: bool = None) -> object:
+
+        self.start_worker()
+
+        future = Future()
+        self.requests.put((faces, logits, future))
+
+        return future.result()
+
+    # embedding requests waiting for a forward pass, for the metrics
+    def queue_depth(self) -> int:
+
+        if self.pid != os.getpid():
+            return 0
+
+        return self.requests.qsize() + (self.carry_over is not None)
+
+    # (re)start the batching thread if it isn't running in this process
+    def start_worker(self):
+
+        if self.pid == os.getpid():
+            return
+
+        with self.start_lock:
+
+            if self.pid == os.getpid():
+                return
+
+            self.requests = queue.Queue()
+            self.carry_over = None
+
+            self.worker = threading.Thread(target=self.run, daemon=True,
+                                           name='embedding_batcher')
+            self.worker.start()
+            self.pid = os.getpid()
+
+    def next_request(self, timeout: float = None) -> tuple:
+
+        if self.carry_over is not None:
+            request, self.carry_over = self.carry_over, None
+            return request
+
+        if timeout is None:
+            return self.requests.get()
+
+        return self.requests.get(timeout=timeout)
+
+    # collect requests until the batch is full or the wait time is up
+    def collect_batch(self) -> list:
+
+        request = self.next_request()
+
+        batch = [request]
+        size = len(request[0])
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                break
+
+            try:
+                request = self.next_request(remaining)
+
+            except queue.Empty:
+                break
+
+            # hold the request over to the next batch if it doesn't fit
+            if size + len(request[0]) > self.max_batch_size:
+                self.carry_over = request
+                break
+
+            batch.append(request)
+            size += len(request[0])
+
+        return batch
+
+    # the worker thread isn't restarted, so nothing may escape the loop, the
+    # futures of a batch that failed are failed rather than left pending
+    def run(self):
+
+        while True:
+            batch = []
+
+            try:
+                batch = self.collect_batch()
+                self.run_batch(batch)
+
+            except Exception as e:
+                logger.error(f'Embedding batch failed with error: {e}')
+                self.fail(batch, e)
+
+    @staticmethod
+    def fail(batch: list, error: Exception):
+
+        for faces, logits, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    # one forward pass for the whole batch, the features are then projected
+    # to embeddings or logits depending on what each request asked for
+    def run_batch(self, batch: list):
+
+        try:
+            faces = torch.cat([faces for faces, logits, future in batch])
+            features = self.engine.features(faces)
+
+        except Exception as e:
+            logger.error(f'Batched embedding pass failed with error: {e}')
+            self.fail(batch, e)
+
+            return
+
+        start = 0
+
+        # a failed projection (e.g., out of memory for the logits layer)
+        # only fails its own request
+        for faces, logits, future in batch:
+
+            try:
+                future.set_result(self.engine.project(
+                    features[start:start + len(faces)], logits))
+
+            except Exception as e:
+                logger.error(f'Embedding projection failed with error: {e}')
+                self.fail([(faces, logits, future)], e)
+
+            start += len(faces)
@@ -0,0 +1,221 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Face detection in a pool of worker processes. MTCNN does a lot of Python
+# level work per photo (image pyramid, NMS, box regression) that serializes
+# behind the GIL when run on threads, with a process pool detection scales
+# with the number of cores while the embedding model stays in the main
+# process. Decoded photos are handed to the workers and the cropped faces
+# handed back via shared memory rather than being pickled.
+import multiprocessing
+import os
+import threading
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image
+from logging_util import logger
+
+# cropped face tensors returned by MTCNN
+FACE_SHAPE = (3, 160, 160)
+FACE_BYTES = 4 * 3 * 160 * 160
+
+# MTCNN instance for each worker process, created by init_worker
+detector = None
+
+
+def init_worker():
+
+    global detector
+
+    from facenet_pytorch import MTCNN
+
+    # one PyTorch thread per process, the pool provides the parallelism
+    torch.set_num_threads(1)
+
+    detector = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                     0.709, True, True, None,
+                     False, device='cpu').eval()
+
+
+# runs in the worker: read the photo from shared memory, detect the face and
+# write the cropped face to the output block, returns False if no face was
+# found
+def detect_worker(image_name: str, shape: tuple, face_name: str) -> bool:
+
+    image_memory = SharedMemory(name=image_name)
+    face_memory = SharedMemory(name=face_name)
+
+    try:
+        view = np.ndarray(shape, dtype=np.uint8, buffer=image_memory.buf)
+        photo = Image.fromarray(view.copy())
+        del view
+
+        with torch.inference_mode():
+            face = detector(photo)
+
+        if face is None:
+            return False
+
+        output = np.ndarray(FACE_SHAPE, dtype=np.float32,
+                            buffer=face_memory.buf)
+        output[:] = face.numpy()
+        del output
+
+        return True
+
+    finally:
+        image_memory.close()
+        face_memory.close()
+
+
+class DetectionPool:
+
+    def __init__(self, workers: int):
+
+        self.workers = workers
+
+        # the pool is per process, as the processes and the executor's
+        # threads don't survive a fork, e.g., when gunicorn preloads the app,
+        # see start()
+        self.executor = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+        # photos submitted and not collected yet, i.e., queued or being
+        # detected
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+
+        logger.info(f'Face detection will run in a pool of {workers} processes')  # noqa: E501
+
+    # create the pool and fork its processes now rather than on the first
+    # submit: forking a process that's already running other threads
+    # (request threads, the warm-up, busy PyTorch/OpenMP thread pools) can
+    # leave a child with a lock that's never released, i.e., deadlocked.
+    # Call it early in each process, before those threads exist, see
+    # server.py and gunicorn_config.py's post_fork. Fork rather than spawn,
+    # spawn re-imports the main module, i.e., the server, in every process.
+    def start(self) -> ProcessPoolExecutor:
+
+        if self.pid == os.getpid():
+            return self.executor
+
+        with self.start_lock:
+
+            if self.pid != os.getpid():
+                executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=init_worker)
+
+                # with fork all the processes are started on the first
+                # submit
+                executor.submit(os.getpid).result()
+
+                self.executor = executor
+                self.pid = os.getpid()
+
+        return self.executor
+
+    # copy a photo into shared memory and queue it for detection, returns
+    # the future plus the shared memory blocks to read/release afterwards
+    def submit(self, photo: object) -> tuple:
+
+        # raw photos are already (height x width x 3) uint8 tensors
+        if isinstance(photo, torch.Tensor):
+            array = photo.numpy()
+
+        else:
+            array = np.asarray(photo.convert('RGB'))
+
+        memories = []
+
+        try:
+            image_memory = SharedMemory(create=True, size=array.nbytes)
+            memories.append(image_memory)
+            face_memory = SharedMemory(create=True, size=FACE_BYTES)
+            memories.append(face_memory)
+
+            view = np.ndarray(array.shape, dtype=np.uint8,
+                              buffer=image_memory.buf)
+            view[:] = array
+            del view
+
+            future = self.start().submit(detect_worker, image_memory.name,
+                                         array.shape, face_memory.name)
+
+        # nothing will collect the job, release the blocks here
+        except BaseException:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+
+            raise
+
+        with self.pending_lock:
+            self.pending += 1
+
+        return future, image_memory, face_memory
+
+    # wait for a detection job, returns the cropped face or None
+    def collect(self, future: object, image_memory: SharedMemory,
+                face_memory: SharedMemory) -> object:
+
+        try:
+            if not future.result():
+                return None
+
+            view = np.ndarray(FACE_SHAPE, dtype=np.float32,
+                              buffer=face_memory.buf)
+            face = torch.from_numpy(view.copy())
+            del view
+
+            return face
+
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+
+            for memory in (image_memory, face_memory):
+                memory.close()
+                memory.unlink()
+
+    # same as Inferencing.detect_face
+    def detect_face(self, photo: object) -> object:
+
+        return self.collect(*self.submit(photo))
+
+    # detect the face in each of a list of photos, the photos are spread
+    # across the worker processes
+    def detect_face_batch(self, photos: list) -> list:
+
+        jobs = []
+
+        try:
+            for photo in photos:
+                jobs.append(self.submit(photo))
+
+        # collect what was submitted, so its shared memory is released
+        except BaseException:
+            for job in jobs:
+                try:
+                    self.collect(*job)
+
+                except Exception:
+                    pass
+
+            raise
+
+        return [self.collect_single(job) for job in jobs]
+
+    # collect a job for detect_face_batch, returns the exception if
+    # detection failed, same as Inferencing.detect_face_batch
+    def collect_single(self, job: tuple) -> object:
+
+        try:
+            return self.collect(*job)
+
+        except Exception as error:
+            return error
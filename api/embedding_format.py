@@ -0,0 +1,147 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Compact binary format for embeddings (.femb), used instead of pickled .pt
+# files: parsing it doesn't execute any code, it's smaller and it can be read
+# straight into a tensor without unpickling. Layout, all little-endian:
+#   16 byte header: magic b'FEMB', version (u8), dtype (u8), reserved (u16),
+#                   count (u32), dim (u32)
+#   int8 only: count float32 scales, one per embedding
+#   count x dim values of the given dtype
+# This is the only implementation, the scripts outside the api folder import
+# it via common_utils/embedding_format.py.
+import io
+import struct
+import warnings
+import numpy as np
+import torch
+
+MAGIC = b'FEMB'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHII')
+
+# dtype name -> (header code, numpy dtype)
+DTYPES = {'float32': (0, '<f4'),
+          'float16': (1, '<f2'),
+          'int8': (2, 'i1')}
+
+DTYPE_NAMES = {code: name for name, (code, numpy_dtype) in DTYPES.items()}
+
+
+class EmbeddingFormat:
+
+    @staticmethod
+    def is_embedding_file(data: bytes) -> bool:
+
+        return bytes(data[:4]) == MAGIC
+
+    # per embedding symmetric int8 quantization: each row is scaled so its
+    # largest absolute value maps to 127, returns the int8 values and the
+    # float32 scales
+    @staticmethod
+    def quantize(embeddings: object) -> tuple:
+
+        scales = embeddings.abs().amax(dim=1).clamp(min=1e-12) / 127
+        values = torch.round(embeddings / scales.unsqueeze(1)).\
+            clamp(-127, 127).to(torch.int8)
+
+        return values, scales
+
+    # encode a (count x dim) block of embeddings, dtype is float32, float16
+    # or int8
+    @classmethod
+    def encode(cls, embeddings: object, dtype: str = 'float32') -> bytes:
+
+        embeddings = embeddings.detach().cpu().float()
+        embeddings = embeddings.reshape(-1, embeddings.shape[-1])
+        count, dim = embeddings.shape
+
+        code, numpy_dtype = DTYPES[dtype]
+        header = HEADER.pack(MAGIC, VERSION, code, 0, count, dim)
+
+        if dtype == 'int8':
+            values, scales = cls.quantize(embeddings)
+
+            return header + scales.numpy().astype('<f4').tobytes() + \
+                values.numpy().tobytes()
+
+        return header + embeddings.numpy().astype(numpy_dtype).tobytes()
+
+    # parse the header, returns the dtype name, count and dim
+    @staticmethod
+    def read_header(data: bytes) -> tuple:
+
+        if len(data) < HEADER.size:
+            raise ValueError('embedding data is shorter than the header')
+
+        magic, version, code, reserved, count, dim = \
+            HEADER.unpack_from(data)
+
+        if magic != MAGIC:
+            raise ValueError('not an embedding file')
+
+        if version != VERSION or code not in DTYPE_NAMES:
+            raise ValueError(f'unsupported embedding file version {version}, dtype {code}')  # noqa: E501
+
+        return DTYPE_NAMES[code], count, dim
+
+    # view part of the buffer as a tensor without copying it, the buffer is
+    # read only, which PyTorch warns about, but the tensor is never written
+    @staticmethod
+    def view(data: bytes, numpy_dtype: str, count: int,
+             offset: int) -> object:
+
+        array = np.frombuffer(data, dtype=numpy_dtype, count=count,
+                              offset=offset)
+
+        # big endian hosts need the bytes swapped, i.e., a copy
+        if not array.dtype.isnative:
+            array = array.astype(array.dtype.newbyteorder('='))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return torch.from_numpy(array)
+
+    # decode to a (count x dim) float32 tensor, zero-copy for float32 data
+    @classmethod
+    def decode(cls, data: bytes) -> object:
+
+        dtype, count, dim = cls.read_header(data)
+        numpy_dtype = DTYPES[dtype][1]
+        offset = HEADER.size
+
+        if dtype == 'int8':
+            scales = cls.view(data, '<f4', count, offset)
+            values = cls.view(data, numpy_dtype, count * dim,
+                              offset + 4 * count).reshape(count, dim)
+
+            return values.float() * scales.unsqueeze(1)
+
+        embeddings = cls.view(data, numpy_dtype, count * dim, offset).\
+            reshape(count, dim)
+
+        return embeddings if dtype == 'float32' else embeddings.float()
+
+    # load a reference from an upload/file's bytes: .femb data is decoded,
+    # anything else is treated as a legacy .pt file and loaded with
+    # weights_only, so it can't execute code on the server
+    @classmethod
+    def from_bytes(cls, data: bytes) -> object:
+
+        if cls.is_embedding_file(data):
+            return cls.decode(data)
+
+        return torch.load(io.BytesIO(data), map_location='cpu',
+                          weights_only=True)
+
+    @classmethod
+    def load(cls, path: str) -> object:
+
+        with open(path, 'rb') as file:
+            return cls.from_bytes(file.read())
+
+    @classmethod
+    def save(cls, embeddings: object, path: str, dtype: str = 'float32'):
+
+        with open(path, 'wb') as file:
+            file.write(cls.encode(embeddings, dtype))
@@ -0,0 +1,406 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Persistent store for enrolled reference embeddings: a fixed width matrix
+# file (float32, or float16/int8 for large galleries) that is memory-mapped,
+# plus a log that maps each identity to its row. Both are append-only: an
+# enrollment appends its rows to the matrix file and a (row, identity) line
+# to the log, a removal appends a (row, null) tombstone, so the matrix is
+# never rewritten and each worker only reads the lines it hasn't seen yet.
+# The log is compacted once it's mostly stale lines, the same way as the
+# enrollment manifest (common_utils/enrollment_manifest.py). A small JSON
+# header holds the width, dtype and row count. Each gunicorn worker maps the
+# same matrix file, i.e., the gallery pages are shared via the OS page cache
+# rather than every worker holding its own copy. float16 halves and int8
+# quarters the memory per identity, see SimilarityScore for scoring the
+# quantized rows.
+import fcntl
+import json
+import os
+import warnings
+import numpy as np
+import torch
+import torch.nn.functional as F
+from contextlib import contextmanager, nullcontext
+from embedding_format import EmbeddingFormat
+from logging_util import logger
+
+
+class EmbeddingStore:
+
+    # matrix file + numpy dtype for each storage dtype, int8 rows also have
+    # a float32 scale each, stored in SCALES_FILE
+    MATRIX_FILES = {'float32': ('embeddings.f32', '<f4'),
+                    'float16': ('embeddings.f16', '<f2'),
+                    'int8': ('embeddings.i8', 'i1')}
+    SCALES_FILE = 'scales.f32'
+    INDEX_FILE = 'index.json'
+    LOG_FILE = 'rows.jsonl'
+    LOCK_FILE = '.lock'
+
+    # dtype only applies to a new store, an existing store keeps the dtype
+    # it was created with
+    def __init__(self, path: str, dtype: str = 'float32'):
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.index_path = os.path.join(path, self.INDEX_FILE)
+        self.log_path = os.path.join(path, self.LOG_FILE)
+        self.lock_path = os.path.join(path, self.LOCK_FILE)
+        self.scales_path = os.path.join(path, self.SCALES_FILE)
+
+        # dim: embedding width, count: rows written to the matrix file
+        # (including removed ones), rows: identity -> row number, names: row
+        # aligned identities, None for removed rows
+        self.dim = None
+        self.count = 0
+        self.rows = {}
+        self.names = []
+        self.matrix = None
+        self.scales = None
+
+        # the log as read so far: open file (i.e., its inode can't be reused
+        # while we hold it), bytes and lines applied
+        self.log_file = None
+        self.log_offset = 0
+        self.log_lines = 0
+
+        # rows changed since the log was last read from the start, so a
+        # gallery can apply just those, generation counts the full reads
+        self.generation = 0
+        self.changes = []
+
+        self.set_dtype(dtype)
+
+        self.refresh()
+
+        logger.info(f'Embedding store opened at {path}, {len(self)} identities')  # noqa: E501
+
+    def __len__(self):
+
+        return len(self.rows)
+
+    # exclusive lock across processes, so that concurrent enrollments from
+    # different gunicorn workers don't interleave their appends
+    @contextmanager
+    def lock(self):
+
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                yield
+
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # apply the log lines other processes have appended since the last
+    # call, it's just a stat() call when nothing has changed. The log is
+    # read from the start if it was compacted, i.e., replaced. Returns True
+    # if the store changed.
+    def refresh(self) -> bool:
+
+        try:
+            stat = os.stat(self.log_path)
+
+        except FileNotFoundError:
+            return False
+
+        if self.log_file is None or \
+                os.fstat(self.log_file.fileno()).st_ino != stat.st_ino:
+            self.reload()
+
+        elif stat.st_size == self.log_offset:
+            return False
+
+        self.log_file.seek(self.log_offset)
+        data = self.log_file.read()
+
+        # only complete lines, a line being appended is picked up next time
+        data = data[:data.rfind(b'\n') + 1]
+        count = self.count
+
+        for line in data.splitlines():
+            row, identity = json.loads(line)
+            self.apply(row, identity)
+
+        self.log_offset += len(data)
+        self.log_lines += data.count(b'\n')
+
+        if self.count != count or self.matrix is None:
+            self.map_matrix()
+
+        return True
+
+    # start over from the header and the start of the log
+    def reload(self):
+
+        if self.log_file is not None:
+            self.log_file.close()
+
+        self.log_file = open(self.log_path, 'rb')
+        self.log_offset = 0
+        self.log_lines = 0
+
+        with open(self.index_path) as file:
+            index = json.load(file)
+
+        self.dim = index['dim']
+        self.count = index['count']
+        self.rows = {}
+        self.names = [None] * self.count
+        self.matrix = None
+        self.set_dtype(index['dtype'])
+
+        self.generation += 1
+        self.changes = []
+
+    # one log line: a row enrolled as an identity, or a tombstone (identity
+    # None), a replaced identity's old row is orphaned
+    def apply(self, row: int, identity: str):
+
+        if row >= self.count:
+            self.names += [None] * (row + 1 - self.count)
+            self.count = row + 1
+
+        if identity is None:
+            identity = self.names[row]
+
+            if identity is not None and self.rows.get(identity) == row:
+                del self.rows[identity]
+
+            self.names[row] = None
+
+        else:
+            old_row = self.rows.get(identity)
+
+            if old_row is not None and old_row != row:
+                self.names[old_row] = None
+                self.changes.append(old_row)
+
+            self.rows[identity] = row
+            self.names[row] = identity
+
+        self.changes.append(row)
+
+    def set_dtype(self, dtype: str):
+
+        self.dtype = dtype
+        matrix_file, self.numpy_dtype = self.MATRIX_FILES[dtype]
+        self.matrix_path = os.path.join(self.path, matrix_file)
+
+    @staticmethod
+    def map_file(path: str, numpy_dtype: str, shape: tuple) -> object:
+
+        array = np.memmap(path, dtype=numpy_dtype, mode='r', shape=shape)
+
+        # the mapping is read only, PyTorch warns about that but we never
+        # write to the tensor
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return torch.from_numpy(array)
+
+    def map_matrix(self):
+
+        if self.count == 0:
+            self.matrix = None
+            self.scales = None
+            return
+
+        self.matrix = self.map_file(self.matrix_path, self.numpy_dtype,
+                                    (self.count, self.dim))
+
+        if self.dtype == 'int8':
+            self.scales = self.map_file(self.scales_path, '<f4',
+                                        (self.count,))
+
+    # write a file via a temp file that's fsynced and swapped in, so readers
+    # (and a restart after a crash) never see a partially written file
+    @staticmethod
+    def replace_file(path: str, lines: object):
+
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, path)
+
+    def write_index(self):
+
+        self.replace_file(self.index_path, [json.dumps(
+            {"dim": self.dim, "count": self.count, "dtype": self.dtype})])
+
+    # append (row, identity) lines to the log, identity None for a removed
+    # row, and apply them
+    def append_log(self, entries: list):
+
+        if not os.path.exists(self.log_path):
+            self.write_index()
+            self.replace_file(self.log_path, [])
+
+        with open(self.log_path, 'a') as file:
+            file.writelines(json.dumps(entry) + '\n' for entry in entries)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.refresh()
+
+        if self.log_lines > 2 * len(self.rows) + 1000:
+            self.compact()
+
+    # rewrite the log with one line per enrolled identity, in row order,
+    # the header first so its row count covers the log. Other processes
+    # read the new log from the start.
+    def compact(self):
+
+        self.write_index()
+        self.replace_file(self.log_path, (
+            json.dumps([row, identity]) + '\n'
+            for identity, row in sorted(self.rows.items(),
+                                        key=lambda item: item[1])))
+
+        self.refresh()
+
+        logger.info(f'Embedding store log compacted, {len(self)} identities')  # noqa: E501
+
+    # append rows to one of the store's files
+    def append_rows(self, path: str, data: bytes, row_bytes: int):
+
+        with open(path, 'ab') as file:
+
+            # drop anything past the last logged row, e.g., a partial write
+            # from a crashed process
+            if file.tell() != self.count * row_bytes:
+                file.truncate(self.count * row_bytes)
+
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+    # add or replace an identity, the embedding is L2 normalized (and
+    # quantized for float16/int8 stores) and appended to the matrix file, a
+    # replaced identity's old row is simply orphaned
+    def enroll(self, identity: str, embedding: object) -> int:
+
+        return self.enroll_batch([identity], embedding.reshape(1, -1))[0]
+
+    # same as enroll for a (N x D) block of embeddings, one identity per row,
+    # with a single append to the matrix and the log for the whole block,
+    # i.e., the way to do bulk loads. Returns the row of each identity.
+    # locked=True if the caller already holds the lock, flock isn't
+    # reentrant.
+    def enroll_batch(self, identities: list, embeddings: object,
+                     locked: bool = False) -> list:
+
+        embeddings = F.normalize(
+            embeddings.detach().reshape(len(identities), -1).float(),
+            p=2, dim=1).cpu()
+
+        with nullcontext() if locked else self.lock():
+            self.refresh()
+
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f'Embedding width {embeddings.shape[1]} does not match store width {self.dim}')  # noqa: E501
+
+            if self.dtype == 'int8':
+                values, scales = EmbeddingFormat.quantize(embeddings)
+                self.append_rows(self.scales_path,
+                                 scales.numpy().astype('<f4').tobytes(), 4)
+                rows = values.numpy()
+
+            else:
+                rows = embeddings.numpy().astype(self.numpy_dtype)
+
+            self.append_rows(self.matrix_path, rows.tobytes(),
+                             rows.itemsize * self.dim)
+
+            self.append_log([[self.count + offset, identity]
+                             for offset, identity in enumerate(identities)])
+
+        if len(identities) == 1:
+            logger.info(f'Identity {identities[0]} enrolled at row {self.rows[identities[0]]}')  # noqa: E501
+
+        else:
+            logger.info(f'{len(identities)} identities enrolled, store holds {len(self)}')  # noqa: E501
+
+        return [self.rows[identity] for identity in identities]
+
+    # remove an identity, returns False if it wasn't enrolled
+    def unenroll(self, identity: str) -> bool:
+
+        return self.unenroll_batch([identity]) == 1
+
+    # remove a list of identities with a single append to the log, returns
+    # how many were enrolled
+    def unenroll_batch(self, identities: list) -> int:
+
+        with self.lock():
+            self.refresh()
+
+            removed = [identity for identity in dict.fromkeys(identities)
+                       if identity in self.rows]
+
+            if not removed:
+                return 0
+
+            self.append_log([[self.rows[identity], None]
+                             for identity in removed])
+
+        if len(removed) == 1:
+            logger.info(f'Identity {removed[0]} removed from the store')
+
+        else:
+            logger.info(f'{len(removed)} identities removed from the store')
+
+        return len(removed)
+
+    def identities(self) -> list:
+
+        return sorted(self.rows)
+
+    # one time import of a folder of cached reference tensors (.pt or .femb),
+    # the file name minus the extension is used as the identity, e.g., the
+    # output of deployment_utilities/generate_facenet_tensors.py
+    def import_directory(self, path: str, locked: bool = False):
+
+        if not os.path.isdir(path):
+            logger.warning(f'Reference tensor folder {path} not found, nothing imported')  # noqa: E501
+            return
+
+        identities = []
+        tensors = []
+
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            filenames.sort()
+
+            for file in filenames:
+
+                if not file.endswith(('.pt', '.femb')):
+                    continue
+
+                tensor = EmbeddingFormat.load(os.path.join(dirpath, file))
+                identities.append(os.path.splitext(file)[0])
+                tensors.append(tensor.reshape(1, -1))
+
+        if tensors:
+            self.enroll_batch(identities, torch.cat(tensors), locked)
+
+        logger.info(f'Imported reference tensors from {path}, {len(self)} identities')  # noqa: E501
+
+    # import a folder of cached reference tensors if the store is empty,
+    # under the lock, so workers starting at the same time don't all see an
+    # empty store and each import the folder
+    def seed(self, path: str):
+
+        with self.lock():
+            self.refresh()
+
+            if len(self) == 0:
+                self.import_directory(path, locked=True)
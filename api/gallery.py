@@ -0,0 +1,230 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Gallery of reference embeddings for 1:N identification. The references are
+# L2 normalized and held in one contiguous matrix, so a probe can be scored
+# against every enrolled identity with a single matrix multiply. The matrix
+# can be held as float16 or int8 (plus a scale per row) to cut the memory per
+# identity, it's then scored in its quantized form. For very large galleries
+# an IVFIndex can be attached, searches then only scan part of the gallery.
+import numpy as np
+import torch
+import torch.nn.functional as F
+from embedding_format import EmbeddingFormat
+from score_service import SimilarityScore
+
+
+class GalleryIndex:
+
+    def __init__(self, device: str = 'cpu', dtype: str = 'float32',
+                 ann: object = None):
+
+        self.device = device
+        self.dtype = dtype
+
+        # optional approximate nearest neighbor index, labelled by row
+        # number and kept in sync with the store in load_store
+        self.ann = ann
+
+        # row aligned identity labels, None marks a removed row that is
+        # still present in the matrix
+        self.names = []
+        self.matrix = None
+        self.scales = None
+        self.active = None
+
+        # active (not removed) rows, kept up to date by update_mask
+        self.size = 0
+
+        # store generation and changes applied so far, see load_store
+        self.generation = None
+        self.applied = 0
+
+    def __len__(self):
+
+        return self.size
+
+    # add a batch of (N x D) embeddings to the gallery, one name per row
+    def add(self, names: list, embeddings: object):
+
+        embeddings = embeddings.reshape(len(names), -1).float()
+
+        if self.matrix is not None and \
+                embeddings.shape[1] != self.matrix.shape[1]:
+            raise ValueError(f'Embedding width {embeddings.shape[1]} does not match gallery width {self.matrix.shape[1]}')  # noqa: E501
+
+        # normalize once at enrollment so search is just a dot product
+        embeddings = F.normalize(embeddings, p=2, dim=1)
+        embeddings, scales = self.quantize(embeddings)
+        embeddings = embeddings.to(self.device)
+
+        if self.matrix is None:
+            self.matrix = embeddings.contiguous()
+            self.scales = scales
+
+        else:
+            self.matrix = torch.cat((self.matrix, embeddings)).contiguous()
+
+            if scales is not None:
+                self.scales = torch.cat((self.scales, scales))
+
+        self.names += list(names)
+        self.update_mask()
+
+    # convert normalized embeddings to the gallery's dtype, returns the
+    # converted embeddings and the scales for int8 (None otherwise)
+    def quantize(self, embeddings: object) -> tuple:
+
+        if self.dtype == 'int8':
+            values, scales = EmbeddingFormat.quantize(embeddings)
+            return values, scales.to(self.device)
+
+        if self.dtype == 'float16':
+            return embeddings.half(), None
+
+        return embeddings, None
+
+    # point the gallery at an EmbeddingStore, the store's rows are already
+    # normalized (and quantized, if the store is), so on CPU the
+    # memory-mapped matrix is used without a copy. Once loaded, only the
+    # rows the store has changed since are updated.
+    def load_store(self, store: object):
+
+        changed = None
+
+        if self.generation == store.generation and self.names is store.names:
+            changed = sorted(set(store.changes[self.applied:]))
+
+        self.generation = store.generation
+        self.applied = len(store.changes)
+
+        self.names = store.names
+        self.dtype = store.dtype
+        self.matrix = None if store.matrix is None \
+            else store.matrix.to(self.device)
+        self.scales = None if store.scales is None \
+            else store.scales.to(self.device)
+        self.update_mask(changed, len(store))
+
+        if self.ann is not None:
+            self.sync_ann(store, changed)
+
+    # bring the ANN index up to date with the store: rows that are no longer
+    # active (removed or replaced identities) are removed from the index and
+    # new rows added. On the first sync the whole index is compared with the
+    # store, on row masks rather than in Python, after that only the changed
+    # rows are. The index reads the vectors from the store's memory-mapped
+    # matrix. It's saved (under the store's lock, every worker has its own
+    # copy of the index) once the unsaved changes reach 10% of its size, so
+    # a restart only has a bounded amount of catching up to do rather than
+    # rebuilding the index.
+    def sync_ann(self, store: object, changed: list = None):
+
+        if store.matrix is None:
+            return
+
+        self.ann.attach(store.matrix.numpy(), None if store.scales is None
+                        else store.scales.numpy())
+
+        if changed is None:
+            active = np.zeros(store.count, dtype=bool)
+            active[np.fromiter(store.rows.values(), dtype=np.int64,
+                               count=len(store.rows))] = True
+
+            indexed_rows = self.ann.rows()
+            indexed = np.zeros(store.count, dtype=bool)
+            indexed[indexed_rows[indexed_rows < store.count]] = True
+
+            # incl. rows past the end of the store, e.g., if it was recreated
+            stale = np.concatenate((
+                np.flatnonzero(indexed & ~active),
+                indexed_rows[indexed_rows >= store.count])).tolist()
+            new = np.flatnonzero(active & ~indexed)
+
+        else:
+            stale = [row for row in changed if store.names[row] is None]
+            new = [row for row in changed
+                   if store.names[row] is not None and row not in self.ann]
+
+        for row in stale:
+            self.ann.remove(row)
+
+        self.ann.add(new)
+
+        if self.ann.path and self.ann.unsaved and \
+                self.ann.unsaved >= len(self.ann) // 10:
+
+            with store.lock():
+                self.ann.save()
+
+    # mask of the active rows, None if they all are. Rebuilt from the names,
+    # or if the changed rows and the number of active rows are given, only
+    # those rows are updated (rows are only ever added at the end).
+    def update_mask(self, changed: list = None, size: int = None):
+
+        if changed is None:
+            self.size = len(self.names) - self.names.count(None)
+
+            if self.size < len(self.names):
+                self.active = torch.tensor([name is not None
+                                            for name in self.names],
+                                           device=self.device)
+
+            else:
+                self.active = None
+
+            return
+
+        self.size = size
+
+        if self.size == len(self.names):
+            self.active = None
+            return
+
+        # rows that weren't masked before are active unless they changed
+        known = 0 if self.active is None else len(self.active)
+        extra = torch.ones(len(self.names) - known, dtype=torch.bool,
+                           device=self.device)
+        self.active = extra if self.active is None \
+            else torch.cat((self.active, extra))
+
+        self.active[torch.tensor(changed, dtype=torch.long,
+                                 device=self.device)] = torch.tensor(
+            [self.names[row] is not None for row in changed],
+            device=self.device)
+
+    # score a probe embedding against the whole gallery, returns the top_k
+    # (identity, distance) pairs, closest first
+    def search(self, probe: object, top_k: int = 5,
+               score_type: str = 'cosine', nprobe: int = None) -> list:
+
+        return self.search_batch(probe.reshape(1, -1), top_k, score_type,
+                                 nprobe)[0]
+
+    # score a (N x D) block of probes against the whole gallery, returns a
+    # list of top_k matches for each probe. With a trained ANN index only
+    # nprobe of its lists are scanned (defaults to the index's nprobe).
+    def search_batch(self, probes: object, top_k: int = 5,
+                     score_type: str = 'cosine', nprobe: int = None) -> list:
+
+        if self.matrix is None or len(self) == 0:
+            return [[] for probe in probes]
+
+        if self.ann is not None and self.ann.trained:
+            results = self.ann.search(probes.detach().float().cpu().numpy(),
+                                      top_k, nprobe, score_type)
+
+            return [[(self.names[row], round(distance, 4))
+                     for row, distance in zip(rows, distances)]
+                    for rows, distances in results]
+
+        probes = SimilarityScore.normalize(probes).to(self.device)
+
+        distances, rows = SimilarityScore.top_k(
+            probes, self.matrix, min(top_k, len(self)), score_type,
+            normalized=True, mask=self.active, scales=self.scales)
+
+        return [[(self.names[row], round(distance, 4))
+                 for row, distance in zip(probe_rows, probe_distances)]
+                for probe_rows, probe_distances in zip(rows.tolist(),
+                                                       distances.tolist())]
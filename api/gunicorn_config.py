@@ -0,0 +1,76 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# gunicorn config for serving with models shared between workers: the app
+# (and with it the models) is loaded once in the master before the workers
+# are forked, the weights are moved to shared memory and the garbage
+# collector is frozen, so the workers don't end up with copy-on-write copies
+# of the weight pages. Each worker logs a memory report once it's up.
+# Usage: gunicorn -c gunicorn_config.py wsgi:app
+# Opt in only: it's deliberately not named gunicorn.conf.py, which gunicorn
+# loads from the working directory automatically, i.e., the Dockerfile's
+# ENTRYPOINT would pick it up without asking for it.
+# Note: CUDA can't be initialized before forking, set PRELOAD_MODELS=false
+# on GPU nodes.
+import gc
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:6000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+preload_app = os.environ.get('PRELOAD_MODELS', 'true').lower() == 'true'
+
+# with a preloaded app, warm up in each worker (see post_worker_init) rather
+# than in the master, the warm-up's threads wouldn't survive the fork
+if preload_app:
+    os.environ['WARM_UP_ON_IMPORT'] = 'false'
+
+
+# runs in the master after the app is loaded, before any workers are forked
+def when_ready(server):
+
+    if not preload_app:
+        return
+
+    # wsgi.py points at the server module that's being served
+    import wsgi
+
+    wsgi.myapp.photo_match.share_weights()
+
+    # move everything allocated so far into the permanent generation, so the
+    # garbage collector in the workers doesn't touch (and dirty) those pages
+    gc.freeze()
+
+    server.log.info('Model weights moved to shared memory, gc frozen')
+
+
+# split the CPU cores between the workers, otherwise every worker's PyTorch
+# thread pool tries to use all of them
+def post_fork(server, worker):
+
+    import torch
+
+    torch_threads = int(os.environ.get(
+        'TORCH_THREADS', max(1, (os.cpu_count() or 1) // workers)))
+    torch.set_num_threads(torch_threads)
+
+    # with a preloaded app the detection pool's processes are forked here,
+    # while this is the worker's only thread
+    if preload_app:
+        import wsgi
+
+        if wsgi.myapp.photo_match.detection_pool is not None:
+            wsgi.myapp.photo_match.detection_pool.start()
+
+
+def post_worker_init(worker):
+
+    from process_stats import ProcessStats
+
+    worker.log.info(f'Worker started, memory: {ProcessStats.memory_report()}')
+
+    # a no-op if the app was loaded in this worker, the warm-up was started
+    # on import then
+    import wsgi
+
+    if hasattr(wsgi.myapp, 'readiness'):
+        wsgi.myapp.readiness.start()
@@ -1,14 +1,128 @@
 # Logging script - writes all data to stdout so that it can be picked up
 # by container orchestration tools like Kubernetes
+# LOG_MODE=async moves formatting and writing off the request threads: the
+# logger only puts the record on a queue (QueueHandler) and a listener thread
+# formats and writes it (QueueListener). LOG_FORMAT=json writes one JSON
+# object per record, incl. the request's correlation ID and any extra fields.
+# LOG_SAMPLE_RATE keeps that share of the requests' INFO/DEBUG lines, the
+# decision is made once per request, so a request's lines are kept or
+# dropped together. Warnings and errors are always kept. LOG_LEVEL sets the
+# minimum level logged (default INFO), DEBUG adds the per step lines.
+import atexit
+import contextvars
+import json
 import logging
+import os
+import queue
+import random
+import uuid
+from logging.handlers import QueueHandler, QueueListener
 from sys import stdout
 
+LOG_MODE = os.environ.get('LOG_MODE', 'sync').lower()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# correlation ID and sampling decision of the request being handled, None
+# outside of a request
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+sampled = contextvars.ContextVar('sampled', default=True)
+
+# LogRecord attributes, anything else on a record came in via extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | \
+    {'message', 'asctime', 'correlation_id'}
+
+
+# start of a request: sets (or generates) its correlation ID and decides
+# whether its INFO/DEBUG lines are logged, returns the ID
+def begin_request(request_id: str = None) -> str:
+
+    request_id = request_id or uuid.uuid4().hex
+    correlation_id.set(request_id)
+    sampled.set(LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE)
+
+    return request_id
+
+
+# adds the correlation ID to every record and drops the INFO/DEBUG records
+# of requests that weren't sampled
+class RequestFilter(logging.Filter):
+
+    def filter(self, record: logging.LogRecord) -> bool:
+
+        record.correlation_id = correlation_id.get() or '-'
+
+        return record.levelno >= logging.WARNING or sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "file": record.filename,
+                 "message": record.getMessage(),
+                 "correlation_id": getattr(record, 'correlation_id', None)}
+
+        entry.update({key: value for key, value in vars(record).items()
+                      if key not in RECORD_ATTRIBUTES})
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+# QueueHandler formats the message on the calling thread, this one passes
+# the record as is, i.e., the message is only built by the listener thread.
+# Fine for an in-process queue, the args aren't pickled.
+class LazyQueueHandler(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+
+        return record
+
+
+def get_formatter() -> logging.Formatter:
+
+    if LOG_FORMAT == 'json':
+        return JsonFormatter()
+
+    return logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(correlation_id)s - %(message)s')  # noqa: E501
+
+
+# (re)start the listener thread, e.g., in a worker forked from a preloaded
+# gunicorn master, as the thread doesn't survive the fork
+def start_listener():
+
+    global listener
+
+    queue_handler.queue = queue.SimpleQueue()
+    listener = QueueListener(queue_handler.queue, handler)
+    listener.start()
+
+
 # set up/configure logging via stdout so it can be picked up by K8s
 logger = logging.getLogger('telemetry_logger')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 handler = logging.StreamHandler(stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(message)s')  # noqa: E501
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+handler.setLevel(LOG_LEVEL)
+handler.setFormatter(get_formatter())
+
+logger.addFilter(RequestFilter())
+
+if LOG_MODE == 'async':
+    queue_handler = LazyQueueHandler(queue.SimpleQueue())
+    logger.addHandler(queue_handler)
+
+    start_listener()
+    os.register_at_fork(after_in_child=start_listener)
+
+    # write out what's still queued on exit
+    atexit.register(lambda: listener.stop())
+
+else:
+    logger.addHandler(handler)
@@ -0,0 +1,194 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# In-process request metrics in the Prometheus text format: a latency
+# histogram per endpoint and request stage (parse, decode, detection,
+# embedding, scoring, serialization), request counters, in-flight gauges and
+# gauges for the queues in front of the models. Observations are a bisect
+# into fixed buckets plus a few additions under a lock, i.e., well under a
+# microsecond, so the hot path can be instrumented everywhere. Metrics are
+# per process: with several gunicorn workers each one has its own.
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# latency bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075,
+                   0.1, 0.15, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+
+        self.buckets = buckets
+
+        # per bucket counts (not cumulative), the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # cumulative bucket counts, sum and count, read as one consistent set
+    def snapshot(self) -> tuple:
+
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = []
+        running = 0
+
+        for value in counts:
+            running += value
+            cumulative.append(running)
+
+        return cumulative, total, count
+
+
+class Metrics:
+
+    PREFIX = 'facenet'
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+
+        self.buckets = buckets
+
+        # (endpoint, stage) -> Histogram, endpoint -> Histogram
+        self.stages = {}
+        self.requests = {}
+
+        # (endpoint, status) -> count, endpoint -> requests in progress
+        self.responses = {}
+        self.in_flight = {}
+
+        # name -> (help, function returning the current value)
+        self.gauges = {}
+
+        self.lock = threading.Lock()
+
+    # histograms are created on first use, under the lock
+    def histogram(self, histograms: dict, key: object) -> Histogram:
+
+        histogram = histograms.get(key)
+
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.setdefault(key,
+                                                  Histogram(self.buckets))
+
+        return histogram
+
+    def observe(self, endpoint: str, stage: str, seconds: float):
+
+        self.histogram(self.stages, (endpoint, stage)).observe(seconds)
+
+    # times the block as one stage of a request
+    @contextmanager
+    def stage(self, endpoint: str, stage: str):
+
+        start = perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.observe(endpoint, stage, perf_counter() - start)
+
+    def request_started(self, endpoint: str):
+
+        with self.lock:
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+
+    def request_finished(self, endpoint: str, status: int, seconds: float):
+
+        with self.lock:
+            self.in_flight[endpoint] -= 1
+            key = (endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+        self.histogram(self.requests, endpoint).observe(seconds)
+
+    # a gauge whose value is read when the metrics are scraped, e.g., the
+    # depth of a queue
+    def register_gauge(self, name: str, description: str,
+                       function: object):
+
+        self.gauges[name] = (description, function)
+
+    @staticmethod
+    def labels(**labels) -> str:
+
+        return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+    def render_histograms(self, name: str, description: str,
+                          histograms: dict, label_names: tuple) -> list:
+
+        lines = [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+
+        for key, histogram in sorted(histograms.items(), key=str):
+
+            key = key if isinstance(key, tuple) else (key,)
+            labels = self.labels(**dict(zip(label_names, key)))
+            cumulative, total, count = histogram.snapshot()
+
+            for bound, value in zip(self.buckets + ('+Inf',), cumulative):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {value}')  # noqa: E501
+
+            lines.append(f'{name}_sum{{{labels}}} {total}')
+            lines.append(f'{name}_count{{{labels}}} {count}')
+
+        return lines
+
+    # everything in the Prometheus text exposition format
+    def render(self) -> str:
+
+        prefix = self.PREFIX
+
+        lines = self.render_histograms(
+            f'{prefix}_stage_duration_seconds',
+            'Latency of each request stage',
+            dict(self.stages), ('endpoint', 'stage'))
+
+        lines += self.render_histograms(
+            f'{prefix}_request_duration_seconds',
+            'End to end request latency',
+            dict(self.requests), ('endpoint',))
+
+        with self.lock:
+            responses = dict(self.responses)
+            in_flight = dict(self.in_flight)
+
+        lines += [f'# HELP {prefix}_requests_total Requests handled',
+                  f'# TYPE {prefix}_requests_total counter']
+        lines += [f'{prefix}_requests_total{{{self.labels(endpoint=endpoint, status=status)}}} {count}'  # noqa: E501
+                  for (endpoint, status), count
+                  in sorted(responses.items(), key=str)]
+
+        lines += [f'# HELP {prefix}_requests_in_flight Requests in progress',
+                  f'# TYPE {prefix}_requests_in_flight gauge']
+        lines += [f'{prefix}_requests_in_flight{{{self.labels(endpoint=endpoint)}}} {count}'  # noqa: E501
+                  for endpoint, count
+                  in sorted(in_flight.items(), key=str)]
+
+        for name, (description, function) in sorted(self.gauges.items()):
+            lines += [f'# HELP {prefix}_{name} {description}',
+                      f'# TYPE {prefix}_{name} gauge',
+                      f'{prefix}_{name} {function()}']
+
+        lines += [f'# HELP {prefix}_process_id Process the metrics are from',
+                  f'# TYPE {prefix}_process_id gauge',
+                  f'{prefix}_process_id {os.getpid()}']
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,145 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Loading exported models (deployment_utilities/export_models.py) as an
+# alternative to the eager facenet_pytorch modules: frozen TorchScript
+# graphs, or ONNX Runtime sessions on CPU. A frozen graph has the batch norms
+# folded into the convolutions and doesn't need the pretrained weights to be
+# downloaded/loaded into a Python model at startup.
+import os
+import numpy as np
+import torch
+from logging_util import logger
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+# width of InceptionResnetV1's classifier layer for the VGGFace2 weights
+VGGFACE2_CLASSES = 8631
+
+# exported file names (minus the extension), the feature network is
+# InceptionResnetV1 without the classifier layer, which is exported on its
+# own as TorchScript for every backend
+EXPORT_NAMES = {'resnet': 'inception_resnet_v1',
+                'logits': 'logits_layer',
+                'pnet': 'mtcnn_pnet',
+                'rnet': 'mtcnn_rnet',
+                'onet': 'mtcnn_onet'}
+
+
+# ONNX Runtime session that can stand in for a torch module, i.e., takes and
+# returns tensors. A module (without parameters) so share_memory() etc. work.
+class OnnxModule(torch.nn.Module):
+
+    def __init__(self, model_path: str):
+
+        super().__init__()
+
+        # optional dependency, only needed for the ONNX backend
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: object) -> object:
+
+        outputs = self.session.run(
+            None, {self.input_name: np.ascontiguousarray(
+                x.detach().cpu().numpy(), dtype=np.float32)})
+
+        outputs = [torch.from_numpy(output).to(x.device)
+                   for output in outputs]
+
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class ModelBackends:
+
+    @staticmethod
+    def export_path(path: str, name: str, backend: str) -> str:
+
+        extension = '.onnx' if backend == 'onnx' else '.pt'
+
+        return os.path.join(path, f'{EXPORT_NAMES[name]}{extension}')
+
+    @classmethod
+    def load(cls, backend: str, path: str, name: str,
+             device: str = 'cpu') -> object:
+
+        model_path = cls.export_path(path, name, backend)
+
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f'{model_path} not found, run deployment_utilities/export_models.py first')  # noqa: E501
+
+        if backend == 'onnx':
+            return OnnxModule(model_path)
+
+        return torch.jit.load(model_path, map_location=device).eval()
+
+    # InceptionResnetV1 features network + the classifier layer
+    @classmethod
+    def load_resnet(cls, backend: str, path: str, device: str) -> tuple:
+
+        if backend == 'onnx' and device != 'cpu':
+            logger.warning('The ONNX backend runs on CPU, embeddings will be copied to the GPU')  # noqa: E501
+
+        resnet = cls.load(backend, path, 'resnet', device)
+        logits_layer = cls.load('torchscript', path, 'logits', device)
+
+        logger.info(f'InceptionResnetV1 loaded from {path}, backend: {backend}')  # noqa: E501
+
+        return resnet, logits_layer
+
+    # eager InceptionResnetV1 from a local copy of the VGGFace2 weights (see
+    # deployment_utilities/cache_model_weights.py), i.e., never downloads. The
+    # module is built on the meta device and the weights are assigned to it,
+    # so the random init they'd replace is skipped, and the file is memory
+    # mapped, i.e., shared between preloaded gunicorn workers.
+    @staticmethod
+    def load_pretrained_resnet(weights_path: str, device: str,
+                               classify: bool = True) -> object:
+
+        from facenet_pytorch import InceptionResnetV1
+
+        if not os.path.isfile(weights_path):
+            raise FileNotFoundError(f'{weights_path} not found, run deployment_utilities/cache_model_weights.py first')  # noqa: E501
+
+        with torch.device('meta'):
+            resnet = InceptionResnetV1(classify=True,
+                                       num_classes=VGGFACE2_CLASSES)
+
+        try:
+            state_dict = torch.load(weights_path, map_location=device,
+                                    weights_only=True, mmap=True)
+
+        # older checkpoints in the legacy (pre zip) format can't be memory
+        # mapped
+        except RuntimeError:
+            state_dict = torch.load(weights_path, map_location=device,
+                                    weights_only=True)
+
+        resnet.load_state_dict(state_dict, assign=True)
+
+        # the classifier layer stays loaded either way, same as with
+        # pretrained='vggface2', classify only sets whether it's applied
+        resnet.classify = classify
+
+        logger.info(f'InceptionResnetV1 loaded from {weights_path}')
+
+        return resnet.eval()
+
+    # swap MTCNN's P-Net/R-Net/O-Net for their exported versions, the rest of
+    # MTCNN (image pyramid, NMS, etc.) stays in Python
+    @classmethod
+    def load_mtcnn_nets(cls, backend: str, path: str, mtcnn: object,
+                        device: str):
+
+        for name in ('pnet', 'rnet', 'onet'):
+            setattr(mtcnn, name, cls.load(backend, path, name, device))
+
+        logger.info(f'MTCNN networks loaded from {path}, backend: {backend}')
@@ -0,0 +1,166 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Post-training int8 quantization of InceptionResnetV1 for serving on CPU.
+# Dynamic quantization only covers the linear layers, i.e., the final
+# projection and the 8631-wide classifier layer, static quantization also
+# covers the convolutions (most of the compute) but needs a calibration
+# pass over some face crops to pick the activation ranges. Either way the
+# classifier layer is dynamically quantized. The quantized embeddings are
+# compared to float32 on held-out faces: embedding drift and how often the
+# match status of a pair of faces changes.
+import copy
+import os
+import torch
+from PIL import Image
+from score_service import SimilarityScore
+from logging_util import logger
+
+MODES = ('none', 'dynamic', 'static')
+
+
+class ModelQuantization:
+
+    # max faces loaded from the calibration folder, and the batch size for
+    # the calibration pass
+    CALIBRATION_FACES = 64
+    BATCH_SIZE = 16
+
+    # pick the quantized kernels for the CPU, x86 (fbgemm + onednn) on
+    # Intel/AMD, qnnpack on ARM
+    @staticmethod
+    def select_engine() -> str:
+
+        supported = torch.backends.quantized.supported_engines
+
+        for engine in ('x86', 'fbgemm', 'qnnpack'):
+            if engine in supported:
+                torch.backends.quantized.engine = engine
+                return engine
+
+        raise RuntimeError('PyTorch has no quantized engine for this CPU')
+
+    # cropped faces from the photos in a folder, None if there aren't any
+    @classmethod
+    def load_faces(cls, mtcnn: object, path: str) -> object:
+
+        faces = []
+
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            filenames.sort()
+
+            for file in filenames:
+
+                if len(faces) == cls.CALIBRATION_FACES:
+                    break
+
+                try:
+                    with Image.open(os.path.join(dirpath, file)) as photo:
+                        with torch.inference_mode():
+                            face = mtcnn(photo.convert('RGB'))
+
+                except OSError:
+                    continue
+
+                if face is not None:
+                    faces.append(face)
+
+        return torch.stack(faces) if faces else None
+
+    @staticmethod
+    def quantize_dynamic(model: object) -> object:
+
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    # FX graph mode: observers are inserted, the calibration faces are run
+    # through the model to record activation ranges, then the modules are
+    # swapped for their int8 versions (conv + batch norm + relu fused)
+    @classmethod
+    def quantize_static(cls, model: object, faces: object) -> object:
+
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        engine = cls.select_engine()
+
+        prepared = prepare_fx(copy.deepcopy(model).eval(),
+                              get_default_qconfig_mapping(engine),
+                              (faces[:1],))
+
+        with torch.no_grad():
+            for i in range(0, len(faces), cls.BATCH_SIZE):
+                prepared(faces[i:i + cls.BATCH_SIZE])
+
+        return convert_fx(prepared)
+
+    # quantize the feature network and classifier layer, returns them plus
+    # the drift/agreement report. For static quantization every other
+    # calibration face is held out for the report.
+    @classmethod
+    def quantize(cls, mode: str, resnet: object, logits_layer: object,
+                 mtcnn: object, calibration_path: str,
+                 threshold: float = 0.35) -> tuple:
+
+        cls.select_engine()
+
+        faces = cls.load_faces(mtcnn, calibration_path)
+
+        if mode == 'static':
+
+            if faces is None or len(faces) < 2:
+                raise ValueError(f'Static quantization needs photos with faces in {calibration_path} for calibration')  # noqa: E501
+
+            quantized = cls.quantize_static(resnet, faces[::2])
+            held_out = faces[1::2]
+
+        else:
+            quantized = cls.quantize_dynamic(resnet)
+            held_out = faces
+
+        quantized_logits = cls.quantize_dynamic(logits_layer)
+
+        report = {}
+
+        if held_out is not None:
+            report = cls.report(resnet, logits_layer, quantized,
+                                quantized_logits, held_out, threshold)
+
+        logger.info(f'InceptionResnetV1 {mode} int8 quantization: {report}')
+
+        return quantized, quantized_logits, report
+
+    # drift of the quantized embeddings/logits vs float32 (1 - cosine
+    # similarity) and the share of face pairs whose match status is the same
+    @staticmethod
+    def report(resnet: object, logits_layer: object, quantized: object,
+               quantized_logits: object, faces: object,
+               threshold: float) -> dict:
+
+        with torch.inference_mode():
+            features = resnet(faces)
+            quantized_features = quantized(faces)
+
+            outputs = {'embedding': (features, quantized_features),
+                       'logits': (logits_layer(features),
+                                  quantized_logits(quantized_features))}
+
+        report = {"faces": len(faces)}
+
+        for space, (expected, actual) in outputs.items():
+            drift = 1 - torch.nn.functional.cosine_similarity(expected,
+                                                              actual)
+
+            expected_status = SimilarityScore.match_mask(
+                SimilarityScore.distance_matrix(expected, expected),
+                threshold)
+            actual_status = SimilarityScore.match_mask(
+                SimilarityScore.distance_matrix(actual, actual), threshold)
+
+            report[space] = {
+                "mean_drift": round(drift.mean().item(), 6),
+                "max_drift": round(drift.max().item(), 6),
+                "match_agreement": round((expected_status == actual_status).
+                                         float().mean().item(), 4)}
+
+        return report
@@ -0,0 +1,321 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Non-blocking publisher for the monitoring messages: request threads only
+# put an event on a bounded queue (or count it as dropped if the queue is
+# full), a background thread aggregates the events into one message per
+# flush interval (request and match counts, latency summary, optionally the
+# events themselves) and publishes it with the configured QoS. Messages that
+# can't be published while the broker is unreachable are spooled to a file
+# on disk and re-sent, oldest first, once it's back. The spool can be shared
+# by several processes, e.g., gunicorn workers, it's only touched under an
+# fcntl lock, and messages being re-sent are moved to a .sending file that's
+# only deleted once they've all been acknowledged, i.e., a crash mid-resend
+# doesn't lose them. The MQTT client is passed in, anything with paho's
+# publish()/is_connected() works, e.g., a stand-in broker for testing.
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from logging_util import logger
+
+
+class MonitoringPublisher:
+
+    def __init__(self, client: object, topic: str, qos: int = 1,
+                 flush_interval: float = 1.0, max_queue: int = 10000,
+                 spool_path: str = None, max_spool_mb: float = 64,
+                 include_events: bool = False, publish_timeout: float = 5.0):
+
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spool_path = spool_path
+        self.max_spool_bytes = int(max_spool_mb * 1024 * 1024)
+        self.include_events = include_events
+        self.publish_timeout = publish_timeout
+
+        # the thread is started on first use, as threads don't survive a
+        # fork, e.g., when gunicorn preloads the app
+        self.events = None
+        self.worker = None
+        self.pid = None
+        self.stopping = threading.Event()
+        self.start_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+
+        # dropped: events that didn't fit in the queue, spool_dropped:
+        # messages lost because the spool file was full
+        self.counters = {"events": 0,
+                         "dropped": 0,
+                         "published": 0,
+                         "publish_failures": 0,
+                         "spooled": 0,
+                         "spool_dropped": 0}
+
+        logger.info(f'Monitoring publisher configured, topic: {topic}, QoS: {qos}, flush interval: {flush_interval} s')  # noqa: E501
+
+    # queue an event, e.g., the response for a request plus its latency,
+    # never blocks
+    def report(self, event: dict):
+
+        self.start_worker()
+
+        try:
+            self.events.put_nowait((time.time(), event))
+            counter = 'events'
+
+        except queue.Full:
+            counter = 'dropped'
+
+        with self.counter_lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+
+        stats = dict(self.counters)
+        stats['queued'] = self.events.qsize() if self.events else 0
+
+        return stats
+
+    def start_worker(self):
+
+        if self.pid == os.getpid():
+            return
+
+        with self.start_lock:
+
+            if self.pid == os.getpid():
+                return
+
+            self.events = queue.Queue(self.max_queue)
+            self.stopping.clear()
+
+            self.worker = threading.Thread(target=self.run, daemon=True,
+                                           name='monitoring_publisher')
+            self.worker.start()
+            self.pid = os.getpid()
+
+            # publish/spool what's left when the process exits
+            atexit.register(self.close)
+
+    # publish what's queued and stop the thread
+    def close(self):
+
+        if self.pid != os.getpid():
+            return
+
+        self.stopping.set()
+        self.worker.join()
+        self.pid = None
+
+    def run(self):
+
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
+
+    # one aggregated message for everything queued since the last flush,
+    # after any spooled messages so they're received in order
+    def flush(self):
+
+        batch = self.drain()
+
+        if self.resend_spool() and batch:
+            self.publish(self.aggregate(batch))
+
+        elif batch:
+            self.spool([self.aggregate(batch)])
+
+    def drain(self) -> list:
+
+        batch = []
+
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+
+            except queue.Empty:
+                return batch
+
+    def aggregate(self, batch: list) -> str:
+
+        latencies = sorted(event['latency_ms'] for timestamp, event in batch
+                           if event.get('latency_ms') is not None)
+
+        matches = sum(1 for timestamp, event in batch
+                      if event.get('match_status') == 1)
+
+        message = {"window_start": batch[0][0],
+                   "window_end": batch[-1][0],
+                   "requests": len(batch),
+                   "matches": matches,
+                   "non_matches": sum(1 for timestamp, event in batch
+                                      if event.get('match_status') == 0),
+                   "latency_ms": self.summarize(latencies),
+                   "dropped": self.counters['dropped'],
+                   "spool_dropped": self.counters['spool_dropped']}
+
+        if self.include_events:
+            message['events'] = [event for timestamp, event in batch]
+
+        return json.dumps(message)
+
+    @staticmethod
+    def summarize(latencies: list) -> dict:
+
+        if not latencies:
+            return {"count": 0}
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1,
+                                 int(p * len(latencies)))]
+
+        return {"count": len(latencies),
+                "mean": round(sum(latencies) / len(latencies), 2),
+                "min": latencies[0],
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": latencies[-1]}
+
+    # True once the broker has acknowledged the message (per its QoS),
+    # otherwise the message is spooled
+    def publish(self, message: str) -> bool:
+
+        if self.send(message):
+            return True
+
+        self.spool([message])
+
+        return False
+
+    # A message that times out counts as failed, paho may still deliver it
+    # as well, i.e., at least once delivery.
+    def send(self, message: str) -> bool:
+
+        if not self.client.is_connected():
+            return False
+
+        try:
+            info = self.client.publish(self.topic, message, self.qos)
+
+            if self.qos > 0:
+                info.wait_for_publish(self.publish_timeout)
+
+            # QoS 0 messages are never acknowledged
+            if info.rc == 0 and (self.qos == 0 or info.is_published()):
+                self.counters['published'] += 1
+                return True
+
+        except Exception as e:
+            logger.error(f'MQTT publishing failed with error: {e}')
+
+        self.counters['publish_failures'] += 1
+
+        return False
+
+    # exclusive lock on the spool across processes
+    @contextmanager
+    def spool_lock(self):
+
+        with open(f'{self.spool_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                yield
+
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # append messages to the spool file, up to max_spool_mb
+    def spool(self, messages: list):
+
+        if self.spool_path is None:
+            self.counters['spool_dropped'] += len(messages)
+            return
+
+        with self.spool_lock():
+
+            size = os.path.getsize(self.spool_path) \
+                if os.path.exists(self.spool_path) else 0
+
+            with open(self.spool_path, 'a') as file:
+                for message in messages:
+
+                    if size + len(message) + 1 > self.max_spool_bytes:
+                        self.counters['spool_dropped'] += 1
+                        continue
+
+                    file.write(message + '\n')
+                    size += len(message) + 1
+                    self.counters['spooled'] += 1
+
+    # re-send the spooled messages, oldest first, returns False if the
+    # broker is still unreachable. The spool is moved to a .sending file
+    # first, which is only deleted once everything in it has been sent, a
+    # .sending file left by an earlier attempt (or a crash) goes first.
+    def resend_spool(self) -> bool:
+
+        if self.spool_path is None:
+            return self.client.is_connected()
+
+        sending_path = f'{self.spool_path}.sending'
+
+        if not (os.path.exists(self.spool_path) or
+                os.path.exists(sending_path)):
+            return self.client.is_connected()
+
+        if not self.client.is_connected():
+            return False
+
+        resent = 0
+
+        with self.spool_lock():
+
+            while True:
+
+                if not os.path.exists(sending_path):
+
+                    if not os.path.exists(self.spool_path):
+                        break
+
+                    os.replace(self.spool_path, sending_path)
+
+                with open(sending_path) as file:
+                    messages = [line.rstrip('\n') for line in file
+                                if line.strip()]
+
+                for index, message in enumerate(messages):
+
+                    # keep what wasn't sent for the next attempt
+                    if not self.send(message):
+                        self.rewrite(sending_path, messages[index:])
+                        return False
+
+                os.remove(sending_path)
+                resent += len(messages)
+
+        if resent:
+            logger.info(f'{resent} spooled monitoring messages re-sent')
+
+        return True
+
+    # replace a file's contents with the given messages, via a temp file so
+    # a crash leaves either the old or the new contents
+    @staticmethod
+    def rewrite(path: str, messages: list):
+
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.writelines(message + '\n' for message in messages)
+
+        os.replace(temp_path, path)
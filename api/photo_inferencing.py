@@ -1,9 +1,16 @@
 # (C) Markham 2022 - 2024
 # Facial-Recognition-Facenet-Pytorch
 # Flask based API wrapper around the Facenet-PyTorch facial recognition library
+import os
 import torch
+import torch.nn.functional as F
 import warnings
+from PIL import Image
+from time import perf_counter
 from facenet_pytorch import MTCNN, InceptionResnetV1
+from detection_pool import DetectionPool
+from model_backends import BACKENDS, ModelBackends
+from model_quantization import MODES, ModelQuantization
 from logging_util import logger
 
 warnings.filterwarnings('ignore')
@@ -17,8 +24,45 @@ class Inferencing:
         # check device type, set appropriate cuda options
         self.cuda_check()
 
-        # load models
+        # default output space: 'embedding' for the 512-d facial embeddings
+        # or 'logits' for the 8631-wide VGGFace2 classifier output, the
+        # latter is what older cached references and score thresholds were
+        # generated with.
+        self.head = os.environ.get('EMBEDDING_HEAD', 'logits').lower()
+        self.logits = self.head == 'logits'
+
+        logger.info('Default embedding head: %s', self.head)
+
+        # eager facenet_pytorch modules, or the TorchScript/ONNX exports in
+        # MODEL_EXPORT_PATH, see deployment_utilities/export_models.py
+        self.backend = os.environ.get('INFERENCE_BACKEND', 'eager').lower()
+
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown inference backend {self.backend}, expected one of {BACKENDS}')  # noqa: E501
+
+        # int8 quantization of the embedding network when serving on CPU:
+        # 'none', 'dynamic' or 'static' (calibrated on the photos in
+        # QUANTIZATION_CALIBRATION_PATH)
+        self.quantization = os.environ.get('CPU_QUANTIZATION', 'none').lower()
+
+        if self.quantization not in MODES:
+            raise ValueError(f'Unknown quantization mode {self.quantization}, expected one of {MODES}')  # noqa: E501
+
+        # load models, the load time is reported on /ready
+        start = perf_counter()
         self.mtcnn, self.resnet = self.get_models()
+        self.load_time = perf_counter() - start
+
+        logger.info('Models loaded in %.1f ms', 1000 * self.load_time)
+
+        # optionally run single face detection in a pool of processes
+        detection_workers = int(os.environ.get('DETECTION_WORKERS', 0))
+        self.detection_pool = DetectionPool(detection_workers) \
+            if detection_workers > 0 else None
+
+        # detector that keeps every face in the photo rather than just the
+        # largest one, shares the P-Net/R-Net/O-Net weights with self.mtcnn
+        self.mtcnn_all = self.get_group_detector()
 
     def cuda_check(self):
 
@@ -33,7 +77,7 @@ class Inferencing:
         else:
             self.device = 'cpu'
 
-        logger.info(f'Running on device: {self.device}')
+        logger.info('Running on device: %s', self.device)
 
     def get_models(self):
 
@@ -41,39 +85,258 @@ class Inferencing:
                       0.709, True, True, None,
                       False, device=self.device).eval()
 
-        # Instantiate Resnet for Facial Geometry (Embeddings)
-        resnet = InceptionResnetV1(pretrained='vggface2',
-                                   classify=True).eval().to(self.device)
+        if self.backend != 'eager':
+
+            # the exported models are used as they were exported
+            if self.quantization != 'none':
+                logger.warning('CPU_QUANTIZATION=%s only applies to the eager backend, running the %s models as exported', self.quantization, self.backend)  # noqa: E501
+
+            return mtcnn, self.get_exported_models(mtcnn)
+
+        # Instantiate Resnet for Facial Geometry (Embeddings), from a local
+        # copy of the weights if MODEL_WEIGHTS_PATH is set, otherwise
+        # facenet_pytorch downloads them on first use
+        weights_path = os.environ.get('MODEL_WEIGHTS_PATH')
+
+        if weights_path:
+            resnet = ModelBackends.load_pretrained_resnet(weights_path,
+                                                          self.device)
+
+        else:
+            resnet = InceptionResnetV1(pretrained='vggface2',
+                                       classify=True).eval().to(self.device)
+
+        # split off the classifier layer, i.e., the network stops at the
+        # (un-normalized) 512-d features and the logits are only calculated
+        # for the requests that need them.
+        self.logits_layer = resnet.logits
+        self.logits_width = self.logits_layer.out_features
+        resnet.logits = torch.nn.Identity()
+
+        if self.quantization != 'none':
+            resnet = self.quantize_models(mtcnn, resnet)
 
         return mtcnn, resnet
 
+    # swap in int8 versions of the feature network and classifier layer, the
+    # drift/agreement report vs float32 is logged
+    def quantize_models(self, mtcnn: object, resnet: object) -> object:
+
+        if self.device != 'cpu':
+            logger.warning('int8 quantization is for CPU serving, running float32 on the GPU')  # noqa: E501
+            return resnet
+
+        resnet, self.logits_layer, self.quantization_report = \
+            ModelQuantization.quantize(
+                self.quantization, resnet, self.logits_layer, mtcnn,
+                os.environ.get('QUANTIZATION_CALIBRATION_PATH', 'images'))
+
+        return resnet
+
+    # the exported models have the classifier layer split off already
+    def get_exported_models(self, mtcnn: object) -> object:
+
+        export_path = os.environ.get('MODEL_EXPORT_PATH', 'exported_models')
+
+        ModelBackends.load_mtcnn_nets(self.backend, export_path, mtcnn,
+                                      self.device)
+        resnet, self.logits_layer = ModelBackends.load_resnet(
+            self.backend, export_path, self.device)
+        self.logits_width = self.logits_layer.weight.shape[0]
+
+        return resnet
+
+    def get_group_detector(self):
+
+        mtcnn_all = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                          0.709, True, True, None,
+                          True, device=self.device).eval()
+
+        mtcnn_all.pnet = self.mtcnn.pnet
+        mtcnn_all.rnet = self.mtcnn.rnet
+        mtcnn_all.onet = self.mtcnn.onet
+
+        return mtcnn_all
+
+    # move the weights into shared memory, so processes forked after this
+    # point (e.g., preloaded gunicorn workers) map the same pages rather than
+    # getting copy-on-write copies. CPU only, CUDA tensors can't be shared
+    # with forked processes.
+    def share_weights(self):
+
+        if self.device != 'cpu':
+            logger.warning('Weights are on the GPU, not moving them to shared memory')  # noqa: E501
+            return
+
+        for model in (self.mtcnn, self.resnet, self.logits_layer):
+            model.share_memory()
+
+        logger.info('Model weights moved to shared memory')
+
+    # run synthetic inputs through every model once per batch size, so the
+    # first real requests don't pay for lazy initialization: allocator
+    # pools, thread pools, cuDNN autotuning, TorchScript/ONNX graph
+    # optimization, the detection pool's processes, etc. Noise photos rarely
+    # contain faces, so R-Net/O-Net are also run directly on random crops.
+    def warm_up(self, batch_sizes: list, size: tuple = (640, 480)):
+
+        pixels = torch.randint(0, 256, (size[1], size[0], 3),
+                               dtype=torch.uint8)
+        photo = Image.fromarray(pixels.numpy())
+
+        with torch.inference_mode():
+
+            for batch_size in batch_sizes:
+
+                # detection errors are returned per photo, the warm-up
+                # fails on the first one
+                for face in self.detect_face_batch([photo] * batch_size):
+                    if isinstance(face, Exception):
+                        raise face
+
+                self.mtcnn.rnet(torch.rand(batch_size, 3, 24, 24,
+                                           device=self.device))
+                self.mtcnn.onet(torch.rand(batch_size, 3, 48, 48,
+                                           device=self.device))
+
+                # cropped faces are standardized, i.e., roughly [-1, 1]
+                faces = 2 * torch.rand(batch_size, 3, 160, 160) - 1
+                features = self.features(faces)
+                self.project(features, True)
+                self.project(features, False)
+
+            self.detect_faces(photo)
+
+        if self.device != 'cpu':
+            torch.cuda.synchronize()
+
+    # whether a reference of a given width is in logit space, e.g., a cached
+    # tensor generated before the switch to 512-d embeddings
+    def logit_space(self, width: int) -> bool:
+
+        return width == self.logits_width
+
+    # detect the face in a photo, returns a cropped (3 x 160 x 160) tensor
+    def detect_face(self, photo: object) -> object:
+
+        if self.detection_pool is not None:
+            return self.detection_pool.detect_face(photo)
+
+        with torch.inference_mode():
+            return self.mtcnn(photo)
+
+    # detect the face in each of a list of photos, MTCNN can only batch
+    # photos of the same size, so photos are grouped by size and each group
+    # is run as one batch. If a batch fails, e.g., a grayscale and an RGB
+    # photo of the same size can't be stacked, its photos are retried one at
+    # a time, so one bad photo doesn't fail the others. Returns a cropped
+    # face, None if no face was found or the exception if detection failed,
+    # per photo, in the same order as the photos.
+    def detect_face_batch(self, photos: list) -> list:
+
+        # with a process pool the photos are spread across the processes
+        # instead
+        if self.detection_pool is not None:
+            return self.detection_pool.detect_face_batch(photos)
+
+        groups = {}
+
+        for index, photo in enumerate(photos):
+            size = tuple(photo.shape) if isinstance(photo, torch.Tensor) \
+                else photo.size
+            groups.setdefault(size, []).append(index)
+
+        faces = [None] * len(photos)
+
+        with torch.inference_mode():
+
+            for indices in groups.values():
+
+                try:
+                    crops = self.mtcnn([photos[index] for index in indices])
+
+                except Exception:
+                    crops = [self.detect_single(photos[index])
+                             for index in indices]
+
+                for index, crop in zip(indices, crops):
+                    faces[index] = crop
+
+        return faces
+
+    def detect_single(self, photo: object) -> object:
+
+        try:
+            return self.mtcnn(photo)
+
+        except Exception as error:
+            return error
+
+    # detect every face in a photo, returns a (N x 3 x 160 x 160) tensor of
+    # cropped faces plus the bounding boxes and detection probabilities,
+    # faces is None if there aren't any faces in the photo
+    def detect_faces(self, photo: object) -> tuple:
+
+        with torch.inference_mode():
+            boxes, probs = self.mtcnn_all.detect(photo)
+
+            if boxes is None:
+                return None, [], []
+
+            faces = self.mtcnn_all.extract(photo, boxes, None)
+
+        return faces, boxes.tolist(), probs.tolist()
+
+    # 512-d features for a (N x 3 x 160 x 160) batch of cropped faces
+    def features(self, faces: object) -> object:
+
+        with torch.inference_mode():
+            return self.resnet(faces.to(self.device))
+
+    # features -> L2 normalized embeddings or classifier logits
+    def project(self, features: object, logits: bool = None) -> object:
+
+        if logits is None:
+            logits = self.logits
+
+        with torch.inference_mode():
+
+            if logits:
+                return self.logits_layer(features)
+
+            return F.normalize(features, p=2, dim=1)
+
+    # generate embeddings for a (N x 3 x 160 x 160) batch of cropped faces
+    def embed_faces(self, faces: object, logits: bool = None) -> object:
+
+        return self.project(self.features(faces), logits)
+
     def identity_verify(self, reference: object, sample: object) -> object:
-        self.reference = reference
-        self.sample = sample
 
         # detect faces, generate cropped photos
         # need to update to generate a cropped photo for each face
-        reference_cropped = self.mtcnn(self.reference).to(self.device)
-        sample_cropped = self.mtcnn(self.sample).to(self.device)
+        faces = torch.stack((self.detect_face(reference),
+                             self.detect_face(sample)))
 
-        embeddings_reference = self.resnet(reference_cropped.unsqueeze(0))
-        embeddings_sample = self.resnet(sample_cropped.unsqueeze(0))
+        # both faces go through the network in a single forward pass
+        embeddings = self.embed_faces(faces)
 
-        logger.info('Embeddings generated for photo pair')
+        logger.debug('Embeddings generated for photo pair')
 
-        return embeddings_reference, embeddings_sample
+        return embeddings[0:1], embeddings[1:2]
 
-    def cached_reference(self, sample: object) -> object:
+    def cached_reference(self, sample: object, logits: bool = None) -> object:
 
-        self.sample = sample
+        # detect the face in the image, None if there isn't one
+        sample_cropped = self.detect_face(sample)
 
-        # detect the face in the image
-        sample_cropped = self.mtcnn(self.sample).to(self.device)
+        if sample_cropped is None:
+            return None
 
         # generate embeddings
-        embeddings_sample = self.resnet(sample_cropped.unsqueeze(0)).\
-            detach()
+        embeddings_sample = self.embed_faces(sample_cropped.unsqueeze(0),
+                                             logits)
 
-        logger.info('Embeddings generated for single photo/cached tensor workflow')  # noqa: E501
+        logger.debug('Embeddings generated for single photo/cached tensor workflow')  # noqa: E501
 
         return embeddings_sample
@@ -0,0 +1,42 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Per process memory stats, used to confirm that the model weights loaded by
+# the gunicorn master are actually shared with the workers rather than being
+# copied into each one.
+import os
+import resource
+
+# fields from /proc/<pid>/smaps_rollup, values are in kB
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty',
+                'Private_Clean', 'Private_Dirty')
+
+
+class ProcessStats:
+
+    # memory report for the current process: Rss is everything mapped into
+    # the process, Pss splits shared pages between the processes sharing
+    # them and Private_Dirty is memory that only this process is using,
+    # i.e., with shared weights a worker's Private_Dirty should be a small
+    # fraction of its Rss.
+    @staticmethod
+    def memory_report() -> dict:
+
+        report = {"pid": os.getpid()}
+
+        try:
+            with open('/proc/self/smaps_rollup') as file:
+
+                for line in file:
+                    field, value = line.split(':', 1)
+
+                    if field in SMAPS_FIELDS:
+                        report[f'{field}(MB)'] = \
+                            round(int(value.split()[0]) / 1024, 1)
+
+        # not on Linux, fall back to peak RSS
+        except OSError:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report['Peak_Rss(MB)'] = round(peak / 1024, 1)
+
+        return report
@@ -0,0 +1,83 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Readiness gating: synthetic batches are run through the models on a
+# background thread at startup, the "/ready" endpoint only reports ready
+# once that's done, i.e., load balancers/Kubernetes only route traffic to a
+# worker once it serves at steady state latency, while "/ping" (liveness)
+# answers right away. The thread doesn't survive a fork, so with preloaded
+# gunicorn workers the warm-up is started in each worker instead, see
+# gunicorn_config.py.
+import os
+import threading
+import torch
+from time import perf_counter
+from logging_util import logger
+
+
+class Readiness:
+
+    def __init__(self, engine: object, batch_sizes: list,
+                 scheduler: object = None):
+
+        # the Inferencing instance, plus the BatchScheduler when embedding
+        # batching is on
+        self.engine = engine
+        self.scheduler = scheduler
+        self.batch_sizes = batch_sizes
+
+        self.ready = False
+        self.error = None
+        self.warm_up_time = None
+        self.pid = None
+
+        self.start_lock = threading.Lock()
+
+    # start the warm-up in this process, unless it's already been started
+    def start(self):
+
+        with self.start_lock:
+
+            if self.pid == os.getpid():
+                return
+
+            self.ready = False
+            self.error = None
+            self.pid = os.getpid()
+
+            threading.Thread(target=self.run, daemon=True,
+                             name='warm_up').start()
+
+    def run(self):
+
+        start = perf_counter()
+
+        try:
+            self.engine.warm_up(self.batch_sizes)
+
+            # starts the batching thread and runs one batch through it
+            if self.scheduler is not None:
+                self.scheduler.embed_faces(torch.zeros(1, 3, 160, 160))
+
+        except Exception as e:
+            self.error = str(e)
+            logger.error('Warm-up failed with error: %s', e)
+            return
+
+        self.warm_up_time = perf_counter() - start
+        self.ready = True
+
+        logger.info('Warm-up complete in %.1f ms, batch sizes: %s, ready for traffic', 1000 * self.warm_up_time, self.batch_sizes)  # noqa: E501
+
+    def report(self) -> dict:
+
+        report = {"ready": self.ready,
+                  "model_load(ms)": round(1000 * self.engine.load_time, 2),
+                  "warm_up(ms)": round(1000 * self.warm_up_time, 2)
+                  if self.warm_up_time is not None else None,
+                  "warm_up_batch_sizes": self.batch_sizes}
+
+        if self.error:
+            report["error"] = self.error
+
+        return report
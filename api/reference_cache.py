@@ -0,0 +1,152 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# LRU cache for the reference tensors uploaded to /cached_data, keyed by a
+# hash of the upload or a client supplied reference ID. Repeat uploads of the
+# same reference skip parsing/unpickling it and once a reference is
+# cached, clients can send just its ID instead of uploading it again. With a
+# float16 or int8 dtype the entries are held in the compact .femb encoding
+# and decoded on each hit, i.e., 2x/4x as many references fit in the cache.
+import hashlib
+import threading
+from collections import OrderedDict
+from embedding_format import EmbeddingFormat
+from logging_util import logger
+
+
+class ReferenceCache:
+
+    def __init__(self, max_bytes: int, dtype: str = 'float32'):
+
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.size = 0
+
+        # content hash -> tensor, least recently used first
+        self.entries = OrderedDict()
+
+        # client reference IDs -> content hash, and the reverse so aliases
+        # can be dropped when an entry is evicted
+        self.aliases = {}
+        self.alias_keys = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tensor_bytes(entry: object) -> int:
+
+        if isinstance(entry, bytes):
+            return len(entry)
+
+        return entry.element_size() * entry.nelement()
+
+    # float32 entries are cached as is, anything else is encoded
+    def compact(self, tensor: object) -> object:
+
+        if self.dtype == 'float32':
+            return tensor
+
+        return EmbeddingFormat.encode(tensor, self.dtype)
+
+    @staticmethod
+    def expand(entry: object) -> object:
+
+        if isinstance(entry, bytes):
+            return EmbeddingFormat.decode(entry)
+
+        return entry
+
+    # look up a reference by content hash or reference ID, None on a miss
+    def get(self, key: str) -> object:
+
+        with self.lock:
+            key = self.aliases.get(key, key)
+
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            entry = self.entries[key]
+
+        return self.expand(entry)
+
+    # add a reference, returns it the way it's cached, i.e., decoded from
+    # its compact form for a float16/int8 cache
+    def put(self, key: str, tensor: object,
+            reference_id: str = None) -> object:
+
+        with self.lock:
+
+            if key not in self.entries:
+                self.entries[key] = self.compact(tensor)
+                self.size += self.tensor_bytes(self.entries[key])
+
+            self.entries.move_to_end(key)
+
+            if reference_id:
+                previous = self.aliases.get(reference_id)
+
+                # the ID is re-pointed at new content, so evicting the old
+                # entry mustn't drop it
+                if previous is not None and previous != key:
+                    self.alias_keys.get(previous, set()).discard(reference_id)
+
+                self.aliases[reference_id] = key
+                self.alias_keys.setdefault(key, set()).add(reference_id)
+
+            # evict least recently used entries until we're under the limit,
+            # always keeping the entry that was just added
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= self.tensor_bytes(evicted)
+                self.evictions += 1
+
+                for alias in self.alias_keys.pop(evicted_key, ()):
+                    if self.aliases.get(alias) == evicted_key:
+                        del self.aliases[alias]
+
+            entry = self.entries[key]
+
+        return self.expand(entry)
+
+    # load an uploaded reference tensor, via the cache if the same content
+    # was uploaded before. Returns the ID to use for the reference from now
+    # on (the client's reference ID or the content hash) and the tensor.
+    def load(self, upload: object, reference_id: str = None) -> tuple:
+
+        data = upload.read()
+        key = hashlib.sha256(data).hexdigest()
+
+        tensor = self.get(key)
+
+        if tensor is None:
+            tensor = EmbeddingFormat.from_bytes(data)
+            logger.info('Reference %s added to the cache', key[:12])
+
+        # return what's cached, so a quantized cache scores the same on
+        # the first upload as on later hits
+        tensor = self.put(key, tensor, reference_id)
+
+        return reference_id or key, tensor
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {"entries": len(self.entries),
+                    "dtype": self.dtype,
+                    "size_bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": round(self.hits / lookups, 4)
+                    if lookups else 0.0}
@@ -0,0 +1,146 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Request/response helpers shared by the Flask (server.py) and asyncio
+# (async_server.py) servers: loading uploaded photos and building the JSON
+# response for photo pair/cached tensor matches.
+import json
+import os
+import torch
+from PIL import Image
+from embedding_format import EmbeddingFormat
+from logging_util import logger
+
+# JPEGs larger than this (longest side, in pixels) are decoded at reduced
+# size, MTCNN scales photos down for its image pyramid anyway
+MAX_DECODE_SIDE = int(os.environ.get('MAX_DECODE_SIDE', 1280))
+
+# largest side (in pixels) accepted for raw uploads
+MAX_RAW_SIDE = int(os.environ.get('MAX_RAW_SIDE', 8192))
+
+
+# an upload that doesn't match what the client said it is, i.e., a client
+# error (400) rather than a server error
+class UploadError(ValueError):
+
+    pass
+
+
+class ResponseBuilder:
+
+    def __init__(self, scoring: object):
+
+        # SimilarityScore instance
+        self.scoring = scoring
+
+    # method that aggregates data, prepares json response and sends the data
+    # back to the client
+    # TODO: add field for the endpoint the data was received on.
+    def build_response(self, latency: float, tensor1: object,
+                       tensor2: object, score_type: str,
+                       threshold: float, reference_id: str = None) -> str:
+
+        return json.dumps(self.build_results(latency, tensor1, tensor2,
+                                             score_type, threshold,
+                                             reference_id))
+
+    # scores the pair and builds the response payload, i.e., everything but
+    # the serialization, so the two can be timed separately
+    def build_results(self, latency: float, tensor1: object,
+                      tensor2: object, score_type: str,
+                      threshold: float, reference_id: str = None) -> dict:
+
+        # generate score, cosine distance unless euclidean is specified
+        score = self.scoring.score(tensor1, tensor2, score_type)
+        logger.debug('similarity score calculated')
+
+        # get match status
+        status = self.scoring.match_status(score, threshold)
+
+        # round match score
+        score = round(score, 3)
+
+        logger.info('match status calculated: %s from a score of: %s', status, score)  # noqa: E501
+
+        # prepare latency message: rounding + adding units
+        latency_message = latency
+
+        # return data
+        results = {"match_status": status,
+                   "score": score,
+                   "score_type": score_type,
+                   "score_threshold": threshold,
+                   "inferencing_latency(ms)": latency_message}
+
+        # ID the client can use to refer to a cached reference
+        if reference_id:
+            results["reference_id"] = reference_id
+
+        return results
+
+    # loading images
+    # TODO: may need to add transformations in the future
+    @staticmethod
+    def load_images(image: object) -> object:
+
+        with Image.open(image) as photo:
+            ResponseBuilder.draft(photo)
+            photo.load()
+
+        logger.debug('photo loaded')
+
+        return photo
+
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+    # coefficients, which is a lot cheaper than decoding at full size,
+    # draft() picks the smallest scale that is still at least the requested
+    # size. Call it on an opened photo before it's loaded, also used by
+    # deployment_utilities/bulk_enrollment.py.
+    @staticmethod
+    def draft(photo: object, max_side: int = MAX_DECODE_SIDE):
+
+        if photo.format == 'JPEG' and max(photo.size) > max_side:
+            scale = max_side / max(photo.size)
+            photo.draft('RGB', (int(photo.width * scale),
+                                int(photo.height * scale)))
+
+    # load an uploaded reference embedding, .femb or a legacy .pt file
+    @staticmethod
+    def load_reference(upload: object) -> object:
+
+        return EmbeddingFormat.from_bytes(upload.read())
+
+    # raw, pre-decoded RGB pixels (uint8, height x width x 3) for clients
+    # that already have the frames in memory, read straight into the buffer
+    # backing the tensor, i.e., no JPEG decode and no intermediate copies.
+    # shape is a "height,width" string, it's checked against MAX_RAW_SIDE
+    # and the size of the upload before anything is allocated.
+    @staticmethod
+    def load_raw(image: object, shape: str) -> object:
+
+        try:
+            height, width = (int(value) for value in shape.split(','))
+
+        except ValueError:
+            raise UploadError(f'invalid raw photo shape {shape}, expected "height,width"')  # noqa: E501
+
+        if not (0 < height <= MAX_RAW_SIDE and 0 < width <= MAX_RAW_SIDE):
+            raise UploadError(f'raw photo shape {shape} out of range, each side has to be 1 to {MAX_RAW_SIDE} pixels')  # noqa: E501
+
+        start = image.tell()
+        image.seek(0, os.SEEK_END)
+        size = image.tell() - start
+        image.seek(start)
+
+        if size != height * width * 3:
+            raise UploadError(f'raw photo size ({size} bytes) does not match shape {shape}')  # noqa: E501
+
+        buffer = bytearray(size)
+
+        if image.readinto(buffer) != size:
+            raise UploadError(f'raw photo size does not match shape {shape}')
+
+        logger.debug('raw photo loaded')
+
+        return torch.frombuffer(buffer, dtype=torch.uint8).\
+            view(height, width, 3)
@@ -1,15 +1,31 @@
 # (C) Markham 2022 - 2024
 # Facial-Recognition-Facenet-Pytorch
 # Flask based API wrapper around the Facenet-PyTorch facial recognition library
-# This script calculates cosine distance and does the comparison to the
-# provided threshold.
+# This script calculates cosine/euclidean distances and does the comparison
+# to the provided threshold. Besides the single pair methods there are
+# vectorized methods for comparing (N x D) and (M x D) blocks of embeddings,
+# which work in chunks so memory use stays bounded for large galleries.
+# References can also be quantized (float16, or int8 with a scale per row),
+# those are scored block by block without dequantizing the whole matrix.
+# Euclidean distance is always taken between L2 normalized embeddings, i.e.,
+# sqrt(2 - 2 x cosine similarity), between 0 and 2, so a euclidean threshold
+# means the same for a photo pair, a cached reference, the gallery and the
+# ANN index, whichever head (embeddings or logits) the tensors came from.
 import torch
 import torch.nn.functional as F
+from embedding_format import EmbeddingFormat
 from logging_util import logger
 
+# the "type" form field, cosine is the default
+SCORE_TYPES = ('cosine', 'euclidean')
+
 
 class SimilarityScore:
 
+    # max rows per block for the many-vs-many methods, i.e., at most a
+    # CHUNK_SIZE x CHUNK_SIZE block of distances is held in memory
+    CHUNK_SIZE = 1024
+
     # method for calculating cosine distance between two tensors
     @staticmethod
     def cosine_score(reference: float, sample: float) -> float:
@@ -17,24 +33,261 @@ class SimilarityScore:
         cosd = F.cosine_similarity(reference, sample)
         score = round((1 - cosd.item()), 4)
 
-        logger.info(f'Cosine distance calculated: {score}')
+        logger.debug('Cosine distance calculated: %s', score)
 
         return score
 
-    # not using this at the moment
+    # euclidean distance between the two L2 normalized tensors
     @staticmethod
     def euclidean_distance(reference: float, sample: float) -> float:
 
-        dist = torch.cdist(reference, sample, p=2.0,
+        dist = torch.cdist(F.normalize(reference.float(), p=2, dim=1),
+                           F.normalize(sample.float(), p=2, dim=1), p=2.0,
                            compute_mode='use_mm_for_euclid_dist_if_necessary')
 
         # pull the float value out of the tensor object
         dist = round((dist.item()), 2)
 
-        logger.info(f'Euclidean distance is: {dist}')
+        logger.debug('Euclidean distance is: %s', dist)
 
         return dist
 
+    # score a single pair based on the score type, cosine unless euclidean
+    # is specified, raises a ValueError for any other type
+    @classmethod
+    def score(cls, reference: object, sample: object,
+              score_type: str = 'cosine') -> float:
+
+        if score_type not in SCORE_TYPES:
+            raise ValueError(f'Unknown score type {score_type}, expected one of {SCORE_TYPES}')  # noqa: E501
+
+        if score_type == 'euclidean':
+            return cls.euclidean_distance(reference.reshape(1, -1),
+                                          sample.reshape(1, -1))
+
+        return cls.cosine_score(reference, sample)
+
+    # L2 normalize a block of embeddings, one embedding per row
+    @staticmethod
+    def normalize(embeddings: object) -> object:
+
+        return F.normalize(embeddings.reshape(len(embeddings), -1).float(),
+                           p=2, dim=1)
+
+    # (N x M) distances between two blocks in one pass, the inputs are
+    # expected to be L2 normalized
+    @staticmethod
+    def block_distances(queries: object, references: object,
+                        score_type: str = 'cosine') -> object:
+
+        if score_type == 'euclidean':
+            return torch.cdist(
+                queries, references, p=2.0,
+                compute_mode='use_mm_for_euclid_dist_if_necessary')
+
+        return 1 - torch.mm(queries, references.T)
+
+    @staticmethod
+    def is_quantized(references: object) -> bool:
+
+        return references.dtype in (torch.float16, torch.int8)
+
+    # normalize the queries for scoring against quantized references, for
+    # int8 references they're quantized the same way, returns the queries and
+    # their scales (None unless int8)
+    @classmethod
+    def prepare_quantized(cls, queries: object, references: object,
+                          normalized: bool) -> tuple:
+
+        queries = queries.reshape(len(queries), -1).float()
+
+        if not normalized:
+            queries = cls.normalize(queries)
+
+        if references.dtype == torch.int8:
+            return EmbeddingFormat.quantize(queries)
+
+        return queries, None
+
+    # (N x M) distances between a block of queries and a block of L2
+    # normalized, quantized references. For int8 the dot products are taken
+    # on the integer values and then multiplied by the two scales. The sums
+    # are exact in float32 as long as 127^2 x width < 2^24, i.e., up to ~1000
+    # wide, which covers the 512-d embeddings. For the 8631-wide logits
+    # they're rounded to float32 precision, still well below the int8
+    # quantization error. Euclidean distance is
+    # derived from the dot product, i.e., sqrt(2 - 2 x similarity), which
+    # only holds because both sides are normalized.
+    @staticmethod
+    def quantized_distances(queries: object, query_scales: object,
+                            references: object, reference_scales: object,
+                            score_type: str = 'cosine') -> object:
+
+        similarity = torch.mm(queries.float(), references.float().T)
+
+        if query_scales is not None:
+            similarity = similarity * query_scales.unsqueeze(1) * \
+                reference_scales.unsqueeze(0)
+
+        if score_type == 'euclidean':
+            return torch.sqrt(torch.clamp(2 - 2 * similarity, min=0))
+
+        return 1 - similarity
+
+    # full (N x M) distance matrix between an (N x D) and an (M x D) block,
+    # calculated CHUNK_SIZE x CHUNK_SIZE at a time. scales are the per row
+    # scales of int8 references.
+    @classmethod
+    def distance_matrix(cls, queries: object, references: object,
+                        score_type: str = 'cosine',
+                        normalized: bool = False,
+                        scales: object = None) -> object:
+
+        distances = torch.cat([
+            torch.cat([distances for j, distances in block], dim=1)
+            for block in cls.distance_blocks(queries, references, score_type,
+                                             normalized, scales)])
+
+        logger.debug('%s x %s %s distance matrix calculated', distances.shape[0], distances.shape[1], score_type)  # noqa: E501
+
+        return distances
+
+    # yields a generator for each CHUNK_SIZE block of queries, which in turn
+    # yields (first reference row, distances) for each CHUNK_SIZE block of
+    # references
+    @classmethod
+    def distance_blocks(cls, queries: object, references: object,
+                        score_type: str = 'cosine', normalized: bool = False,
+                        scales: object = None):
+
+        quantized = cls.is_quantized(references)
+        query_scales = None
+
+        if quantized:
+            queries, query_scales = cls.prepare_quantized(queries, references,
+                                                          normalized)
+
+        else:
+            queries, references = cls.prepare(queries, references,
+                                              score_type, normalized)
+
+        def reference_blocks(i: int):
+
+            query_block = queries[i:i + cls.CHUNK_SIZE]
+
+            for j in range(0, len(references), cls.CHUNK_SIZE):
+                reference_block = references[j:j + cls.CHUNK_SIZE]
+
+                if not quantized:
+                    yield j, cls.block_distances(query_block, reference_block,
+                                                 score_type)
+                    continue
+
+                yield j, cls.quantized_distances(
+                    query_block,
+                    None if query_scales is None
+                    else query_scales[i:i + cls.CHUNK_SIZE],
+                    reference_block,
+                    None if scales is None
+                    else scales[j:j + cls.CHUNK_SIZE],
+                    score_type)
+
+        for i in range(0, len(queries), cls.CHUNK_SIZE):
+            yield reference_blocks(i)
+
+    # the k closest references for each query, returns (N x k) distances and
+    # (N x k) reference row numbers, closest first. The references are
+    # scanned in chunks and only the running top k is kept, so memory use is
+    # bounded by the chunk size rather than the size of the gallery. Rows
+    # with False in the optional mask are excluded, scales are the per row
+    # scales of int8 references.
+    @classmethod
+    def top_k(cls, queries: object, references: object, k: int,
+              score_type: str = 'cosine', normalized: bool = False,
+              mask: object = None, scales: object = None) -> tuple:
+
+        k = min(k, len(references))
+
+        top_distances = []
+        top_rows = []
+
+        for block in cls.distance_blocks(queries, references, score_type,
+                                         normalized, scales):
+
+            best_distances = None
+            best_rows = None
+
+            for j, distances in block:
+
+                if mask is not None:
+                    distances = distances.masked_fill(
+                        ~mask[j:j + cls.CHUNK_SIZE], float('inf'))
+
+                rows = torch.arange(j, j + distances.shape[1],
+                                    device=distances.device).\
+                    expand_as(distances)
+
+                if best_distances is not None:
+                    distances = torch.cat((best_distances, distances), dim=1)
+                    rows = torch.cat((best_rows, rows), dim=1)
+
+                best_distances, positions = torch.topk(
+                    distances, min(k, distances.shape[1]), dim=1,
+                    largest=False)
+                best_rows = torch.gather(rows, 1, positions)
+
+            top_distances.append(best_distances)
+            top_rows.append(best_rows)
+
+        return torch.cat(top_distances), torch.cat(top_rows)
+
+    # distances between one reference and a (N x D) block of samples,
+    # returns a list of N scores
+    @classmethod
+    def one_to_many_scores(cls, reference: object, samples: object,
+                           score_type: str = 'cosine') -> list:
+
+        distances = cls.distance_matrix(reference.reshape(1, -1), samples,
+                                        score_type)[0]
+
+        return cls.round_scores(distances, score_type)
+
+    # row-wise distances between two (N x D) blocks, i.e., N reference/sample
+    # pairs scored in one pass, returns a list of N scores
+    @classmethod
+    def paired_scores(cls, references: object, samples: object,
+                      score_type: str = 'cosine') -> list:
+
+        if score_type == 'euclidean':
+            distances = torch.linalg.vector_norm(
+                cls.normalize(references) - cls.normalize(samples), dim=1)
+
+        else:
+            distances = 1 - F.cosine_similarity(references, samples, dim=1)
+
+        logger.debug('%s distances calculated for %s pairs', score_type, len(distances))  # noqa: E501
+
+        return cls.round_scores(distances, score_type)
+
+    # normalize the inputs, unless they already are
+    @classmethod
+    def prepare(cls, queries: object, references: object, score_type: str,
+                normalized: bool) -> tuple:
+
+        if not normalized:
+            queries = cls.normalize(queries)
+            references = cls.normalize(references)
+
+        return queries, references
+
+    # same rounding as the single pair methods
+    @staticmethod
+    def round_scores(distances: object, score_type: str) -> list:
+
+        digits = 2 if score_type == 'euclidean' else 4
+
+        return [round(score, digits) for score in distances.tolist()]
+
     # method for calculating match status - putting this into a separate
     # method to accomodate multiple score types
     @staticmethod
@@ -44,3 +297,10 @@ class SimilarityScore:
             return 1
         else:
             return 0
+
+    # vectorized match status for a tensor of distances, 1 for a match,
+    # 0 otherwise
+    @staticmethod
+    def match_mask(distances: object, threshold: float) -> object:
+
+        return (distances < threshold).int()
@@ -5,13 +5,24 @@
 # to the client, etc.
 import flask
 import json
-import time
+import os
 import torch
-from PIL import Image
 from flask import Flask, request
+from time import perf_counter
+from ann_index import IVFIndex
+from batching import BatchScheduler
+from embedding_store import EmbeddingStore
+from gallery import GalleryIndex
+from metrics import Metrics
 from photo_inferencing import Inferencing
-from score_service import SimilarityScore
-from logging_util import logger
+from process_stats import ProcessStats
+from readiness import Readiness
+from reference_cache import ReferenceCache
+from response_builder import ResponseBuilder, UploadError
+from score_service import SCORE_TYPES, SimilarityScore
+from video_tracking import FaceTracker, first_frame_checked, upload_frames, \
+    video_frames
+from logging_util import begin_request, logger
 
 app = Flask('Identity')
 
@@ -19,10 +30,120 @@ app = Flask('Identity')
 photo_match = Inferencing()
 logger.info('ML models instantiated')
 
+# optionally coalesce the embedding passes of concurrent requests into
+# batches, requires a threaded server, e.g., gunicorn --threads
+if os.environ.get('EMBEDDING_BATCHING', 'false').lower() == 'true':
+    inferencing = BatchScheduler(
+        photo_match,
+        int(os.environ.get('MAX_BATCH_SIZE', 32)),
+        float(os.environ.get('MAX_BATCH_WAIT_MS', 5)))
+
+else:
+    inferencing = photo_match
+
+# per stage latency histograms, request counters and queue gauges, served
+# on /metrics
+metrics = Metrics()
+
+if isinstance(inferencing, BatchScheduler):
+    metrics.register_gauge('embedding_queue_depth',
+                           'Embedding requests waiting for a batch',
+                           inferencing.queue_depth)
+
+if photo_match.detection_pool is not None:
+    metrics.register_gauge('detection_queue_depth',
+                           'Photos queued or being detected by the pool',
+                           lambda: photo_match.detection_pool.pending)
+
+# warm-up with synthetic batches of these sizes, "/ready" reports ready once
+# it's done. With preloaded gunicorn workers it's started in each worker
+# (gunicorn_config.py sets WARM_UP_ON_IMPORT=false).
+readiness = Readiness(
+    photo_match,
+    [int(size) for size in
+     os.environ.get('WARM_UP_BATCH_SIZES', '1,2,8').split(',')],
+    inferencing if inferencing is not photo_match else None)
+
+# the detection pool's processes are forked before the warm-up (or any
+# request) thread starts
+if os.environ.get('WARM_UP_ON_IMPORT', 'true').lower() == 'true':
+
+    if photo_match.detection_pool is not None:
+        photo_match.detection_pool.start()
+
+    readiness.start()
+
+metrics.register_gauge('ready', 'Whether warm-up is complete',
+                       lambda: int(readiness.ready))
+metrics.register_gauge('model_load_seconds', 'Time to load the models',
+                       lambda: photo_match.load_time)
+metrics.register_gauge('warm_up_seconds', 'Time to warm up the models',
+                       lambda: readiness.warm_up_time or 0)
+
 # instantiate the class with the scoring functionality
 scoring = SimilarityScore()
 logger.info('Scoring/similarity class instantiated')
 
+# response/photo loading helpers shared with the async server
+responses = ResponseBuilder(scoring)
+
+# LRU cache for the reference tensors uploaded to /cached_data, entries can
+# be held as float16/int8 to fit more references in the same memory
+reference_cache = ReferenceCache(
+    int(os.environ.get('REFERENCE_CACHE_MB', 64)) * 1024 * 1024,
+    os.environ.get('REFERENCE_CACHE_DTYPE', 'float32'))
+
+# open the persistent store of enrolled reference embeddings, an empty store
+# is seeded from a folder of cached tensors. The dtype (float32, float16 or
+# int8) only applies when a new store is created.
+store = EmbeddingStore(os.environ.get('EMBEDDING_STORE_PATH',
+                                      'embedding_store'),
+                       os.environ.get('EMBEDDING_STORE_DTYPE', 'float32'))
+
+store.seed(os.environ.get('GALLERY_PATH', 'cpu_tensors'))
+
+# approximate nearest neighbor index for very large galleries, off unless
+# ANN_NLIST is set, ANN_NPROBE is the default recall/latency trade-off
+ann_index = None
+
+if int(os.environ.get('ANN_NLIST', 0)) > 0:
+    ann_index = IVFIndex.open(
+        os.environ.get('ANN_INDEX_PATH',
+                       os.path.join(store.path, 'ivf_index.npz')),
+        int(os.environ.get('ANN_NLIST')),
+        int(os.environ.get('ANN_NPROBE', 16)))
+
+# gallery of reference embeddings used for 1:N searches
+gallery = GalleryIndex(photo_match.device, ann=ann_index)
+gallery.load_store(store)
+
+
+# request timing for the metrics, teardown runs after a streamed response
+# has been sent. Each request gets a correlation ID for its log lines, the
+# client's X-Request-ID if it sent one, which is returned in the response.
+@app.before_request
+def start_request():
+
+    flask.g.start = perf_counter()
+    flask.g.request_id = begin_request(request.headers.get('X-Request-ID'))
+    metrics.request_started(request.endpoint)
+
+
+@app.after_request
+def record_status(response: flask.Response) -> flask.Response:
+
+    flask.g.status = response.status_code
+    response.headers['X-Request-ID'] = flask.g.request_id
+
+    return response
+
+
+@app.teardown_request
+def finish_request(error: Exception = None):
+
+    metrics.request_finished(request.endpoint, flask.g.get('status', 500),
+                             perf_counter() - flask.g.start)
+
 
 # endpoint for API health check
 # the "ping" endpoint is one that is required by AWS
@@ -34,7 +155,48 @@ def health():
     results = {"API Status": 200}
     resultjson = json.dumps(results)
 
-    logger.info(f'health check response: {resultjson}')
+    logger.info('health check response: %s', resultjson)
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# readiness endpoint, 503 until the models are warmed up, for load balancer/
+# Kubernetes readiness probes. Includes the model load and warm-up times.
+@app.route("/ready", methods=['GET'])
+def ready():
+
+    resultjson = json.dumps(readiness.report())
+    status = 200 if readiness.ready else 503
+
+    return flask.Response(response=resultjson, status=status,
+                          mimetype='application/json')
+
+
+# endpoint reporting the memory use of the worker that handles the request,
+# used to check that the model weights are shared between workers
+@app.route("/memory", methods=['GET'])
+def memory():
+
+    resultjson = json.dumps(ProcessStats.memory_report())
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# endpoint with this worker's metrics, in the Prometheus text format
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+
+    return flask.Response(response=metrics.render(), status=200,
+                          mimetype='text/plain; version=0.0.4')
+
+
+# endpoint with the reference cache's hit/miss counters for this worker
+@app.route("/cache_stats", methods=['GET'])
+def cache_stats():
+
+    resultjson = json.dumps(reference_cache.stats())
 
     return flask.Response(response=resultjson, status=200,
                           mimetype='application/json')
@@ -44,42 +206,53 @@ def health():
 @app.route("/identity", methods=['POST'])
 def embeddings():
 
-    score_type = request.form.get('type')
-    threshold = request.form.get('threshold')
+    with stage('parse'):
+        score_type = request.form.get('type', 'cosine')
+        threshold = request.form.get('threshold')
 
-    logger.info(f'Request received at endpoint for photo pairs, score type: {score_type}, and match threshold: {threshold}')  # noqa: E501
+        # python parses the data as a string and we need it to be a float
+        # to be used for scoring
+        threshold = float(threshold)
 
-    # python parses the data as a string and we need it to be a float to
-    # be used for scoring
-    threshold = float(threshold)
+        # retrieve reference photo
+        ref_file = request.files['reference']
 
-    # retrieve reference photo
-    ref_file = request.files['reference']
+        # retrieve sample photo
+        sample_file = request.files['sample']
 
-    # retrieve sample photo
-    sample_file = request.files['sample']
+    logger.info('Request received at endpoint for photo pairs, score type: %s, and match threshold: %s', score_type, threshold)  # noqa: E501
 
-    logger.info('parsed image data from incomimng request')
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
 
     # load photos
-    ref_img = load_images(ref_file)
-    sample_img = load_images(sample_file)
+    with stage('decode'):
+        ref_img = load_upload(ref_file, 'reference')
+        sample_img = load_upload(sample_file, 'sample')
 
     # generate pair of tensors
     # timing inferencing latency defined, which is just the time for
     #  the ML code to run
-    start = time.time()
+    start = perf_counter()
+
+    with stage('detection'):
+        faces = torch.stack((photo_match.detect_face(ref_img),
+                             photo_match.detect_face(sample_img)))
 
-    ref_tensor, sample_tensor = photo_match.\
-        identity_verify(ref_img, sample_img)
+    # both faces go through the network in a single forward pass
+    with stage('embedding'):
+        tensors = inferencing.embed_faces(faces)
 
-    end = time.time()
+    latency = round(1000 * (perf_counter() - start), 2)
+    logger.info('Facial embeddings generated, inferencing latency: %s ms', latency, extra={'latency_ms': latency})  # noqa: E501
 
-    latency = 1000 * round((end - start), 2)
-    logger.info(f'Facial embeddings generated, inferencing latency: {latency} ms')  # noqa: E501
+    with stage('scoring'):
+        results = responses.build_results(latency, tensors[0:1],
+                                          tensors[1:2], score_type,
+                                          threshold)
 
-    resultjson = build_response(latency, ref_tensor, sample_tensor,
-                                score_type, threshold)
+    with stage('serialization'):
+        resultjson = json.dumps(results)
 
     logger.info('response sent back to client')
     return flask.Response(response=resultjson, status=200,
@@ -91,89 +264,716 @@ def embeddings():
 def cached():
 
     # parse score type and threshold from POST request
-    score_type = request.form.get('type')
-    threshold = request.form.get('threshold')
+    with stage('parse'):
+        score_type = request.form.get('type', 'cosine')
+        threshold = request.form.get('threshold')
+
+        # python parses the data as a string as we need it to be a float
+        # to be used for scoring
+        threshold = float(threshold)
+
+        reference_id = request.form.get('reference_id')
+
+        # retrieve sample photo
+        sample_file = request.files['sample']
+
+    logger.info('Request received at cached data endpoint, score type: %s, match threshold: %s', score_type, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
 
-    logger.info(f'Request received at cached data endpoint, score type: {score_type}, match threshold: {threshold}')  # noqa: E501
+    # parse and load PyTorch tensor, via the reference cache, i.e., a
+    # reference that was uploaded before can be sent as just its ID
+    with stage('decode'):
 
-    # python parses the data as a string as we need it to be a float
-    # to be used for scoring
-    threshold = float(threshold)
+        if 'reference' in request.files:
+            reference_id, cached_tensor = reference_cache.\
+                load(request.files['reference'], reference_id)
 
-    # parse and load PyTorch tensor
-    ref = request.files['reference']
-    cached_tensor = torch.load(ref)
+        elif not reference_id:
+            resultjson = json.dumps({"error": "reference or reference_id required"})  # noqa: E501
+            return flask.Response(response=resultjson, status=400,
+                                  mimetype='application/json')
 
-    # retrieve sample photo
-    sample_file = request.files['sample']
-    sample_img = load_images(sample_file)
+        else:
+            cached_tensor = reference_cache.get(reference_id)
+
+            if cached_tensor is None:
+                resultjson = json.dumps({"error": "reference not cached, upload it again",  # noqa: E501
+                                         "reference_id": reference_id})
+                return flask.Response(response=resultjson, status=404,
+                                      mimetype='application/json')
+
+        cached_tensor = cached_tensor.to(photo_match.device)
+
+        sample_img = load_upload(sample_file, 'sample')
 
     logger.info('data parsed from incoming request')
 
     # generate embeddings for sample photo
     # timing inferencing latency defined, which is just the time for
     # the ML code to run
-    start = time.time()
+    start = perf_counter()
+
+    with stage('detection'):
+        sample_cropped = photo_match.detect_face(sample_img)
 
-    sample_tensor = photo_match.cached_reference(sample_img)
+    if sample_cropped is None:
+        return no_face_response('sample')
 
-    end = time.time()
+    # score in the same space as the reference, i.e., references cached
+    # before the switch to 512-d embeddings hold classifier logits
+    with stage('embedding'):
+        logits = photo_match.logit_space(cached_tensor.shape[-1])
+        sample_tensor = inferencing.embed_faces(
+            sample_cropped.unsqueeze(0), logits)
 
-    latency = 1000 * round((end - start), 2)
+    latency = round(1000 * (perf_counter() - start), 2)
 
-    logger.info(f'Facial embedding generated for sample photo, inferencing latency: {latency}')  # noqa: E501
+    logger.info('Facial embedding generated for sample photo, inferencing latency: %s', latency, extra={'latency_ms': latency})  # noqa: E501
 
     # send data to the method that does the similarity calculations
     # and builds response payload
-    resultjson = build_response(latency, cached_tensor, sample_tensor,
-                                score_type, threshold)
-    logger.info(resultjson)
+    with stage('scoring'):
+        results = responses.build_results(latency, cached_tensor,
+                                          sample_tensor, score_type,
+                                          threshold, reference_id)
+
+    with stage('serialization'):
+        resultjson = json.dumps(results)
+
+    logger.debug('response: %s', resultjson)
 
     return flask.Response(response=resultjson, status=200,
                           mimetype='application/json')
 
 
-# method that aggregates data, prepares json response and sends the data
-# back to the client
-# TODO: move this and the methods below to a separate class, add field
-# for the endpoint the data was received on.
-def build_response(latency: float, tensor1: object, tensor2: object,
-                   score_type: float, threshold: float) -> dict:
+# endpoint for verifying many photo pairs in one request, the references can
+# be photos or cached tensors (.pt), samples are photos. Detection, embeddings
+# and scoring are run in batches across all the pairs.
+@app.route("/identity/batch", methods=['POST'])
+def batch_embeddings():
+
+    with stage('parse'):
+        score_type = request.form.get('type', 'cosine')
+        threshold = float(request.form.get('threshold'))
+
+        references = request.files.getlist('reference')
+        samples = request.files.getlist('sample')
+
+    logger.info('Request received at batch endpoint, %s pairs, score type: %s, match threshold: %s', len(samples), score_type, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
+    if len(references) != len(samples):
+        resultjson = json.dumps({"error": "reference and sample counts don't match"})  # noqa: E501
+        return flask.Response(response=resultjson, status=400,
+                              mimetype='application/json')
+
+    start = perf_counter()
+
+    results = [None] * len(samples)
+
+    # decode everything up front, errors are reported per pair
+    sample_imgs = {}
+    reference_imgs = {}
+    reference_tensors = {}
+
+    with stage('decode'):
+
+        for index, (reference, sample) in enumerate(zip(references,
+                                                        samples)):
+
+            try:
+                if reference.filename.endswith(('.pt', '.femb')):
+                    reference_tensors[index] = responses.\
+                        load_reference(reference).\
+                        reshape(1, -1).to(photo_match.device)
+
+                else:
+                    reference_imgs[index] = load_upload(reference,
+                                                        'reference')
+
+                sample_imgs[index] = load_upload(sample, 'sample')
+
+            except Exception as e:
+                results[index] = {"error": f'unable to load pair: {e}'}
+
+    # one detection pass over all the photos
+    photo_keys = [('sample', index) for index in sample_imgs] + \
+        [('reference', index) for index in reference_imgs
+         if index in sample_imgs]
+
+    with stage('detection'):
+        crops = photo_match.detect_face_batch(
+            [sample_imgs[index] if kind == 'sample'
+             else reference_imgs[index] for kind, index in photo_keys])
+
+    crops = dict(zip(photo_keys, crops))
+
+    # pairs are scored in the space of their reference, i.e., logits for
+    # references cached before the switch to 512-d embeddings
+    groups = {}
+
+    for index in sample_imgs:
+
+        failed = [f'{kind}: {crops[(kind, index)]}'
+                  for kind in ('reference', 'sample')
+                  if isinstance(crops.get((kind, index)), Exception)]
+
+        if failed:
+            results[index] = {"error": f'detection failed, {", ".join(failed)}'}  # noqa: E501
+            continue
+
+        missing = [kind for kind in ('reference', 'sample')
+                   if (kind, index) in crops and crops[(kind, index)] is None]
+
+        if missing:
+            results[index] = {"error": f'no face detected in {" and ".join(missing)} photo'}  # noqa: E501
+            continue
+
+        if index in reference_tensors:
+            logits = photo_match.logit_space(
+                reference_tensors[index].shape[-1])
+
+        else:
+            logits = photo_match.logits
+
+        groups.setdefault(logits, []).append(index)
+
+    for logits, indices in groups.items():
+
+        try:
+            face_crops = [crops[('sample', index)] for index in indices] + \
+                [crops[('reference', index)] for index in indices
+                 if index not in reference_tensors]
+
+            with stage('embedding'):
+                embeddings = embed_in_chunks(face_crops, logits)
+
+            sample_tensors = embeddings[:len(indices)]
+            reference_embeddings = iter(embeddings[len(indices):])
+
+            reference_block = torch.cat(
+                [reference_tensors[index] if index in reference_tensors
+                 else next(reference_embeddings).unsqueeze(0)
+                 for index in indices])
+
+            with stage('scoring'):
+                scores = scoring.paired_scores(reference_block,
+                                               sample_tensors, score_type)
+
+        except Exception as e:
+            for index in indices:
+                results[index] = {"error": f'scoring failed: {e}'}
+
+            continue
+
+        for index, score in zip(indices, scores):
+            results[index] = {"match_status": scoring.match_status(score,
+                                                                   threshold),
+                              "score": round(score, 3)}
+
+    latency = round(1000 * (perf_counter() - start), 2)
+
+    logger.info('%s pairs verified, inferencing latency: %s', len(samples), latency, extra={'latency_ms': latency})  # noqa: E501
+
+    with stage('serialization'):
+        resultjson = json.dumps({"results": results,
+                                 "pairs": len(samples),
+                                 "score_type": score_type,
+                                 "score_threshold": threshold,
+                                 "inferencing_latency(ms)": latency})
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# endpoint for 1:N identification: a sample photo is scored against every
+# identity in the gallery, returns the closest matches
+@app.route("/search", methods=['POST'])
+def search():
+
+    with stage('parse'):
+        score_type = request.form.get('type', 'cosine')
+        threshold = float(request.form.get('threshold'))
+        top_k = int(request.form.get('top_k', 5))
+
+        # only used with an ANN index, lists to scan
+        nprobe = request.form.get('nprobe')
+        nprobe = int(nprobe) if nprobe else None
+
+        # retrieve sample photo
+        sample_file = request.files['sample']
+
+    logger.info('Request received at search endpoint, top_k: %s, match threshold: %s', top_k, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
+    with stage('decode'):
+        sample_img = load_upload(sample_file, 'sample')
+
+    # timing inferencing latency defined, which is just the time for
+    # the ML code to run
+    start = perf_counter()
+
+    # pick up enrollments made by other workers
+    if store.refresh():
+        gallery.load_store(store)
+
+    with stage('detection'):
+        sample_cropped = photo_match.detect_face(sample_img)
+
+    if sample_cropped is None:
+        return no_face_response('sample')
+
+    with stage('embedding'):
+        sample_tensor = inferencing.embed_faces(sample_cropped.unsqueeze(0),
+                                                gallery_logit_space())
+
+    with stage('scoring'):
+        matches = gallery.search(sample_tensor, top_k, score_type, nprobe)
+
+    latency = round(1000 * (perf_counter() - start), 2)
+
+    logger.info('Gallery search complete, inferencing latency: %s', latency, extra={'latency_ms': latency})  # noqa: E501
+
+    with stage('serialization'):
+        results = {"matches": [{"identity": identity,
+                                "score": round(score, 3),
+                                "match_status": scoring.match_status(
+                                    score, threshold)}
+                               for identity, score in matches],
+                   "gallery_size": len(gallery),
+                   "score_type": score_type,
+                   "score_threshold": threshold,
+                   "inferencing_latency(ms)": latency}
+
+        resultjson = json.dumps(results)
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
 
-    # generate score
-    score = scoring.cosine_score(tensor1, tensor2)
-    logger.info('similarity score calculated')
+# endpoint for group photos: every face in the sample photo is matched
+# against a reference photo, a cached tensor for the reference photo, or if
+# neither is provided, the gallery
+@app.route("/faces", methods=['POST'])
+def faces():
 
-    # get match status
-    status = scoring.match_status(score, threshold)
+    with stage('parse'):
+        score_type = request.form.get('type', 'cosine')
+        threshold = float(request.form.get('threshold'))
+        top_k = int(request.form.get('top_k', 1))
+        uploads = request.files
 
-    # round match score
-    score = round(score, 3)
+    logger.info('Request received at group photo endpoint, score type: %s, match threshold: %s', score_type, threshold)  # noqa: E501
 
-    logger.info(f'match status calculated: {status} from a score of: {score}')
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
 
-    # prepare latency message: rounding + adding units
-    latency_message = latency
+    reference_img = None
+    cached_tensor = None
 
-    # return data
-    results = {"match_status": status,
-               "score": score,
+    with stage('decode'):
+        sample_img = load_upload(uploads['sample'], 'sample')
+
+        if 'reference' in uploads:
+            reference_img = load_upload(uploads['reference'], 'reference')
+
+        elif 'tensor' in uploads:
+            cached_tensor = responses.load_reference(uploads['tensor']).\
+                to(photo_match.device)
+
+    start = perf_counter()
+
+    # one detection pass for the whole photo
+    with stage('detection'):
+        face_crops, boxes, probs = photo_match.detect_faces(sample_img)
+
+        if face_crops is not None and reference_img is not None:
+            reference_crop = photo_match.detect_face(reference_img)
+
+            if reference_crop is None:
+                return no_face_response('reference')
+
+    results = {"faces": [],
+               "face_count": len(boxes),
                "score_type": score_type,
-               "score_threshold": threshold,
-               "inferencing_latency(ms)": latency_message}
+               "score_threshold": threshold}
+
+    if face_crops is not None:
+
+        # add the reference face to the same batch as the sample faces, so
+        # that all the embeddings are generated in one forward pass
+        if reference_img is not None:
+            face_crops = torch.cat((reference_crop.unsqueeze(0),
+                                    face_crops))
+            logits = None
+
+        elif cached_tensor is not None:
+            logits = photo_match.logit_space(cached_tensor.shape[-1])
+
+        else:
+            if store.refresh():
+                gallery.load_store(store)
+
+            logits = gallery_logit_space()
+
+        with stage('embedding'):
+            embeddings = inferencing.embed_faces(face_crops, logits)
+
+        if reference_img is not None:
+            cached_tensor, embeddings = embeddings[0:1], embeddings[1:]
+
+        if cached_tensor is not None:
+            with stage('scoring'):
+                scores = scoring.one_to_many_scores(cached_tensor,
+                                                    embeddings, score_type)
+
+            results['faces'] = [{"box": box,
+                                 "probability": prob,
+                                 "score": round(score, 3),
+                                 "match_status": scoring.match_status(
+                                     score, threshold)}
+                                for box, prob, score in zip(boxes, probs,
+                                                            scores)]
+
+        else:
+            with stage('scoring'):
+                matches = gallery.search_batch(embeddings, top_k,
+                                               score_type)
+
+            results['faces'] = [{"box": box,
+                                 "probability": prob,
+                                 "matches": [{"identity": identity,
+                                              "score": round(score, 3),
+                                              "match_status":
+                                              scoring.match_status(
+                                                  score, threshold)}
+                                             for identity, score
+                                             in face_matches]}
+                                for box, prob, face_matches in zip(
+                                    boxes, probs, matches)]
+
+    latency = round(1000 * (perf_counter() - start), 2)
+    results["inferencing_latency(ms)"] = latency
+
+    logger.info('%s faces detected and matched, inferencing latency: %s', len(boxes), latency, extra={'latency_ms': latency})  # noqa: E501
+
+    with stage('serialization'):
+        resultjson = json.dumps(results)
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# streaming verification for video: a "video" file or a sequence of "frames"
+# photos (in order). Faces are detected on keyframes only and tracked in
+# between, each track's best crops are embedded once the track ends and
+# matched against a reference photo, a cached tensor or the gallery. Results
+# stream back as newline delimited JSON: one line per track as it ends, then
+# a summary line.
+@app.route("/video", methods=['POST'])
+def video():
+
+    score_type = request.form.get('type', 'cosine')
+    threshold = float(request.form.get('threshold'))
+    top_k = int(request.form.get('top_k', 1))
+    keyframe_interval = int(request.form.get(
+        'keyframe_interval', os.environ.get('KEYFRAME_INTERVAL', 5)))
+
+    logger.info('Request received at video endpoint, keyframe interval: %s, match threshold: %s', keyframe_interval, threshold)  # noqa: E501
+
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
+    reference = None
+    logits = None
+
+    if 'reference' in request.files:
+        reference = inferencing.cached_reference(
+            load_upload(request.files['reference'], 'reference'))
+
+        if reference is None:
+            return no_face_response('reference')
+
+    elif 'tensor' in request.files:
+        reference = responses.load_reference(request.files['tensor']).\
+            to(photo_match.device)
+        logits = photo_match.logit_space(reference.shape[-1])
+
+    else:
+        if store.refresh():
+            gallery.load_store(store)
+
+        logits = gallery_logit_space()
+
+    if 'video' in request.files:
+        frames = video_frames(request.files['video'])
+
+    else:
+        frames = upload_frames(request.files.getlist('frames'),
+                               lambda upload: responses.load_images(upload))
+
+    # a video that can't be opened is a 400, once the response has started
+    # errors can only be reported in the stream
+    try:
+        frames = first_frame_checked(frames)
+
+    except (ValueError, OSError) as e:
+        resultjson = json.dumps({"error": f'unable to read video: {e}'})
+        return flask.Response(response=resultjson, status=400,
+                              mimetype='application/json')
+
+    tracker = FaceTracker(photo_match.detect_faces, keyframe_interval)
+
+    def score_tracks(tracks: list) -> list:
+
+        if not tracks:
+            return []
+
+        crops = [track.best() for track in tracks]
+
+        with stage('embedding'):
+            embeddings = embed_in_chunks([crop for track_crops in crops
+                                          for crop in track_crops], logits)
+
+        embeddings = torch.split(embeddings, [len(track_crops)
+                                              for track_crops in crops])
+
+        results = [track.summary() for track in tracks]
+
+        if reference is not None:
+            for result, track_embeddings in zip(results, embeddings):
+                scores = scoring.one_to_many_scores(reference,
+                                                    track_embeddings,
+                                                    score_type)
+
+                # the mean over the track's crops, plus the best crop
+                score = sum(scores) / len(scores)
+                result.update({"score": round(score, 3),
+                               "best_score": round(min(scores), 3),
+                               "match_status": scoring.match_status(
+                                   score, threshold)})
+
+            return results
+
+        # one template per track, the mean of its normalized embeddings
+        templates = torch.stack([
+            scoring.normalize(track_embeddings).mean(dim=0)
+            for track_embeddings in embeddings])
+
+        matches = gallery.search_batch(templates, top_k, score_type)
+
+        for result, track_matches in zip(results, matches):
+            result["matches"] = [{"identity": identity,
+                                  "score": round(score, 3),
+                                  "match_status": scoring.match_status(
+                                      score, threshold)}
+                                 for identity, score in track_matches]
+
+        return results
+
+    # an error after the response has started ends the stream with an
+    # "error" line rather than a dropped connection
+    def stream():
+
+        try:
+            yield from track_results()
+
+        except Exception as e:
+            logger.error('Video processing failed with error: %s', e)
+            yield json.dumps({"error": f'video processing failed: {e}',
+                              "frames": tracker.frames}) + '\n'
+
+    def track_results():
+
+        start = perf_counter()
+        track_count = 0
+
+        for frame, load in frames:
+
+            # keyframes are decoded and run through MTCNN
+            with stage('detection'):
+                ended = tracker.process(frame, load)
+
+            track_count += len(ended)
+
+            for result in score_tracks(ended):
+                yield json.dumps(result) + '\n'
+
+        ended = tracker.finish()
+        track_count += len(ended)
+
+        for result in score_tracks(ended):
+            yield json.dumps(result) + '\n'
+
+        latency = round(1000 * (perf_counter() - start), 2)
+
+        logger.info('Video processed: %s frames, %s keyframes, %s tracks, inferencing latency: %s', tracker.frames, tracker.keyframes, track_count, latency, extra={'latency_ms': latency})  # noqa: E501
+
+        yield json.dumps({"frames": tracker.frames,
+                          "keyframes": tracker.keyframes,
+                          "tracks": track_count,
+                          "score_type": score_type,
+                          "score_threshold": threshold,
+                          "inferencing_latency(ms)": latency}) + '\n'
+
+    return flask.Response(flask.stream_with_context(stream()), status=200,
+                          mimetype='application/x-ndjson')
+
+
+# endpoint for enrolling an identity in the embedding store, takes either a
+# reference photo or a cached tensor for the reference photo
+@app.route("/enroll", methods=['POST'])
+def enroll():
+
+    identity = request.form.get('identity')
+
+    logger.info('Request received at enrollment endpoint for identity: %s', identity)  # noqa: E501
+
+    if not identity:
+        resultjson = json.dumps({"error": "identity is required"})
+        return flask.Response(response=resultjson, status=400,
+                              mimetype='application/json')
+
+    if 'tensor' in request.files:
+        embedding = responses.load_reference(request.files['tensor'])
+
+    else:
+        reference_img = load_upload(request.files['reference'],
+                                    'reference')
+        embedding = inferencing.cached_reference(reference_img,
+                                                 gallery_logit_space())
+
+        if embedding is None:
+            return no_face_response('reference')
+
+    # e.g., a 512-d tensor for a store of classifier logits
+    try:
+        row = store.enroll(identity, embedding)
+
+    except ValueError as e:
+        resultjson = json.dumps({"error": str(e)})
+        return flask.Response(response=resultjson, status=400,
+                              mimetype='application/json')
+
+    gallery.load_store(store)
+
+    results = {"identity": identity,
+               "row": row,
+               "gallery_size": len(store)}
+
+    resultjson = json.dumps(results)
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# endpoint for removing an identity from the embedding store
+@app.route("/unenroll", methods=['POST'])
+def unenroll():
+
+    identity = request.form.get('identity')
+
+    logger.info('Request received at unenrollment endpoint for identity: %s', identity)  # noqa: E501
+
+    removed = store.unenroll(identity)
+    gallery.load_store(store)
+
+    results = {"identity": identity,
+               "removed": removed,
+               "gallery_size": len(store)}
+
+    resultjson = json.dumps(results)
+
+    status = 200 if removed else 404
+
+    return flask.Response(response=resultjson, status=status,
+                          mimetype='application/json')
+
+
+# endpoint listing the enrolled identities
+@app.route("/identities", methods=['GET'])
+def identities():
+
+    store.refresh()
+
+    results = {"identities": store.identities(),
+               "gallery_size": len(store)}
 
     resultjson = json.dumps(results)
 
-    return resultjson
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
+
+
+# a raw upload that doesn't match its shape field is a 400 with a JSON error
+@app.errorhandler(UploadError)
+def upload_error(error: UploadError) -> flask.Response:
+
+    resultjson = json.dumps({"error": str(error)})
+
+    return flask.Response(response=resultjson, status=400,
+                          mimetype='application/json')
+
+
+# load an uploaded photo, if the client sent a <field>_shape form field, e.g.,
+# sample_shape=480,640 the upload is raw uint8 RGB pixels rather than an
+# encoded photo, raises an UploadError if it doesn't match the shape
+def load_upload(upload: object, field: str) -> object:
+
+    shape = request.form.get(f'{field}_shape')
+
+    if shape:
+        return responses.load_raw(upload, shape)
+
+    return responses.load_images(upload)
+
+
+# a 422 with a JSON error for a photo without a detectable face
+def no_face_response(field: str) -> flask.Response:
+
+    resultjson = json.dumps({"error": f'no face detected in the {field} photo'})  # noqa: E501
+
+    return flask.Response(response=resultjson, status=422,
+                          mimetype='application/json')
+
+
+# a 400 with a JSON error for a score type other than cosine/euclidean
+def unknown_score_type(score_type: str) -> flask.Response:
+
+    resultjson = json.dumps({"error": f'unknown score type {score_type}, expected one of {", ".join(SCORE_TYPES)}'})  # noqa: E501
+
+    return flask.Response(response=resultjson, status=400,
+                          mimetype='application/json')
+
+
+# times a block as one stage of the current request
+def stage(name: str) -> object:
+
+    return metrics.stage(request.endpoint, name)
+
+
+# generate embeddings for a list of cropped faces, in chunks of up to
+# MAX_BATCH_SIZE faces to keep memory use bounded
+def embed_in_chunks(face_crops: list, logits: bool) -> object:
+
+    chunk = int(os.environ.get('MAX_BATCH_SIZE', 32))
 
+    return torch.cat([inferencing.embed_faces(
+        torch.stack(face_crops[i:i + chunk]), logits)
+        for i in range(0, len(face_crops), chunk)])
 
-# loading images
-# TODO: may need to add transformations in the future
-def load_images(image: object) -> object:
 
-    with Image.open(image) as photo:
-        photo.load()
+# whether the enrolled references are classifier logits or 512-d embeddings,
+# None (i.e., the default head) for an empty store
+def gallery_logit_space() -> bool:
 
-    app.logger.info('photo loaded')
+    if store.dim is None:
+        return None
 
-    return photo
+    return photo_match.logit_space(store.dim)
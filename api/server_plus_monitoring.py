@@ -8,13 +8,14 @@ import flask
 import json
 import os
 import time
-import torch
 from PIL import Image
 from flask import Flask, request
+from embedding_format import EmbeddingFormat
 from photo_inferencing import Inferencing
-from score_service import SimilarityScore
+from score_service import SCORE_TYPES, SimilarityScore
 from logging_util import logger
 from monitoring import ReportingCommunication
+from monitoring_publisher import MonitoringPublisher
 
 app = Flask('Identity')
 
@@ -40,6 +41,19 @@ logger.info('Communications class instantiated')
 
 MONITORING_TOPIC = os.environ['MONITORING_TOPIC']
 
+# publishing happens on a background thread, requests just queue an event,
+# events are sent as one aggregated message per MONITORING_FLUSH_SECONDS
+monitor = MonitoringPublisher(
+    mqttClient, MONITORING_TOPIC,
+    qos=int(os.environ.get('MQTT_QOS', 1)),
+    flush_interval=float(os.environ.get('MONITORING_FLUSH_SECONDS', 1)),
+    max_queue=int(os.environ.get('MONITORING_QUEUE_SIZE', 10000)),
+    spool_path=os.environ.get('MONITORING_SPOOL_PATH',
+                              'monitoring_spool.jsonl'),
+    max_spool_mb=float(os.environ.get('MONITORING_SPOOL_MB', 64)),
+    include_events=os.environ.get('MONITORING_INCLUDE_EVENTS',
+                                  'false').lower() == 'true')
+
 
 # endpoint for API health check
 # the "ping" endpoint is one that is required by AWS
@@ -61,11 +75,14 @@ def health():
 @app.route("/identity", methods=['POST'])
 def embeddings():
 
-    score_type = request.form.get('type')
+    score_type = request.form.get('type', 'cosine')
     threshold = request.form.get('threshold')
 
     logger.info(f'Request received at endpoint for photo pairs, score type: {score_type}, and match threshold: {threshold}')  # noqa: E501
 
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
     # python parses the data as a string and we need it to be a float to
     # be used for scoring
     threshold = float(threshold)
@@ -85,21 +102,22 @@ def embeddings():
     # generate pair of tensors
     # timing inferencing latency defined, which is just the time for
     #  the ML code to run
-    start = time.time()
+    start = time.perf_counter()
 
     ref_tensor, sample_tensor = photo_match.\
         identity_verify(ref_img, sample_img)
 
-    end = time.time()
+    end = time.perf_counter()
 
-    latency = 1000 * round((end - start), 2)
+    latency = round(1000 * (end - start), 2)
     logger.info(f'Facial embeddings generated, inferencing latency: {latency} ms')  # noqa: E501
 
-    resultjson = build_response(latency, ref_tensor, sample_tensor,
-                                score_type, threshold)
+    results = build_response(latency, ref_tensor, sample_tensor,
+                             score_type, threshold)
+    resultjson = json.dumps(results)
 
     # send data to MQTT topic for data logging/real time monitoring
-    send_monitoring_message(resultjson)
+    send_monitoring_message(results, latency)
 
     logger.info('response sent back to client')
     return flask.Response(response=resultjson, status=200,
@@ -111,18 +129,22 @@ def embeddings():
 def cached():
 
     # parse score type and threshold from POST request
-    score_type = request.form.get('type')
+    score_type = request.form.get('type', 'cosine')
     threshold = request.form.get('threshold')
 
     logger.info(f'Request received at cached data endpoint, score type: {score_type}, match threshold: {threshold}')  # noqa: E501
 
+    if score_type not in SCORE_TYPES:
+        return unknown_score_type(score_type)
+
     # python parses the data as a string as we need it to be a float
     # to be used for scoring
     threshold = float(threshold)
 
-    # parse and load PyTorch tensor
+    # parse and load the reference, .femb or a legacy .pt file
     ref = request.files['reference']
-    cached_tensor = torch.load(ref)
+    cached_tensor = EmbeddingFormat.from_bytes(ref.read()).\
+        to(photo_match.device)
 
     # retrieve sample photo
     sample_file = request.files['sample']
@@ -133,38 +155,46 @@ def cached():
     # generate embeddings for sample photo
     # timing inferencing latency defined, which is just the time for
     # the ML code to run
-    start = time.time()
+    start = time.perf_counter()
+
+    # score in the same space as the reference, i.e., references cached
+    # before the switch to 512-d embeddings hold classifier logits
+    logits = photo_match.logit_space(cached_tensor.shape[-1])
+    sample_tensor = photo_match.cached_reference(sample_img, logits)
 
-    sample_tensor = photo_match.cached_reference(sample_img)
+    if sample_tensor is None:
+        resultjson = json.dumps({"error": "no face detected in the sample photo"})  # noqa: E501
+        return flask.Response(response=resultjson, status=422,
+                              mimetype='application/json')
 
-    end = time.time()
+    end = time.perf_counter()
 
-    latency = 1000 * round((end - start), 2)
+    latency = round(1000 * (end - start), 2)
 
     logger.info(f'Facial embedding generated for sample photo, inferencing latency: {latency}')  # noqa: E501
 
     # send data to the method that does the similarity calculations
     # and builds response payload
-    resultjson = build_response(latency, cached_tensor, sample_tensor,
-                                score_type, threshold)
+    results = build_response(latency, cached_tensor, sample_tensor,
+                             score_type, threshold)
+    resultjson = json.dumps(results)
     logger.info(resultjson)
 
     # send data to MQTT topic for data logging/real time monitoring
-    send_monitoring_message(resultjson)
+    send_monitoring_message(results, latency)
 
     return flask.Response(response=resultjson, status=200,
                           mimetype='application/json')
 
 
-# method that aggregates data, prepares json response and sends the data
-# back to the client
+# method that aggregates data and prepares the response payload
 # TODO: move this and the methods below to a separate class, add field
 # for the endpoint the data was received on.
 def build_response(latency: float, tensor1: object, tensor2: object,
-                   score_type: float, threshold: float) -> dict:
+                   score_type: str, threshold: float) -> dict:
 
-    # generate score
-    score = scoring.cosine_score(tensor1, tensor2)
+    # generate score, cosine distance unless euclidean is specified
+    score = scoring.score(tensor1, tensor2, score_type)
     logger.info('similarity score calculated')
 
     # get match status
@@ -185,9 +215,7 @@ def build_response(latency: float, tensor1: object, tensor2: object,
                "score_threshold": threshold,
                "inferencing_latency": latency_message}
 
-    resultjson = json.dumps(results)
-
-    return resultjson
+    return results
 
 
 # loading images
@@ -202,13 +230,27 @@ def load_images(image: object) -> object:
     return photo
 
 
-# TODO: add QOS parameters and message re-send logic
-def send_monitoring_message(message: dict):
+# a 400 with a JSON error for a score type other than cosine/euclidean
+def unknown_score_type(score_type: str) -> flask.Response:
+
+    resultjson = json.dumps({"error": f'unknown score type {score_type}, expected one of {", ".join(SCORE_TYPES)}'})  # noqa: E501
+
+    return flask.Response(response=resultjson, status=400,
+                          mimetype='application/json')
+
+
+# queue the request's results for the monitoring publisher, doesn't block
+def send_monitoring_message(message: dict, latency: float):
+
+    monitor.report(dict(message, endpoint=request.path, latency_ms=latency))
 
-    try:
-        result = mqttClient.publish(MONITORING_TOPIC, message)
-        status = result[0]
-        logger.info(f'Monitoring message sent successfully with status {status}')  # noqa: E501
 
-    except Exception as e:
-        logger.error(f'MQTT publishing failed with error: {e}')
+# endpoint with the monitoring publisher's counters: events queued,
+# published, spooled and dropped
+@app.route("/monitoring_stats", methods=['GET'])
+def monitoring_stats():
+
+    resultjson = json.dumps(monitor.stats())
+
+    return flask.Response(response=resultjson, status=200,
+                          mimetype='application/json')
@@ -16,12 +16,35 @@ class TestLogConfiguration(unittest.TestCase):
         # URL to check that the API is working properly
         self.health = 'http://0.0.0.0:6000/ping'
 
+        # readiness, i.e., the models have been warmed up
+        self.ready = 'http://0.0.0.0:6000/ready'
+
         # a pair of photos to be verified
         self.photo_pair = 'http://0.0.0.0:6000/identity'
 
         # a photo and a previously computed tensor of the reference photo
         self.photo_tensor = 'http://0.0.0.0:6000/cached_data'
 
+        # several reference/sample pairs in one request
+        self.batch = 'http://0.0.0.0:6000/identity/batch'
+
+        # a photo searched against the gallery of cached tensors
+        self.gallery_search = 'http://0.0.0.0:6000/search'
+
+        # every face in a photo matched against a reference
+        self.group_photo = 'http://0.0.0.0:6000/faces'
+
+        # a sequence of frames with face tracking, streams NDJSON back
+        self.video = 'http://0.0.0.0:6000/video'
+
+        # per stage latency histograms in the Prometheus text format
+        self.metrics = 'http://0.0.0.0:6000/metrics'
+
+        # enrollment endpoints for the embedding store
+        self.enroll = 'http://0.0.0.0:6000/enroll'
+        self.unenroll = 'http://0.0.0.0:6000/unenroll'
+        self.identities = 'http://0.0.0.0:6000/identities'
+
         # define our test photos
         self.reference = 'images/Allyson_Felix_0001.jpg'
         self.evaluated = 'images/Allyson_Felix_0002.jpg'
@@ -41,6 +64,20 @@ class TestLogConfiguration(unittest.TestCase):
 
         self.assertEqual(status, 200, 'API not running')
 
+    # the API should only report ready once warm-up is done, with the
+    # model load and warm-up times
+    def test_ready(self):
+
+        response = requests.get(self.ready)
+        parsedResponse = json.loads(response.text)
+
+        self.assertEqual(response.status_code, 200, 'API not ready')
+        self.assertTrue(parsedResponse['ready'], 'API not ready')
+        self.assertIsNotNone(parsedResponse['warm_up(ms)'],
+                             'Warm-up time is missing')
+        self.assertIsNotNone(parsedResponse['model_load(ms)'],
+                             'Model load time is missing')
+
     # testing the endpoint you present two photos to for verification
     def test_twoPhotos(self):
 
@@ -132,6 +169,216 @@ class TestLogConfiguration(unittest.TestCase):
         self.assertIsNotNone(response['inferencing_latency(ms)'],
                              "The latency data is missing")
 
+    # upload a cached tensor with a reference ID, then send just the ID. The
+    # cache is per worker, so with several workers the ID-only request can
+    # land on one that hasn't seen the upload and get a 404, in which case
+    # the reference is uploaded again, like a client would.
+    def test_cached_reference_id(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35,
+                   'reference_id': 'aaron_sorkin_test'}
+
+        for attempt in range(10):
+
+            files = {'reference': open(self.reference_b, 'rb'),
+                     'sample': open(self.evaluated_b, 'rb')}
+
+            response = requests.post(self.photo_tensor, data=payload,
+                                     files=files)
+
+            for file in files.values():
+                file.close()
+
+            response = json.loads(response.text)
+            self.assertEqual(response['reference_id'], 'aaron_sorkin_test',
+                             "The reference ID is wrong")
+
+            files = {'sample': open(self.evaluated_b, 'rb')}
+
+            response = requests.post(self.photo_tensor, data=payload,
+                                     files=files)
+
+            for file in files.values():
+                file.close()
+
+            if response.status_code != 404:
+                break
+
+        self.assertEqual(response.status_code, 200,
+                         "The reference ID wasn't found in the cache")
+
+        response = json.loads(response.text)
+        self.assertEqual(response['score'], 0.28,
+                         "The Cosine Distance is wrong")
+
+    # testing the batch endpoint with a matching pair of photos, a non
+    # matching pair and a cached tensor + photo pair
+    def test_batch(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35}
+
+        files = [('reference', open(self.reference, 'rb')),
+                 ('sample', open(self.evaluated, 'rb')),
+                 ('reference', open(self.reference_a, 'rb')),
+                 ('sample', open(self.evaluated_a, 'rb')),
+                 ('reference', open(self.reference_b, 'rb')),
+                 ('sample', open(self.evaluated_b, 'rb'))]
+
+        response = requests.post(self.batch, data=payload, files=files)
+
+        for name, file in files:
+            file.close()
+
+        # convert the JSON string to a python dictionary
+        response = json.loads(response.text)
+        match_status = [result['match_status']
+                        for result in response['results']]
+
+        self.assertEqual(response['pairs'], 3, "The pair count is wrong")
+        self.assertEqual(match_status, [1, 0, 1],
+                         "The Match Status is Wrong")
+        self.assertIsNotNone(response['inferencing_latency(ms)'],
+                             "The latency data is missing")
+
+    # testing the gallery search endpoint, the gallery is built from the
+    # cpu_tensors folder, so the best match should be the cached tensor
+    # for the same person
+    def test_search(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35, 'top_k': 1}
+
+        files = {'sample': open(self.evaluated_b, 'rb')}
+
+        response = requests.post(self.gallery_search, data=payload,
+                                 files=files)
+
+        for file in files.values():
+            file.close()
+
+        # convert the JSON string to a python dictionary
+        response = json.loads(response.text)
+        best_match = response['matches'][0]
+
+        self.assertEqual(best_match['identity'], 'Aaron_Sorkin_0001',
+                         "The best match is wrong")
+        self.assertEqual(best_match['match_status'], 1,
+                         "The Match Status is Wrong")
+        self.assertEqual(best_match['score'], 0.28,
+                         "The Cosine Distance is wrong")
+        self.assertIsNotNone(response['inferencing_latency(ms)'],
+                             "The latency data is missing")
+
+    # testing the group photo endpoint, at least one of the faces in the
+    # sample photo should match the reference photo
+    def test_faces(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35}
+
+        files = {'reference': open(self.reference, 'rb'),
+                 'sample': open(self.evaluated, 'rb')}
+
+        response = requests.post(self.group_photo, data=payload, files=files)
+
+        for file in files.values():
+            file.close()
+
+        # convert the JSON string to a python dictionary
+        response = json.loads(response.text)
+
+        self.assertGreaterEqual(response['face_count'], 1,
+                                "No faces detected")
+        self.assertEqual(len(response['faces']), response['face_count'],
+                         "Face count doesn't match the results")
+        self.assertIn(1, [face['match_status'] for face in response['faces']],
+                      "The Match Status is Wrong")
+
+    # the same photo as a three frame sequence should give one track that
+    # matches the reference, followed by the summary line
+    def test_video(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35,
+                   'keyframe_interval': 1}
+
+        files = [('reference', open(self.reference, 'rb'))] + \
+            [('frames', open(self.evaluated, 'rb')) for frame in range(3)]
+
+        response = requests.post(self.video, data=payload, files=files)
+
+        for field, file in files:
+            file.close()
+
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        tracks, summary = lines[:-1], lines[-1]
+
+        self.assertEqual(summary['frames'], 3, "Frame count is wrong")
+        self.assertEqual(len(tracks), 1, "Expected a single face track")
+        self.assertEqual(tracks[0]['detections'], 3,
+                         "Track wasn't followed across the frames")
+        self.assertEqual(tracks[0]['match_status'], 1,
+                         "The Match Status is Wrong")
+
+    # enroll an identity from a photo, check that it's listed and then
+    # remove it again
+    def test_enrollment(self):
+
+        payload = {'identity': 'enrollment_test'}
+
+        files = {'reference': open(self.reference, 'rb')}
+
+        response = requests.post(self.enroll, data=payload, files=files)
+
+        for file in files.values():
+            file.close()
+
+        self.assertEqual(response.status_code, 200, "Enrollment failed")
+
+        response = json.loads(requests.get(self.identities).text)
+        self.assertIn('enrollment_test', response['identities'],
+                      "Enrolled identity is missing")
+
+        response = requests.post(self.unenroll, data=payload)
+        self.assertEqual(response.status_code, 200, "Unenrollment failed")
+
+        response = json.loads(requests.get(self.identities).text)
+        self.assertNotIn('enrollment_test', response['identities'],
+                         "Removed identity is still listed")
+
+    # after a verification request the per stage histograms should be there.
+    # The metrics are per process, so with several workers the scrape can
+    # land on one that hasn't handled a verification yet, the request is
+    # repeated until the worker answering the scrape has.
+    def test_metrics(self):
+
+        payload = {'type': "cosine", 'threshold': 0.35}
+        stages = ('parse', 'decode', 'detection', 'embedding', 'scoring',
+                  'serialization')
+
+        for attempt in range(10):
+
+            files = {'reference': open(self.reference, 'rb'),
+                     'sample': open(self.evaluated, 'rb')}
+
+            requests.post(self.photo_pair, data=payload, files=files)
+
+            for file in files.values():
+                file.close()
+
+            response = requests.get(self.metrics)
+
+            self.assertEqual(response.status_code, 200,
+                             "Metrics request failed")
+
+            if all(f'endpoint="embeddings",stage="{stage}"' in response.text
+                   for stage in stages):
+                break
+
+        for stage in stages:
+            self.assertIn(f'endpoint="embeddings",stage="{stage}"',
+                          response.text, f"{stage} latency is missing")
+
+        self.assertIn('facenet_requests_in_flight', response.text,
+                      "In-flight gauge is missing")
+
 
 if __name__ == '__main__':
     unittest.main()
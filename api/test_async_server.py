@@ -0,0 +1,99 @@
+# Tests for the aiohttp server (async_server.py) via aiohttp's test client,
+# i.e., in process, no need for the API to be up: the /identity and
+# /cached_data contract (same scores as server.py, see test.py), unknown score
+# types and the 429 when the model queue is full.
+# Run with: python -m unittest test_async_server
+import unittest
+from unittest import mock
+from aiohttp import FormData
+from aiohttp.test_utils import AioHTTPTestCase
+import async_server
+
+
+class TestAsyncServer(AioHTTPTestCase):
+
+    async def get_application(self):
+
+        return async_server.app
+
+    # multipart form with the score settings and the given files
+    @staticmethod
+    def form(files: dict, score_type: str = 'cosine') -> FormData:
+
+        data = FormData()
+        data.add_field('type', score_type)
+        data.add_field('threshold', '0.35')
+
+        for field, path in files.items():
+            with open(path, 'rb') as file:
+                data.add_field(field, file.read(), filename=path)
+
+        return data
+
+    async def test_health(self):
+
+        response = await self.client.get('/ping')
+        results = await response.json()
+
+        self.assertEqual(response.status, 200, 'API not running')
+        self.assertEqual(results['API Status'], 200, 'API not running')
+
+    async def test_two_photos(self):
+
+        response = await self.client.post('/identity', data=self.form(
+            {'reference': 'images/Allyson_Felix_0001.jpg',
+             'sample': 'images/Allyson_Felix_0002.jpg'}))
+        results = await response.json()
+
+        self.assertEqual(response.status, 200, "Request failed")
+        self.assertEqual(results['match_status'], 1,
+                         "The Match Status is Wrong")
+        self.assertEqual(results['score'], 0.215,
+                         "The Cosine Distance is wrong")
+        self.assertEqual(results['score_type'], 'cosine',
+                         "The score type is wrong")
+        self.assertIsNotNone(results['inferencing_latency(ms)'],
+                             "The latency data is missing")
+        self.assertIn('X-Request-ID', response.headers,
+                      "The correlation ID is missing")
+
+    async def test_cached_data(self):
+
+        response = await self.client.post('/cached_data', data=self.form(
+            {'reference': 'cpu_tensors/Aaron_Sorkin_0001.pt',
+             'sample': 'images/Aaron_Sorkin_0002.jpg'}))
+        results = await response.json()
+
+        self.assertEqual(response.status, 200, "Request failed")
+        self.assertEqual(results['match_status'], 1,
+                         "The Match Status is Wrong")
+        self.assertEqual(results['score'], 0.28,
+                         "The Cosine Distance is wrong")
+
+    async def test_unknown_score_type(self):
+
+        response = await self.client.post('/identity', data=self.form(
+            {'reference': 'images/Allyson_Felix_0001.jpg',
+             'sample': 'images/Allyson_Felix_0002.jpg'}, 'manhattan'))
+
+        self.assertEqual(response.status, 400,
+                         "Unknown score type wasn't rejected")
+
+    # with the model queue full, requests are rejected rather than queued
+    async def test_queue_full(self):
+
+        with mock.patch.object(async_server.model_executor, 'max_depth', 0):
+            response = await self.client.post('/identity', data=self.form(
+                {'reference': 'images/Allyson_Felix_0001.jpg',
+                 'sample': 'images/Allyson_Felix_0002.jpg'}))
+            results = await response.json()
+
+        self.assertEqual(response.status, 429, "Full queue wasn't rejected")
+        self.assertEqual(results['error'], 'inferencing queue is full',
+                         "Wrong error message")
+        self.assertEqual(response.headers.get('Retry-After'), '1',
+                         "Retry-After header is missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# Numerical parity tests for the exported inference backends, i.e., the
+# TorchScript/ONNX models generated by deployment_utilities/export_models.py
+# are compared to the eager facenet_pytorch models on the test photos.
+# Backends that haven't been exported (or onnxruntime isn't installed) are
+# skipped. Runs in process, no need for the API to be up.
+import os
+import unittest
+import torch
+import torch.nn.functional as F
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from PIL import Image
+from model_backends import ModelBackends
+
+
+class TestBackendParity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+
+        self.export_path = os.environ.get('MODEL_EXPORT_PATH',
+                                          'exported_models')
+
+        self.photos = [Image.open(f'images/{photo}')
+                       for photo in sorted(os.listdir('images'))]
+
+        self.mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                           0.709, True, True, None,
+                           False, device='cpu').eval()
+
+        resnet = InceptionResnetV1(pretrained='vggface2',
+                                   classify=True).eval()
+        self.logits_layer = resnet.logits
+        resnet.logits = torch.nn.Identity()
+
+        with torch.inference_mode():
+            self.faces = torch.stack([self.mtcnn(photo)
+                                      for photo in self.photos])
+            self.features = resnet(self.faces)
+            self.logits = self.logits_layer(self.features)
+            self.boxes = [self.mtcnn.detect(photo)[0]
+                          for photo in self.photos]
+
+    def load(self, backend: str) -> tuple:
+
+        try:
+            return ModelBackends.load_resnet(backend, self.export_path,
+                                             'cpu')
+
+        except (FileNotFoundError, ImportError) as error:
+            self.skipTest(f'{backend} backend not available: {error}')
+
+    def check_embeddings(self, backend: str):
+
+        resnet, logits_layer = self.load(backend)
+
+        with torch.inference_mode():
+            features = resnet(self.faces)
+            logits = logits_layer(features)
+
+        similarity = F.cosine_similarity(features, self.features, dim=1)
+
+        self.assertGreater(similarity.min().item(), 0.9999,
+                           f"{backend} embeddings drifted from eager")
+        self.assertLess((logits - self.logits).abs().max().item(), 1e-2,
+                        f"{backend} logits drifted from eager")
+
+    # the same faces should be found, within a pixel
+    def check_detection(self, backend: str):
+
+        self.load(backend)
+
+        mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                      0.709, True, True, None,
+                      False, device='cpu').eval()
+        ModelBackends.load_mtcnn_nets(backend, self.export_path, mtcnn,
+                                      'cpu')
+
+        with torch.inference_mode():
+            for photo, expected in zip(self.photos, self.boxes):
+                boxes = mtcnn.detect(photo)[0]
+
+                self.assertEqual(len(boxes), len(expected),
+                                 f"{backend} found a different face count")
+                self.assertLess(abs(boxes - expected).max(), 1.0,
+                                f"{backend} face boxes drifted from eager")
+
+    def test_torchscript_embeddings(self):
+
+        self.check_embeddings('torchscript')
+
+    def test_torchscript_detection(self):
+
+        self.check_detection('torchscript')
+
+    def test_onnx_embeddings(self):
+
+        self.check_embeddings('onnx')
+
+    def test_onnx_detection(self):
+
+        self.check_detection('onnx')
+
+
+if __name__ == '__main__':
+    unittest.main()
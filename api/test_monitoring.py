@@ -0,0 +1,178 @@
+# Tests for the monitoring publisher against an in-process stand-in for the
+# MQTT broker, i.e., no broker or paho needed: batching/aggregation, drop
+# counters, spooling while the broker is down and re-sending once it's back.
+# Run with: python -m unittest test_monitoring
+import json
+import os
+import tempfile
+import unittest
+from monitoring_publisher import MonitoringPublisher
+
+
+# stands in for paho's MQTTMessageInfo
+class StandInMessage:
+
+    def __init__(self, rc: int):
+
+        self.rc = rc
+
+    def wait_for_publish(self, timeout: float = None):
+
+        pass
+
+    def is_published(self) -> bool:
+
+        return self.rc == 0
+
+
+# stands in for a paho client connected to a broker, records what it
+# receives, can be "disconnected" to simulate a broker outage
+class StandInBroker:
+
+    def __init__(self):
+
+        self.connected = True
+        self.received = []
+
+        # disconnects after this many more messages, e.g., mid-resend
+        self.remaining = None
+
+    def is_connected(self) -> bool:
+
+        return self.connected
+
+    def publish(self, topic: str, payload: str, qos: int) -> StandInMessage:
+
+        if self.remaining == 0:
+            self.connected = False
+
+        if not self.connected:
+            return StandInMessage(4)
+
+        if self.remaining is not None:
+            self.remaining -= 1
+
+        self.received.append((topic, json.loads(payload), qos))
+
+        return StandInMessage(0)
+
+
+class TestMonitoringPublisher(unittest.TestCase):
+
+    def setUp(self):
+
+        self.broker = StandInBroker()
+        self.folder = tempfile.TemporaryDirectory()
+        self.spool_path = os.path.join(self.folder.name, 'spool.jsonl')
+
+        # long flush interval, the tests flush explicitly
+        self.publisher = MonitoringPublisher(
+            self.broker, 'monitoring', qos=1, flush_interval=3600,
+            max_queue=100, spool_path=self.spool_path)
+
+    def tearDown(self):
+
+        self.publisher.close()
+        self.folder.cleanup()
+
+    def report(self, count: int, match_status: int = 1):
+
+        for latency in range(count):
+            self.publisher.report({"match_status": match_status,
+                                   "latency_ms": float(latency)})
+
+    # events are aggregated into one message per flush
+    def test_aggregation(self):
+
+        self.report(10)
+        self.report(5, match_status=0)
+        self.publisher.flush()
+
+        self.assertEqual(len(self.broker.received), 1,
+                         "Events weren't batched")
+
+        topic, message, qos = self.broker.received[0]
+
+        self.assertEqual((topic, qos), ('monitoring', 1), "Wrong topic/QoS")
+        self.assertEqual(message['requests'], 15, "Wrong request count")
+        self.assertEqual(message['matches'], 10, "Wrong match count")
+        self.assertEqual(message['non_matches'], 5, "Wrong non-match count")
+        self.assertEqual(message['latency_ms']['count'], 15,
+                         "Wrong latency count")
+        self.assertEqual(message['latency_ms']['max'], 9.0,
+                         "Wrong max latency")
+
+    # events beyond the queue size are counted, not queued
+    def test_drop_counter(self):
+
+        self.report(150)
+
+        self.assertEqual(self.publisher.stats()['dropped'], 50,
+                         "Dropped events weren't counted")
+
+        self.publisher.flush()
+
+        self.assertEqual(self.broker.received[0][1]['requests'], 100,
+                         "Wrong request count")
+        self.assertEqual(self.broker.received[0][1]['dropped'], 50,
+                         "Drop count missing from the message")
+
+    # messages are spooled during an outage and re-sent in order afterwards
+    def test_spool_and_resend(self):
+
+        self.broker.connected = False
+
+        for count in (1, 2, 3):
+            self.report(count)
+            self.publisher.flush()
+
+        self.assertEqual(self.broker.received, [], "Published while down")
+        self.assertEqual(self.publisher.stats()['spooled'], 3,
+                         "Messages weren't spooled")
+
+        self.broker.connected = True
+        self.report(4)
+        self.publisher.flush()
+
+        self.assertEqual([message['requests'] for topic, message, qos
+                          in self.broker.received], [1, 2, 3, 4],
+                         "Spooled messages weren't re-sent in order")
+        self.assertFalse(os.path.exists(self.spool_path),
+                         "Spool wasn't emptied")
+
+        self.assertFalse(os.path.exists(f'{self.spool_path}.sending'),
+                         "Messages being re-sent weren't cleaned up")
+
+    # an outage partway through a resend doesn't lose or reorder messages
+    def test_resend_interrupted(self):
+
+        self.broker.connected = False
+
+        for count in (1, 2, 3):
+            self.report(count)
+            self.publisher.flush()
+
+        self.broker.connected = True
+        self.broker.remaining = 1
+        self.report(4)
+        self.publisher.flush()
+
+        self.assertEqual([message['requests'] for topic, message, qos
+                          in self.broker.received], [1],
+                         "Wrong messages re-sent before the outage")
+
+        self.broker.connected = True
+        self.broker.remaining = None
+        self.report(5)
+        self.publisher.flush()
+
+        self.assertEqual([message['requests'] for topic, message, qos
+                          in self.broker.received], [1, 2, 3, 4, 5],
+                         "Spooled messages were lost or reordered")
+        self.assertFalse(os.path.exists(self.spool_path) or
+                         os.path.exists(f'{self.spool_path}.sending'),
+                         "Spool wasn't emptied")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Flask based API wrapper around the Facenet-PyTorch facial recognition library
+# Face tracking for video/frame sequences: MTCNN only runs on every
+# keyframe_interval-th frame, detections are linked into tracks by IoU with
+# the track's predicted box (constant velocity between keyframes), and each
+# track keeps its best few crops (by detection probability and face size).
+# Only those crops get embedded, once the track ends, instead of running
+# detection + embedding on every frame.
+import heapq
+import itertools
+import os
+import tempfile
+import torch
+from PIL import Image, ImageSequence
+from logging_util import logger
+
+
+class FaceTrack:
+
+    def __init__(self, track_id: int, frame: int, box: list, prob: float,
+                 crop: object, best_crops: int):
+
+        self.track_id = track_id
+        self.first_frame = frame
+        self.last_frame = frame
+        self.box = torch.tensor(box, dtype=torch.float32)
+
+        # box change per frame, estimated from consecutive detections
+        self.velocity = torch.zeros(4)
+        self.detections = 0
+        self.misses = 0
+
+        # min heap of (quality, frame, crop), i.e., the worst crop is first
+        self.best_crops = best_crops
+        self.crops = []
+
+        self.update(frame, box, prob, crop)
+
+    # where the face should be on a given frame
+    def predict(self, frame: int) -> object:
+
+        return self.box + self.velocity * (frame - self.last_frame)
+
+    def update(self, frame: int, box: list, prob: float, crop: object):
+
+        box = torch.tensor(box, dtype=torch.float32)
+
+        if self.detections:
+            self.velocity = (box - self.box) / (frame - self.last_frame)
+
+        self.box = box
+        self.last_frame = frame
+        self.detections += 1
+        self.misses = 0
+
+        # bigger, more confident detections make better crops
+        quality = prob * min(box[2] - box[0], box[3] - box[1]).item()
+
+        # kept crops are copied, the crop is a view into the keyframe's
+        # whole batch of crops, which would otherwise be kept alive as long
+        # as the track
+        if len(self.crops) < self.best_crops:
+            heapq.heappush(self.crops, (quality, frame, crop.clone()))
+
+        elif quality > self.crops[0][0]:
+            heapq.heapreplace(self.crops, (quality, frame, crop.clone()))
+
+    # the kept crops, best first
+    def best(self) -> list:
+
+        return [crop for quality, frame, crop
+                in sorted(self.crops, key=lambda entry: -entry[0])]
+
+    def summary(self) -> dict:
+
+        return {"track": self.track_id,
+                "first_frame": self.first_frame,
+                "last_frame": self.last_frame,
+                "detections": self.detections,
+                "box": [round(value, 1) for value in self.box.tolist()],
+                "crops": len(self.crops)}
+
+
+class FaceTracker:
+
+    # detector: takes a frame, returns (faces, boxes, probs) like
+    # Inferencing.detect_faces. A track ends once it hasn't been matched on
+    # max_misses keyframes in a row.
+    def __init__(self, detector: object, keyframe_interval: int = 5,
+                 iou_threshold: float = 0.3, max_misses: int = 2,
+                 best_crops: int = 3, min_probability: float = 0.9):
+
+        self.detector = detector
+        self.keyframe_interval = max(keyframe_interval, 1)
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.best_crops = best_crops
+        self.min_probability = min_probability
+
+        self.tracks = []
+        self.track_ids = itertools.count()
+        self.frames = 0
+        self.keyframes = 0
+
+    # (N x 4) vs (M x 4) IoU matrix for [x1, y1, x2, y2] boxes
+    @staticmethod
+    def box_iou(boxes1: object, boxes2: object) -> object:
+
+        area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+        area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+        top_left = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+        bottom_right = torch.min(boxes1[:, None, 2:], boxes2[None, :, 2:])
+        overlap = (bottom_right - top_left).clamp(min=0).prod(dim=2)
+
+        return overlap / (area1[:, None] + area2[None, :] - overlap)
+
+    # process one frame, load() returns the decoded frame and is only called
+    # on keyframes. Returns the tracks that ended.
+    def process(self, frame: int, load: object) -> list:
+
+        self.frames += 1
+
+        if frame % self.keyframe_interval:
+            return []
+
+        self.keyframes += 1
+
+        faces, boxes, probs = self.detector(load())
+
+        detections = [(box, prob, face) for box, prob, face
+                      in zip(boxes, probs, faces if faces is not None else [])
+                      if prob >= self.min_probability]
+
+        matched = self.associate(frame, detections)
+
+        for index, (box, prob, face) in enumerate(detections):
+            if index not in matched:
+                self.tracks.append(FaceTrack(next(self.track_ids), frame, box,
+                                             prob, face, self.best_crops))
+
+        return self.expire()
+
+    # greedy matching of detections to tracks, highest IoU first, returns
+    # the indices of the detections that were matched
+    def associate(self, frame: int, detections: list) -> set:
+
+        matched = set()
+
+        if not self.tracks or not detections:
+            for track in self.tracks:
+                track.misses += 1
+
+            return matched
+
+        predicted = torch.stack([track.predict(frame)
+                                 for track in self.tracks])
+        boxes = torch.tensor([box for box, prob, face in detections],
+                             dtype=torch.float32)
+        iou = self.box_iou(predicted, boxes)
+
+        updated = set()
+
+        for position in torch.argsort(iou.flatten(), descending=True).tolist():
+            track_index, detection_index = divmod(position, len(detections))
+
+            if iou[track_index, detection_index] < self.iou_threshold:
+                break
+
+            if track_index in updated or detection_index in matched:
+                continue
+
+            box, prob, face = detections[detection_index]
+            self.tracks[track_index].update(frame, box, prob, face)
+
+            updated.add(track_index)
+            matched.add(detection_index)
+
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in updated:
+                track.misses += 1
+
+        return matched
+
+    def expire(self) -> list:
+
+        ended = [track for track in self.tracks
+                 if track.misses > self.max_misses]
+        self.tracks = [track for track in self.tracks
+                       if track.misses <= self.max_misses]
+
+        return ended
+
+    # end of the stream, all remaining tracks end
+    def finish(self) -> list:
+
+        ended = self.tracks
+        self.tracks = []
+
+        return ended
+
+
+# frames from a list of uploaded photos, load_frame decodes one upload
+def upload_frames(uploads: list, load_frame: object):
+
+    for frame, upload in enumerate(uploads):
+        yield frame, lambda upload=upload: load_frame(upload)
+
+
+# frames from an uploaded video. With OpenCV installed (opencv-python,
+# optional) any format it can read is supported, frames that aren't
+# keyframes are only grabbed, not converted. Without it, multi-frame images
+# PIL can read, e.g., animated GIFs, are supported.
+def video_frames(upload: object):
+
+    try:
+        import cv2
+
+    except ImportError:
+        yield from image_sequence_frames(upload)
+        return
+
+    # OpenCV reads from a path, not a stream
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(
+            upload.filename or '')[1]) as file:
+        upload.save(file)
+        file.flush()
+
+        capture = cv2.VideoCapture(file.name)
+
+        if not capture.isOpened():
+            raise ValueError('unsupported video format')
+
+        try:
+            for frame in itertools.count():
+
+                if not capture.grab():
+                    break
+
+                yield frame, lambda: Image.fromarray(
+                    cv2.cvtColor(capture.retrieve()[1], cv2.COLOR_BGR2RGB))
+
+        finally:
+            capture.release()
+
+    logger.info('video decoded')
+
+
+# runs a frame generator up to its first frame, i.e., opens the video, so an
+# upload that can't be read fails before a response is started. Returns the
+# frames incl. the first one, raises a ValueError if there aren't any.
+def first_frame_checked(frames: object) -> object:
+
+    try:
+        first = next(frames)
+
+    except StopIteration:
+        raise ValueError('no frames in the upload')
+
+    return itertools.chain([first], frames)
+
+
+def image_sequence_frames(upload: object):
+
+    with Image.open(upload) as image:
+        for frame, image_frame in enumerate(ImageSequence.Iterator(image)):
+            yield frame, lambda image_frame=image_frame: \
+                image_frame.convert('RGB')
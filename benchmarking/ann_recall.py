@@ -0,0 +1,113 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Recall@k benchmark for the IVF approximate nearest neighbor index in
+# api/ann_index.py: a synthetic gallery of clustered, normalized embeddings is
+# indexed and a set of noisy probes is searched with a range of nprobe
+# values, the results are compared to an exact search via SimilarityScore.
+# Usage: just run the script or edit the line at the bottom, e.g., the
+# gallery size, embedding width and number of IVF lists.
+import os
+import sys
+import numpy as np
+import torch
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
+from ann_index import IVFIndex  # noqa: E402
+from score_service import SimilarityScore  # noqa: E402
+
+
+class ANNRecall:
+
+    def __init__(self, gallery_size: int = 200000, dim: int = 512,
+                 nlist: int = 1024, probes: int = 1000, k: int = 10,
+                 nprobe_values: list = [1, 2, 4, 8, 16, 32, 64, 128]):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("ann_recall")
+
+        self.rng = np.random.default_rng(0)
+
+        gallery, queries = self.generate_data(gallery_size, dim, probes)
+
+        start = perf_counter()
+        index = IVFIndex(nlist)
+        index.attach(gallery)
+        index.add(np.arange(gallery_size))
+
+        if not index.trained:
+            index.train()
+
+        build_time = round(perf_counter() - start, 2)
+        self.logger.info(f'IVF index with {nlist} lists built in {build_time}s')  # noqa: E501
+
+        exact_rows, exact_latency = self.exact_search(gallery, queries, k)
+
+        self.run_tests(index, queries, k, exact_rows, exact_latency,
+                       nprobe_values)
+
+    # clusters of embeddings around random identities, i.e., roughly the
+    # structure of a real gallery, the probes are noisy copies of gallery
+    # rows, like a new photo of an enrolled person
+    def generate_data(self, gallery_size: int, dim: int,
+                      probes: int) -> tuple:
+
+        centers = self.rng.standard_normal((gallery_size // 20, dim))
+        assignments = self.rng.integers(0, len(centers), gallery_size)
+
+        gallery = centers[assignments] + \
+            0.5 * self.rng.standard_normal((gallery_size, dim))
+        gallery = IVFIndex.normalize(gallery)
+
+        rows = self.rng.choice(gallery_size, probes, replace=False)
+        queries = gallery[rows] + \
+            0.03 * self.rng.standard_normal((probes, dim))
+
+        return gallery, IVFIndex.normalize(queries)
+
+    def exact_search(self, gallery: np.ndarray, queries: np.ndarray,
+                     k: int) -> tuple:
+
+        start = perf_counter()
+        distances, rows = SimilarityScore.top_k(torch.from_numpy(queries),
+                                                torch.from_numpy(gallery),
+                                                k, normalized=True)
+        latency = 1000 * (perf_counter() - start) / len(queries)
+
+        return rows.numpy(), latency
+
+    def run_tests(self, index: IVFIndex, queries: np.ndarray, k: int,
+                  exact_rows: np.ndarray, exact_latency: float,
+                  nprobe_values: list):
+
+        test_data = [['exact', 1.0, round(exact_latency, 3)]]
+
+        for nprobe in nprobe_values:
+
+            start = perf_counter()
+            results = index.search(queries, k, nprobe)
+            latency = 1000 * (perf_counter() - start) / len(queries)
+
+            recall = np.mean([len(set(labels).intersection(expected)) / k
+                              for (labels, distances), expected
+                              in zip(results, exact_rows.tolist())])
+
+            test_data.append([nprobe, round(recall, 4), round(latency, 3)])
+
+        df_columns = ["nprobe",
+                      f"recall@{k}",
+                      "latency_per_probe(ms)"]
+
+        stats_df = ResultsTable(test_data, df_columns)
+
+        results = (f'ANN Recall Results: \n{stats_df}\n')
+        self.logger.info(results)
+        return stats_df
+
+
+test = ANNRecall()
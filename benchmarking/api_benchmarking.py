@@ -9,7 +9,6 @@ import json
 import os
 import requests
 import sys
-import pandas as pd
 from statistics import mean, stdev
 from time import time
 
@@ -17,6 +16,7 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
 
 
 class FacenetBenchmarking:
@@ -144,7 +144,7 @@ class FacenetBenchmarking:
                       "total_latency",
                       "matches_per_second(fps)"]
 
-        stats_df = pd.DataFrame(test_data, columns=df_columns)
+        stats_df = ResultsTable(test_data, df_columns)
 
         results = (f'Testing Results: \n{stats_df}\n')
         self.logger.info(results)
@@ -0,0 +1,131 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Compares the inference backends the API supports (INFERENCE_BACKEND):
+# eager facenet_pytorch, frozen TorchScript and ONNX Runtime on CPU. For each
+# backend it reports the time to load the models (i.e., the cold start), the
+# mean/stdev latency of detection + embedding per photo and the largest
+# difference of its embeddings vs. eager. Run
+# deployment_utilities/export_models.py first, backends that haven't been
+# exported are skipped. Usage: just run the script or edit the line at the
+# bottom.
+import os
+import sys
+import torch
+import torch.nn.functional as F
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from statistics import mean, stdev
+from PIL import Image
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
+from common_utils.general_utilities import GeneralUtils  # noqa: E402
+from model_backends import BACKENDS, ModelBackends  # noqa: E402
+
+
+class BackendBenchmarking:
+
+    # runs excluded from the latency stats
+    WARM_UP = 10
+
+    def __init__(self, photo_path: str, export_path: str):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("backend_benchmarking")
+
+        self.export_path = export_path
+
+        photo_files, photo_names = GeneralUtils.get_file_list(photo_path)
+        self.photos = [Image.open(photo).convert('RGB')
+                       for photo in photo_files]
+
+        self.run_tests()
+
+    def load_models(self, backend: str) -> tuple:
+
+        mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                      0.709, True, True, None,
+                      False, device='cpu').eval()
+
+        if backend == 'eager':
+            resnet = InceptionResnetV1(pretrained='vggface2',
+                                       classify=True).eval()
+            resnet.logits = torch.nn.Identity()
+
+            return mtcnn, resnet
+
+        ModelBackends.load_mtcnn_nets(backend, self.export_path, mtcnn,
+                                      'cpu')
+        resnet, logits_layer = ModelBackends.load_resnet(
+            backend, self.export_path, 'cpu')
+
+        return mtcnn, resnet
+
+    def time_backend(self, backend: str) -> tuple:
+
+        start = perf_counter()
+        mtcnn, resnet = self.load_models(backend)
+        load_time = 1000 * (perf_counter() - start)
+
+        latencies = []
+        embeddings = []
+
+        with torch.inference_mode():
+            for photo in self.photos:
+
+                start = perf_counter()
+                face = mtcnn(photo)
+
+                if face is None:
+                    continue
+
+                embedding = resnet(face.unsqueeze(0))
+                latencies.append(1000 * (perf_counter() - start))
+                embeddings.append(embedding)
+
+        return load_time, latencies[self.WARM_UP:], torch.cat(embeddings)
+
+    def run_tests(self):
+
+        test_data = []
+        baseline = None
+
+        for backend in BACKENDS:
+
+            try:
+                load_time, latencies, embeddings = self.time_backend(backend)
+
+            except (FileNotFoundError, ImportError) as error:
+                self.logger.info(f'Skipping {backend}: {error}')
+                continue
+
+            if baseline is None:
+                baseline = embeddings
+
+            # comparable as long as the same faces were detected
+            drift = 1 - F.cosine_similarity(embeddings, baseline).min().\
+                item() if embeddings.shape == baseline.shape else None
+
+            test_data.append([backend, round(load_time, 2),
+                              round(mean(latencies), 2),
+                              round(stdev(latencies), 2),
+                              drift])
+
+        df_columns = ["backend",
+                      "model_load(ms)",
+                      "latency(ms)",
+                      "latency_stdev(ms)",
+                      "max_cosine_drift_vs_eager"]
+
+        stats_df = ResultsTable(test_data, df_columns)
+
+        results = (f'Backend Results: \n{stats_df}\n')
+        self.logger.info(results)
+        return stats_df
+
+
+test = BackendBenchmarking("test_photos/", "../api/exported_models/")
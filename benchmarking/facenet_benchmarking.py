@@ -6,13 +6,13 @@
 # at the bottom:
 # test = FacenetBenchmarking("test_photos/", "cached_gpu_tensors/")
 # where the first parameter are your photos and the second one is
-# precomputed tensors. The script will return a dataframe with your testing
+# precomputed tensors. The script will return a results table (see
+# common_utils/results_table.py, .to_dataframe() for pandas) with your testing
 # data in it as well as write it to a log file. Make sure to match tensors
 # to the device they were created on and you're runing this test on.
 import os
 import sys
 import torch
-import pandas as pd
 import torch.nn.functional as F
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from statistics import mean, stdev
@@ -23,6 +23,7 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
 from common_utils.general_utilities import GeneralUtils  # noqa: E402
 
 
@@ -113,12 +114,15 @@ class FacenetBenchmarking:
             sample_photo = Image.open(photo)
 
             start = time()
-            # face detection
-            sample_cropped = self.mtcnn(sample_photo).to(self.device)
-            end_face = time()
 
-            sample_embeddings = self.resnet(sample_cropped.unsqueeze(0))
-            end_embedding = time()
+            # no autograd graph needed, we're only running inference
+            with torch.inference_mode():
+                # face detection
+                sample_cropped = self.mtcnn(sample_photo).to(self.device)
+                end_face = time()
+
+                sample_embeddings = self.resnet(sample_cropped.unsqueeze(0))
+                end_embedding = time()
 
             # load reference embedding
             reference_embedding = torch.load(tensor)
@@ -170,7 +174,7 @@ class FacenetBenchmarking:
                       "embedding_latency(ms)",
                       "effective_FPS"]
 
-        stats_df = pd.DataFrame(test_data, columns=df_columns)
+        stats_df = ResultsTable(test_data, df_columns)
 
         results = (f'Testing Results: \n{stats_df}\n')
         self.logger.info(results)
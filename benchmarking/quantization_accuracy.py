@@ -0,0 +1,161 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Accuracy report for quantized reference storage: every photo in the
+# benchmark photo set is scored against every cached reference tensor with
+# float32, float16 and int8 references, and the float16/int8 match statuses
+# are compared to float32. Also reports the bytes per identity and the time
+# to score against a gallery of the references tiled to gallery_rows.
+# Usage: just run the script or edit the line at the bottom, the thresholds
+# are the cosine/euclidean match thresholds to check agreement at.
+import os
+import sys
+import torch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from PIL import Image
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
+from common_utils.general_utilities import GeneralUtils  # noqa: E402
+from gallery import GalleryIndex  # noqa: E402
+from score_service import SimilarityScore  # noqa: E402
+
+
+class QuantizationAccuracy:
+
+    DTYPES = ['float32', 'float16', 'int8']
+
+    def __init__(self, photo_path: str, tensor_path: str,
+                 thresholds: dict = {'cosine': 0.35, 'euclidean': 0.9},
+                 gallery_rows: int = 20000):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("quantization_accuracy")
+
+        self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        self.mtcnn, self.resnet = self.get_models()
+
+        photo_files, photo_names = GeneralUtils.get_file_list(photo_path)
+        tensor_files, tensor_names = GeneralUtils.get_file_list(tensor_path)
+
+        # normalized up front, the gallery rows are normalized and the
+        # quantized scoring path derives euclidean distance from the dot
+        # product, so all three dtypes are compared on the same footing
+        samples = SimilarityScore.normalize(self.embed_photos(photo_files))
+        references = torch.cat([torch.load(file, map_location=self.device,
+                                           weights_only=True).reshape(1, -1)
+                                for file in tensor_files])
+
+        self.logger.info(f'{len(samples)} photos vs {len(references)} references, {references.shape[1]} wide')  # noqa: E501
+
+        self.run_report(samples, references, thresholds, gallery_rows)
+
+    def get_models(self):
+
+        mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                      0.709, True, True, None,
+                      False, device=self.device).eval()
+
+        # same head as the cached tensors, i.e., logits
+        resnet = InceptionResnetV1(pretrained='vggface2',
+                                   classify=True).eval().to(self.device)
+
+        return mtcnn, resnet
+
+    def embed_photos(self, photo_files: list) -> object:
+
+        faces = []
+
+        with torch.inference_mode():
+            for photo in photo_files:
+                face = self.mtcnn(Image.open(photo))
+
+                if face is None:
+                    self.logger.info(f'No face detected in {photo}, skipped')  # noqa: E501
+                    continue
+
+                faces.append(face)
+
+            return self.resnet(torch.stack(faces).to(self.device))
+
+    def build_gallery(self, references: object, dtype: str) -> GalleryIndex:
+
+        gallery = GalleryIndex(self.device, dtype)
+        gallery.add([str(row) for row in range(len(references))],
+                    references)
+
+        return gallery
+
+    @staticmethod
+    def distances(samples: object, gallery: GalleryIndex,
+                  score_type: str) -> object:
+
+        return SimilarityScore.distance_matrix(samples, gallery.matrix,
+                                               score_type, normalized=False,
+                                               scales=gallery.scales)
+
+    def scoring_latency(self, samples: object, gallery: GalleryIndex,
+                        gallery_rows: int) -> float:
+
+        repeats = -(-gallery_rows // len(gallery.matrix))
+        matrix = gallery.matrix.repeat(repeats, 1)[:gallery_rows]
+        scales = None if gallery.scales is None \
+            else gallery.scales.repeat(repeats)[:gallery_rows]
+
+        start = perf_counter()
+        SimilarityScore.top_k(samples, matrix, 5, normalized=False,
+                              scales=scales)
+
+        return round(1000 * (perf_counter() - start), 2)
+
+    def run_report(self, samples: object, references: object,
+                   thresholds: dict, gallery_rows: int):
+
+        galleries = {dtype: self.build_gallery(references, dtype)
+                     for dtype in self.DTYPES}
+
+        baseline = {score_type: self.distances(samples, galleries['float32'],
+                                               score_type)
+                    for score_type in thresholds}
+
+        test_data = []
+
+        for dtype, gallery in galleries.items():
+
+            row = [dtype,
+                   gallery.matrix.element_size() * gallery.matrix.shape[1] +
+                   (0 if gallery.scales is None else 4)]
+
+            for score_type, threshold in thresholds.items():
+                distances = self.distances(samples, gallery, score_type)
+                expected = SimilarityScore.match_mask(baseline[score_type],
+                                                      threshold)
+                actual = SimilarityScore.match_mask(distances, threshold)
+
+                row += [round((actual == expected).float().mean().item(), 4),
+                        round((distances - baseline[score_type]).abs().
+                              max().item(), 5)]
+
+            row.append(self.scoring_latency(samples, gallery, gallery_rows))
+            test_data.append(row)
+
+        df_columns = ["dtype", "bytes_per_identity"]
+
+        for score_type in thresholds:
+            df_columns += [f"{score_type}_agreement",
+                           f"{score_type}_max_error"]
+
+        df_columns.append(f"top5_latency_{gallery_rows}_rows(ms)")
+
+        stats_df = ResultsTable(test_data, df_columns)
+
+        results = (f'Quantization Results: \n{stats_df}\n')
+        self.logger.info(results)
+        return stats_df
+
+
+test = QuantizationAccuracy("test_photos/", "cached_cpu_tensors/")
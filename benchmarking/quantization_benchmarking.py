@@ -0,0 +1,112 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Compares float32 InceptionResnetV1 on CPU with the API's int8 quantization
+# modes (CPU_QUANTIZATION=dynamic|static). For each mode it reports the time
+# to quantize (incl. calibration), the mean/stdev latency of the embedding
+# network + classifier layer per face, and the embedding/logit drift and
+# match status agreement vs float32 on the held-out faces. Face crops come
+# from the test photos, which are also the calibration set for static
+# quantization. Usage: just run the script or edit the line at the bottom.
+import os
+import sys
+import copy
+import torch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from statistics import mean, stdev
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
+from model_quantization import ModelQuantization  # noqa: E402
+
+
+class QuantizationBenchmarking:
+
+    # runs excluded from the latency stats
+    WARM_UP = 10
+
+    def __init__(self, photo_path: str, threshold: float = 0.35):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("quantization_benchmarking")
+
+        self.photo_path = photo_path
+        self.threshold = threshold
+
+        self.mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                           0.709, True, True, None,
+                           False, device='cpu').eval()
+
+        self.resnet = InceptionResnetV1(pretrained='vggface2',
+                                        classify=True).eval()
+        self.logits_layer = self.resnet.logits
+        self.resnet.logits = torch.nn.Identity()
+
+        self.faces = ModelQuantization.load_faces(self.mtcnn, photo_path)
+
+        self.run_tests()
+
+    def time_model(self, resnet: object, logits_layer: object) -> list:
+
+        latencies = []
+
+        with torch.inference_mode():
+            for face in self.faces:
+
+                start = perf_counter()
+                logits_layer(resnet(face.unsqueeze(0)))
+                latencies.append(1000 * (perf_counter() - start))
+
+        return latencies[self.WARM_UP:]
+
+    def run_tests(self):
+
+        test_data = []
+
+        latencies = self.time_model(self.resnet, self.logits_layer)
+        test_data.append(['float32', None, round(mean(latencies), 2),
+                          round(stdev(latencies), 2)] + [None] * 6)
+
+        for mode in ('dynamic', 'static'):
+
+            # quantize_dynamic swaps the modules in place
+            start = perf_counter()
+            resnet, logits_layer, report = ModelQuantization.quantize(
+                mode, copy.deepcopy(self.resnet),
+                copy.deepcopy(self.logits_layer), self.mtcnn,
+                self.photo_path, self.threshold)
+            quantize_time = 1000 * (perf_counter() - start)
+
+            latencies = self.time_model(resnet, logits_layer)
+
+            test_data.append([mode, round(quantize_time, 2),
+                              round(mean(latencies), 2),
+                              round(stdev(latencies), 2)] +
+                             [report[space][metric]
+                              for space in ('embedding', 'logits')
+                              for metric in ('mean_drift', 'max_drift',
+                                             'match_agreement')])
+
+        df_columns = ["model",
+                      "quantize(ms)",
+                      "latency(ms)",
+                      "latency_stdev(ms)",
+                      "embedding_mean_drift",
+                      "embedding_max_drift",
+                      "embedding_match_agreement",
+                      "logits_mean_drift",
+                      "logits_max_drift",
+                      "logits_match_agreement"]
+
+        stats_df = ResultsTable(test_data, df_columns)
+
+        results = (f'Quantization Results, {len(self.faces)} faces, match threshold {self.threshold}: \n{stats_df}\n')  # noqa: E501
+        self.logger.info(results)
+        return stats_df
+
+
+test = QuantizationBenchmarking("test_photos/")
@@ -0,0 +1,136 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Startup profiling for the API: imports server.py (or any other API module)
+# in a fresh interpreter with python -X importtime, i.e., the same cold start
+# as a new container or worker, and reports the wall time per run plus an
+# import time breakdown per top level package (self time, so nothing is
+# counted twice). A module's self time is its body, for server.py that's
+# building the models, loading the embedding store, etc. Pass environment
+# variables to compare startup paths, e.g., MODEL_WEIGHTS_PATH or
+# INFERENCE_BACKEND. Usage: just run the script or edit the line at the
+# bottom.
+import os
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.results_table import ResultsTable  # noqa: E402
+
+
+class StartupProfiling:
+
+    def __init__(self, module: str = 'server', runs: int = 3, top: int = 15,
+                 environment: dict = None):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("startup_profiling")
+
+        self.api_path = os.path.join(parent_dir, 'api')
+        self.module = module
+        self.runs = runs
+        self.top = top
+
+        # the warm-up runs on a background thread after the import, it's not
+        # part of the import time
+        self.environment = dict(os.environ, WARM_UP_ON_IMPORT='false',
+                                **(environment or {}))
+
+        self.run_tests()
+
+    # one cold start, returns the wall time (s) and the import time entries
+    def profile(self) -> tuple:
+
+        start = perf_counter()
+
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             f'import {self.module}'],
+            cwd=self.api_path, env=self.environment, capture_output=True,
+            text=True)
+
+        wall_time = perf_counter() - start
+
+        if result.returncode != 0:
+            raise RuntimeError(f'import {self.module} failed: {result.stderr[-2000:]}')  # noqa: E501
+
+        return wall_time, self.parse(result.stderr)
+
+    # -X importtime lines: "import time: self [us] | cumulative | name", the
+    # name is indented by nesting level. Returns (name, self us, cumulative
+    # us) tuples, anything else on stderr (warnings etc.) is skipped.
+    @staticmethod
+    def parse(output: str) -> list:
+
+        entries = []
+
+        for line in output.splitlines():
+
+            if not line.startswith('import time:'):
+                continue
+
+            fields = line[len('import time:'):].split('|')
+
+            try:
+                entries.append((fields[2].strip(), int(fields[0]),
+                                int(fields[1])))
+
+            # the header line
+            except (IndexError, ValueError):
+                continue
+
+        return entries
+
+    # self time per top level package, in ms, slowest first
+    @staticmethod
+    def by_package(entries: list) -> list:
+
+        packages = {}
+
+        for name, self_time, cumulative in entries:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + self_time / 1000
+
+        return sorted(packages.items(), key=lambda item: item[1],
+                      reverse=True)
+
+    def run_tests(self):
+
+        wall_times = []
+
+        # the first run is usually the slowest, i.e., cold disk cache
+        for run in range(self.runs):
+            wall_time, entries = self.profile()
+            wall_times.append(wall_time)
+
+            self.logger.info(f'Run {run + 1}: import {self.module} took {1000 * wall_time:.1f} ms')  # noqa: E501
+
+        # breakdown of the last run
+        packages = self.by_package(entries)
+        import_time = sum(self_time for package, self_time in packages)
+
+        test_data = [[package, round(self_time, 1),
+                      round(100 * self_time / import_time, 1)]
+                     for package, self_time in packages[:self.top]]
+
+        other = sum(self_time for package, self_time in packages[self.top:])
+        test_data.append([f'other ({len(packages[self.top:])} packages)',
+                          round(other, 1),
+                          round(100 * other / import_time, 1)])
+
+        df_columns = ["package",
+                      "import_time(ms)",
+                      "share(%)"]
+
+        stats_df = ResultsTable(test_data, df_columns)
+
+        results = (f'Startup Results, import {self.module}, cold start: {1000 * wall_times[0]:.1f} ms, median of {self.runs} runs: {1000 * median(wall_times):.1f} ms, of which imports + module bodies: {import_time:.1f} ms\n{stats_df}\n')  # noqa: E501
+        self.logger.info(results)
+        return stats_df
+
+
+profile = StartupProfiling('server')
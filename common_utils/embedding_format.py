@@ -0,0 +1,17 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Embedding Format Utilities
+# The binary embedding format (.femb) is implemented once, in
+# api/embedding_format.py, as the API image is built from the api folder
+# only. This module makes it importable as common_utils.embedding_format for
+# the utility and benchmarking scripts.
+import os
+import sys
+
+api_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'api')
+
+if api_dir not in sys.path:
+    sys.path.append(api_dir)
+
+from embedding_format import EmbeddingFormat  # noqa: E402, F401
@@ -0,0 +1,194 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Manifest of the photos that have been embedded, so that enrollment runs
+# only re-embed what changed: for each source photo it records the content
+# hash, size/mtime, the model version and the identity it was enrolled as.
+# A photo is up to date if its size and mtime are unchanged (no need to read
+# it), or if they changed but the content hash didn't, e.g., the file was
+# touched or copied. Photos embedded with a different model version are
+# redone, and photos that have disappeared are reported so their
+# embeddings can be pruned.
+# The manifest is an append-only JSON lines file: each update is one line,
+# the last line for a photo wins and a deleted photo gets a tombstone line,
+# so recording progress is cheap no matter how large the archive is. It's
+# compacted when it's mostly stale lines.
+import hashlib
+import json
+import os
+from importlib.metadata import version, PackageNotFoundError
+from common_utils.logging_util import LoggingUtilities
+
+logger = LoggingUtilities.console_out_logger("enrollment manifest")
+
+
+class EnrollmentManifest():
+
+    def __init__(self, path: str, model_version: str):
+
+        self.path = path
+        self.model_version = model_version
+
+        # photo -> latest record
+        self.entries = {}
+
+        self.load()
+
+        self.file = open(self.path, 'a')
+
+    # identifies the model and settings embeddings were generated with,
+    # e.g., 'facenet-pytorch 2.5.3 vggface2 embedding', anything that changes
+    # the embeddings should change this string
+    @staticmethod
+    def current_model_version(head: str = 'embedding',
+                              extra: str = '') -> str:
+
+        try:
+            library = f'facenet-pytorch {version("facenet-pytorch")}'
+
+        except PackageNotFoundError:
+            library = 'facenet-pytorch'
+
+        return ' '.join(part for part in (library, 'vggface2', head, extra)
+                        if part)
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_stat(path: str) -> tuple:
+
+        stat = os.stat(path)
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+
+        if not os.path.exists(self.path):
+            return
+
+        lines = 0
+
+        with open(self.path) as file:
+            for line in file:
+
+                # a partial last line from an interrupted run is ignored
+                try:
+                    record = json.loads(line)
+
+                except json.JSONDecodeError:
+                    continue
+
+                lines += 1
+
+                if record.get('deleted'):
+                    self.entries.pop(record['photo'], None)
+
+                else:
+                    self.entries[record['photo']] = record
+
+        logger.info(f'Manifest {self.path} loaded: {len(self.entries)} photos')  # noqa: E501
+
+        if lines > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    # rewrite the manifest with just the latest record for each photo
+    def compact(self):
+
+        temp_path = f'{self.path}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.writelines(json.dumps(record) + '\n'
+                            for record in self.entries.values())
+
+        os.replace(temp_path, self.path)
+
+        logger.info(f'Manifest {self.path} compacted')
+
+    # True if the photo was processed with the current model and hasn't
+    # changed since. root is the folder the photo names are relative to.
+    def is_current(self, photo: str, root: str) -> bool:
+
+        entry = self.entries.get(photo)
+
+        if entry is None or entry['model'] != self.model_version:
+            return False
+
+        path = os.path.join(root, photo)
+        size, mtime_ns = self.file_stat(path)
+
+        if entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+            return True
+
+        # the file was touched, it only needs redoing if the content changed
+        if entry['sha256'] and self.file_hash(path) == entry['sha256']:
+            self.record(photo, entry['identity'], entry['sha256'],
+                        (size, mtime_ns), entry['status'])
+            return True
+
+        return False
+
+    # split the photos in a folder into those that need (re-)embedding and
+    # the manifest entries whose photo no longer exists, photos are names
+    # relative to root
+    def plan(self, photos: list, root: str) -> tuple:
+
+        present = set(photos)
+
+        pending = [photo for photo in photos
+                   if not self.is_current(photo, root)]
+        deleted = [photo for photo in self.entries if photo not in present]
+
+        logger.info(f'{len(photos)} photos: {len(photos) - len(pending)} up to date, {len(pending)} new or changed, {len(deleted)} deleted')  # noqa: E501
+
+        return pending, deleted
+
+    # record a processed photo, status is 'enrolled' or 'failed'. stat is the
+    # (size, mtime_ns) taken before the photo was read, so a change made
+    # while it was being processed is picked up next time.
+    def record(self, photo: str, identity: str, sha256: str, stat: tuple,
+               status: str = 'enrolled'):
+
+        size, mtime_ns = stat
+
+        record = {"photo": photo,
+                  "identity": identity,
+                  "sha256": sha256,
+                  "size": size,
+                  "mtime_ns": mtime_ns,
+                  "model": self.model_version,
+                  "status": status}
+
+        self.entries[photo] = record
+        self.file.write(json.dumps(record) + '\n')
+
+    def remove(self, photo: str):
+
+        if self.entries.pop(photo, None) is not None:
+            self.file.write(json.dumps({"photo": photo, "deleted": True})
+                            + '\n')
+
+    # identities of the enrolled photos
+    def identities(self) -> set:
+
+        return {entry['identity'] for entry in self.entries.values()
+                if entry['status'] == 'enrolled'}
+
+    # make the records written so far durable, call after the embeddings
+    # they describe have been written
+    def flush(self):
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+
+        self.flush()
+        self.file.close()
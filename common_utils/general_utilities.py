@@ -1,5 +1,6 @@
 import os
 from torch import save as ts
+from common_utils.embedding_format import EmbeddingFormat
 from common_utils.logging_util import LoggingUtilities
 
 logger = LoggingUtilities.console_out_logger("general utils")
@@ -36,3 +37,15 @@ class GeneralUtils():
         ts(tensor,  file_path)
 
         logger.info(f'Tensor saved to: {file_path}')
+
+    # save embeddings in the binary .femb format, dtype is float32, float16
+    # or int8
+    @staticmethod
+    def save_embedding_file(tensor: object, path: str, file_name: str,
+                            dtype: str = 'float32'):
+
+        file_path = (f'{path}/{file_name}')
+
+        EmbeddingFormat.save(tensor, file_path, dtype)
+
+        logger.info(f'Embedding saved to: {file_path}')
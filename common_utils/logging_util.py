@@ -1,8 +1,15 @@
 # (C) Markham 2022 - 2024
 # Facial-Recognition-Facenet-Pytorch
 # Logging Utilities
+# With LOG_MODE=async (or asynchronous=True) the file logger's handlers run
+# on a listener thread, i.e., logging a line is just putting the record on a
+# queue and the rotating file writes happen off the calling thread.
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, \
+    RotatingFileHandler
 from sys import stdout
 
 
@@ -28,7 +35,7 @@ class LoggingUtilities():
         return logger
 
     @staticmethod
-    def log_file_logger(name):
+    def log_file_logger(name, asynchronous: bool = None):
 
         logger = logging.getLogger(name)
         logger.setLevel(logging.DEBUG)
@@ -40,8 +47,25 @@ class LoggingUtilities():
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(message)s')  # noqa: E501
         handler.setFormatter(formatter)
         stream_handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.addHandler(stream_handler)
         logger.propagate = False
 
+        if asynchronous is None:
+            asynchronous = os.environ.get('LOG_MODE', 'sync').lower() == \
+                'async'
+
+        if asynchronous:
+            log_queue = queue.SimpleQueue()
+            listener = QueueListener(log_queue, handler, stream_handler,
+                                     respect_handler_level=True)
+            listener.start()
+
+            # write out what's still queued on exit
+            atexit.register(listener.stop)
+
+            logger.addHandler(QueueHandler(log_queue))
+
+        else:
+            logger.addHandler(handler)
+            logger.addHandler(stream_handler)
+
         return logger
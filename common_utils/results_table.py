@@ -0,0 +1,40 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Plain text results table for the benchmarking scripts, laid out like a
+# printed pandas DataFrame, i.e., the scripts don't have to import pandas
+# (~0.5 s) just to log a summary row. to_dataframe() still hands over a
+# DataFrame for further analysis, pandas is only imported then.
+
+
+class ResultsTable:
+
+    def __init__(self, rows: list, columns: list):
+
+        self.rows = [list(row) for row in rows]
+        self.columns = list(columns)
+
+    def __len__(self) -> int:
+
+        return len(self.rows)
+
+    def __str__(self) -> str:
+
+        # index column + one column per field, right aligned
+        table = [[''] + [str(column) for column in self.columns]]
+        table += [[str(index)] + [str(value) for value in row]
+                  for index, row in enumerate(self.rows)]
+
+        widths = [max(len(row[column]) for row in table)
+                  for column in range(len(table[0]))]
+
+        return '\n'.join('  '.join(value.rjust(width)
+                                   for value, width in zip(row, widths))
+                         for row in table)
+
+    __repr__ = __str__
+
+    def to_dataframe(self) -> object:
+
+        import pandas as pd
+
+        return pd.DataFrame(self.rows, columns=self.columns)
@@ -0,0 +1,386 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Bulk enrollment of a folder of reference photos into the API's embedding
+# store (api/embedding_store.py), for archives that are too large to do one
+# photo at a time. Photos are decoded ahead of time by a thread pool, faces
+# are detected a batch at a time and embedded in batches, and the
+# embeddings are committed to the store in large blocks. After each commit
+# the processed photos are recorded in an enrollment manifest (content hash,
+# size/mtime, model version), so an interrupted run picks up where it left
+# off and later runs only embed new or changed photos, and prune the
+# identities of deleted ones. Photos without a detectable face (or that
+# can't be decoded), or that share their file name (the identity) with a
+# photo in another folder, are listed in a failure manifest instead of
+# aborting the run. Usage: edit the line at the bottom.
+import hashlib
+import io
+import json
+import os
+import sys
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from PIL import Image
+from time import perf_counter
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.general_utilities import GeneralUtils  # noqa: E402
+from common_utils.enrollment_manifest import EnrollmentManifest  # noqa: E402,E501
+from embedding_store import EmbeddingStore  # noqa: E402
+from model_backends import VGGFACE2_CLASSES  # noqa: E402
+from response_builder import ResponseBuilder  # noqa: E402
+
+
+class BulkEnrollment():
+
+    MANIFEST_FILE = 'bulk_enrollment_manifest.jsonl'
+    FAILURE_FILE = 'bulk_enrollment_failures.jsonl'
+
+    # photos larger than this (longest side) are decoded at reduced size,
+    # same as the API
+    MAX_DECODE_SIDE = 1280
+
+    def __init__(self, photo_path: str, store_path: str, device=None,
+                 batch_size: int = 64, decode_workers: int = 8,
+                 prefetch_batches: int = 4, commit_every: int = 4096,
+                 dtype: str = 'float32'):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("bulk_enrollment")
+
+        self.device = device or \
+            ('cuda:0' if torch.cuda.is_available() else 'cpu')
+        self.logger.info(f'Running on device: {self.device}')
+
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.prefetch_batches = prefetch_batches
+        self.commit_every = commit_every
+
+        # the store's dtype only applies if it's new
+        self.store = EmbeddingStore(store_path, dtype)
+        self.failure_path = os.path.join(store_path, self.FAILURE_FILE)
+
+        # checked before anything is loaded, rather than failing on the
+        # first commit
+        self.classify = self.select_head(self.store.dim)
+
+        self.manifest = EnrollmentManifest(
+            os.path.join(store_path, self.MANIFEST_FILE),
+            EnrollmentManifest.current_model_version(
+                'logits' if self.classify else 'embedding'))
+
+        # photos are tracked by their path relative to photo_path, so the
+        # manifest doesn't depend on where the archive is mounted
+        self.photo_path = photo_path
+        file_list, name_list = GeneralUtils.get_file_list(photo_path)
+        photos = [os.path.relpath(file, photo_path) for file in file_list]
+        identities = dict(zip(photos, name_list))
+
+        pending, deleted = self.manifest.plan(photos, photo_path)
+
+        self.prune(deleted)
+
+        self.enrolled = 0
+        self.failed = 0
+
+        pending = self.skip_collisions(pending, identities)
+
+        if pending:
+            self.mtcnn, self.resnet = self.get_models()
+            self.run([(photo, identities[photo]) for photo in pending])
+
+        self.manifest.close()
+
+    # the embeddings have to match the store's width: 512-d embeddings
+    # (same as generate_facenet_tensors.py) for a new store, or the 8631-wide
+    # classifier logits for a store seeded from logits tensors, e.g., the
+    # API's default cpu_tensors. Returns whether to apply the classifier.
+    def select_head(self, store_dim: int) -> bool:
+
+        if store_dim in (None, 512):
+            return False
+
+        if store_dim == VGGFACE2_CLASSES:
+            self.logger.info(f'The store at {self.store.path} holds {store_dim}-wide logits, enrolling logits to match')  # noqa: E501
+            return True
+
+        raise ValueError(f'The store at {self.store.path} holds {store_dim}-wide embeddings, InceptionResnetV1 outputs 512-d embeddings or {VGGFACE2_CLASSES}-wide logits, use a different store_path')  # noqa: E501
+
+    # photos with the same file name in different folders would be enrolled
+    # under the same identity, i.e., overwrite each other, so they're
+    # skipped and listed in the failure manifest until they're renamed
+    def skip_collisions(self, pending: list, identities: dict) -> list:
+
+        photos_by_identity = {}
+
+        for photo, identity in identities.items():
+            photos_by_identity.setdefault(identity, []).append(photo)
+
+        collisions = {identity: photos for identity, photos
+                      in photos_by_identity.items() if len(photos) > 1}
+
+        if not collisions:
+            return pending
+
+        waiting = set(pending)
+        failures = [(photo, f'identity {identity} is shared by {", ".join(photos)}')  # noqa: E501
+                    for identity, photos in collisions.items()
+                    for photo in photos if photo in waiting]
+
+        self.write_failures(failures)
+        self.failed += len(failures)
+
+        identity, photos = next(iter(collisions.items()))
+        self.logger.warning(f'{len(collisions)} identities are shared by more than one photo, e.g., {identity}: {photos}, {len(failures)} photos skipped, see {self.failure_path}')  # noqa: E501
+
+        return [photo for photo in pending
+                if identities[photo] not in collisions]
+
+    def get_models(self):
+
+        mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                      0.709, True, True, None,
+                      False, device=self.device).eval()
+
+        resnet = InceptionResnetV1(pretrained='vggface2',
+                                   classify=self.classify).eval().\
+            to(self.device)
+
+        self.logger.info("MTCNN and InceptionResnetV1 Loaded")
+
+        return mtcnn, resnet
+
+    # remove the identities of photos that have been deleted, unless another
+    # photo is still enrolled under the same identity
+    def prune(self, deleted: list):
+
+        if not deleted:
+            return
+
+        identities = {self.manifest.entries[photo]['identity']
+                      for photo in deleted}
+
+        for photo in deleted:
+            self.manifest.remove(photo)
+
+        removed = self.store.unenroll_batch(
+            sorted(identities - self.manifest.identities()))
+        self.manifest.flush()
+
+        self.logger.info(f'{len(deleted)} deleted photos pruned, {removed} identities removed from the store')  # noqa: E501
+
+    # record a committed block of photos, only called once their embeddings
+    # are in the store, so a crash in between means they're redone rather
+    # than lost
+    def write_manifest(self, processed: list, failures: list):
+
+        self.write_failures(failures)
+
+        for photo, identity, sha256, stat, status in processed:
+            self.manifest.record(photo, identity, sha256, stat, status)
+
+        self.manifest.flush()
+
+    def write_failures(self, failures: list):
+
+        if failures:
+            with open(self.failure_path, 'a') as file:
+                file.writelines(json.dumps({"file": photo, "error": error})
+                                + '\n' for photo, error in failures)
+
+    # runs in the decode pool: the file is read once, for both the content
+    # hash and decoding, the stat is taken first so that a change made
+    # while the photo is processed is picked up by the next run. Returns the
+    # photo, hash and (size, mtime_ns).
+    def decode(self, photo: str) -> tuple:
+
+        path = os.path.join(self.photo_path, photo)
+        stat = EnrollmentManifest.file_stat(path)
+
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        return self.open_photo(data), hashlib.sha256(data).hexdigest(), stat
+
+    def open_photo(self, data: bytes) -> object:
+
+        photo = Image.open(io.BytesIO(data))
+
+        # JPEG draft mode, same as the API
+        ResponseBuilder.draft(photo, self.MAX_DECODE_SIDE)
+
+        return photo.convert('RGB')
+
+    # decode the photos a few batches ahead of detection/embedding, so the
+    # model never waits on JPEG decoding
+    def run(self, pending: list):
+
+        start = perf_counter()
+
+        batches = [pending[i:i + self.batch_size]
+                   for i in range(0, len(pending), self.batch_size)]
+
+        # (identity, embedding) pairs waiting to be committed, and the
+        # manifest records/failures that go with them
+        self.embedded = []
+        self.processed = []
+        self.failures = []
+
+        with ThreadPoolExecutor(self.decode_workers) as pool:
+            queued = deque()
+
+            for batch in batches:
+                queued.append((batch, [pool.submit(self.decode, photo)
+                                       for photo, name in batch]))
+
+                if len(queued) > self.prefetch_batches:
+                    self.process_batch(*queued.popleft())
+
+            while queued:
+                self.process_batch(*queued.popleft())
+
+        self.commit()
+
+        elapsed = perf_counter() - start
+        rate = round((self.enrolled + self.failed) / elapsed, 1) \
+            if elapsed else 0
+
+        self.logger.info(f'Bulk enrollment complete: {self.enrolled} enrolled, {self.failed} failed ({rate} photos/s), see {self.failure_path} for failures')  # noqa: E501
+
+    def process_batch(self, batch: list, futures: list):
+
+        photos = []
+
+        for (file, name), future in zip(batch, futures):
+
+            try:
+                photo, sha256, stat = future.result()
+                photos.append((file, name, photo, sha256, stat))
+
+            except Exception as error:
+                self.fail(file, name, None, f'decode failed: {error}')
+
+        faces = self.detect_faces([photo for file, name, photo, sha256, stat
+                                   in photos])
+        detected = []
+
+        for (file, name, photo, sha256, stat), face in zip(photos, faces):
+
+            if isinstance(face, Exception):
+                self.fail(file, name, (sha256, stat),
+                          f'detection failed: {face}')
+
+            elif face is None:
+                self.fail(file, name, (sha256, stat), 'no face detected')
+
+            else:
+                detected.append((name, face))
+                self.processed.append((file, name, sha256, stat, 'enrolled'))
+
+        if detected:
+            with torch.inference_mode():
+                embeddings = self.resnet(
+                    torch.stack([face for name, face in detected]).
+                    to(self.device)).cpu()
+
+            self.embedded += [(name, embedding) for (name, face), embedding
+                              in zip(detected, embeddings)]
+
+        if len(self.processed) >= self.commit_every:
+            self.commit()
+
+    # failed photos are recorded too, so they aren't retried until they
+    # change, source is the (hash, stat) of the photo if it could be read
+    def fail(self, photo: str, identity: str, source: tuple, error: str):
+
+        if source is None:
+            try:
+                source = (None, EnrollmentManifest.file_stat(
+                    os.path.join(self.photo_path, photo)))
+
+            # gone since the folder was listed, the next run prunes it
+            except OSError:
+                self.failures.append((photo, error))
+                return
+
+        self.processed.append((photo, identity, *source, 'failed'))
+        self.failures.append((photo, error))
+
+    # MTCNN takes a list of photos as one batch as long as they're the same
+    # size, so the photos are grouped by size. If a group fails the photos
+    # are retried one at a time, so one bad photo doesn't fail the others.
+    # Returns a face, None or the exception for each photo.
+    def detect_faces(self, photos: list) -> list:
+
+        faces = [None] * len(photos)
+        groups = {}
+
+        for i, photo in enumerate(photos):
+            groups.setdefault(photo.size, []).append(i)
+
+        with torch.inference_mode():
+            for positions in groups.values():
+
+                try:
+                    group_faces = self.mtcnn([photos[i] for i in positions])
+
+                except Exception:
+                    group_faces = [self.detect_single(photos[i])
+                                   for i in positions]
+
+                for i, face in zip(positions, group_faces):
+                    faces[i] = face
+
+        return faces
+
+    def detect_single(self, photo: object) -> object:
+
+        try:
+            return self.mtcnn(photo)
+
+        except Exception as error:
+            return error
+
+    # write the pending embeddings to the store in one block, then the
+    # manifest
+    def commit(self):
+
+        if not self.processed and not self.failures:
+            return
+
+        if self.embedded:
+            self.store.enroll_batch(
+                [name for name, embedding in self.embedded],
+                torch.stack([embedding for name, embedding in self.embedded]))
+
+        # a photo that was enrolled before but has changed and now fails
+        # takes its old embedding with it
+        stale = {identity for photo, identity, sha256, stat, status
+                 in self.processed if status == 'failed' and
+                 self.manifest.entries.get(photo, {}).get('status') ==
+                 'enrolled'}
+        stale.difference_update(name for name, embedding in self.embedded)
+
+        if stale:
+            self.store.unenroll_batch(sorted(stale))
+
+        self.write_manifest(self.processed, self.failures)
+
+        self.enrolled += len(self.embedded)
+        self.failed += len(self.failures)
+
+        self.logger.info(f'Committed {len(self.processed)} photos: {self.enrolled} enrolled, {self.failed} failed so far')  # noqa: E501
+
+        self.embedded = []
+        self.processed = []
+        self.failures = []
+
+
+bulk_enrollment = BulkEnrollment("../benchmarking/test_photos/",
+                                 "../api/embedding_store", "cpu")
@@ -0,0 +1,60 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Saves a local copy of InceptionResnetV1's VGGFace2 weights (incl. the
+# classifier layer) for MODEL_WEIGHTS_PATH, e.g., as a step when building
+# the container image, so the API never downloads them at startup. The file
+# is saved in the current (zip) format, so the API can memory map it, and is
+# checked by loading it back the way the API does.
+# Usage: just run the script or edit the line at the bottom, then set
+# MODEL_WEIGHTS_PATH to the file. MTCNN's weights ship with facenet_pytorch.
+import os
+import sys
+import torch
+from facenet_pytorch import InceptionResnetV1
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from model_backends import ModelBackends  # noqa: E402
+
+
+class CacheModelWeights():
+
+    def __init__(self, output_file: str):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("model_weights")
+
+        folder = os.path.dirname(output_file)
+
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # downloads the weights to the torch hub cache if they aren't there
+        resnet = InceptionResnetV1(pretrained='vggface2', classify=True)
+
+        torch.save(resnet.state_dict(), output_file)
+
+        size = os.path.getsize(output_file) / (1024 * 1024)
+        self.logger.info(f'InceptionResnetV1 weights saved to {output_file}, {size:.1f} MB')  # noqa: E501
+
+        self.check(resnet.eval(), output_file)
+
+    # the local copy has to give the same outputs as the downloaded weights
+    def check(self, resnet: object, output_file: str):
+
+        cached = ModelBackends.load_pretrained_resnet(output_file, 'cpu')
+        example = torch.rand(2, 3, 160, 160)
+
+        with torch.no_grad():
+            difference = (resnet(example) - cached(example)).abs().max()
+
+        if difference.item() != 0:
+            raise RuntimeError(f'{output_file} gives different outputs than the downloaded weights')  # noqa: E501
+
+        self.logger.info(f'{output_file} checked, set MODEL_WEIGHTS_PATH to use it')  # noqa: E501
+
+
+weights = CacheModelWeights("../api/model_weights/inception_resnet_v1_vggface2.pt")  # noqa: E501
@@ -0,0 +1,55 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Converts a folder of cached reference tensors (.pt files) to the binary
+# embedding format (.femb), optionally as float16 or int8 to make them
+# smaller. The .pt files are loaded with weights_only, so converting a cache
+# from an untrusted source can't execute code.
+import os
+import sys
+import torch
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.general_utilities import GeneralUtils  # noqa: E402
+
+
+class ConvertTensors():
+
+    def __init__(self, cache_path: str, output_path: str,
+                 dtype='float32'):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("tensor_conversion")
+
+        self.utils = GeneralUtils()
+
+        os.makedirs(output_path, exist_ok=True)
+
+        file_list, name_list = GeneralUtils.get_file_list(cache_path)
+
+        self.convert_tensors(file_list, name_list, output_path, dtype)
+
+    def convert_tensors(self, tensor_files: list, name_list: list,
+                        output_path: str, dtype: str):
+
+        converted = 0
+
+        for tensor_file, name in zip(tensor_files, name_list):
+
+            if not tensor_file.endswith('.pt'):
+                continue
+
+            tensor = torch.load(tensor_file, map_location='cpu',
+                                weights_only=True)
+
+            self.utils.save_embedding_file(tensor, output_path,
+                                           f'{name}.femb', dtype)
+            converted += 1
+
+        self.logger.info(f'Conversion complete, {converted} tensors converted to {dtype} .femb files')  # noqa: E501
+
+
+convert_tensors = ConvertTensors("facenet_tensor_cache",
+                                 "facenet_embedding_cache")
@@ -0,0 +1,150 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Exports InceptionResnetV1 and the MTCNN sub-networks (P-Net, R-Net, O-Net)
+# to TorchScript and ONNX for the API's INFERENCE_BACKEND setting. The
+# TorchScript models are traced, frozen and optimized for inference, i.e.,
+# the batch norms are folded into the convolutions and the weights are
+# baked into the graph. InceptionResnetV1 is exported without its
+# classifier layer, which is exported on its own (as TorchScript), same as
+# the split the API does with the eager model. After the export each model's
+# outputs are checked against the eager model.
+# Usage: just run the script or edit the line at the bottom, the exports are
+# for the device they're generated on.
+import os
+import sys
+import torch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from model_backends import ModelBackends  # noqa: E402
+
+
+class ExportModels():
+
+    # example inputs for tracing, P-Net is fully convolutional so any size
+    # works, R-Net/O-Net take fixed size crops and the face crops are 160
+    EXAMPLE_SHAPES = {'resnet': (2, 3, 160, 160),
+                      'pnet': (1, 3, 120, 160),
+                      'rnet': (2, 3, 24, 24),
+                      'onet': (2, 3, 48, 48)}
+
+    # dynamic dimensions for ONNX
+    DYNAMIC_AXES = {'resnet': {0: 'batch'},
+                    'pnet': {0: 'batch', 2: 'height', 3: 'width'},
+                    'rnet': {0: 'batch'},
+                    'onet': {0: 'batch'}}
+
+    ONNX_OPSET = 17
+
+    def __init__(self, output_path: str, formats: tuple = ('torchscript',
+                                                           'onnx'),
+                 device: str = 'cpu'):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("model_export")
+
+        self.device = device
+        os.makedirs(output_path, exist_ok=True)
+
+        models, logits_layer = self.get_models()
+
+        # the classifier layer is a single linear layer, it's scripted
+        # rather than traced/frozen so the API can read its width
+        torch.jit.script(logits_layer).save(
+            ModelBackends.export_path(output_path, 'logits', 'torchscript'))
+
+        for name, model in models.items():
+            example = torch.rand(self.EXAMPLE_SHAPES[name],
+                                 device=self.device)
+
+            if 'torchscript' in formats:
+                self.export_torchscript(name, model, example, output_path)
+
+            if 'onnx' in formats:
+                self.export_onnx(name, model, example, output_path)
+
+            for backend in formats:
+                self.check_parity(name, model, backend, output_path)
+
+    def get_models(self) -> tuple:
+
+        mtcnn = MTCNN(device=self.device).eval()
+
+        resnet = InceptionResnetV1(pretrained='vggface2',
+                                   classify=True).eval().to(self.device)
+
+        # same split as Inferencing.get_models
+        logits_layer = resnet.logits
+        resnet.logits = torch.nn.Identity()
+
+        models = {'resnet': resnet,
+                  'pnet': mtcnn.pnet,
+                  'rnet': mtcnn.rnet,
+                  'onet': mtcnn.onet}
+
+        return models, logits_layer
+
+    def export_torchscript(self, name: str, model: object, example: object,
+                           output_path: str):
+
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            frozen = torch.jit.freeze(traced)
+
+            # the fusions optimize_for_inference adds are CPU specific
+            if self.device == 'cpu':
+                frozen = torch.jit.optimize_for_inference(frozen)
+
+        path = ModelBackends.export_path(output_path, name, 'torchscript')
+        frozen.save(path)
+
+        self.logger.info(f'{name} exported to {path}')
+
+    def export_onnx(self, name: str, model: object, example: object,
+                    output_path: str):
+
+        path = ModelBackends.export_path(output_path, name, 'onnx')
+
+        with torch.no_grad():
+            torch.onnx.export(model, example, path,
+                              opset_version=self.ONNX_OPSET,
+                              input_names=['input'],
+                              dynamic_axes={'input':
+                                            self.DYNAMIC_AXES[name]},
+                              do_constant_folding=True)
+
+        self.logger.info(f'{name} exported to {path}')
+
+    # largest absolute difference between the eager and exported outputs,
+    # on an input of a different size than the one used for tracing
+    def check_parity(self, name: str, model: object, backend: str,
+                     output_path: str):
+
+        shape = list(self.EXAMPLE_SHAPES[name])
+        shape[0] += 1
+
+        if name == 'pnet':
+            shape[2:] = [shape[2] + 37, shape[3] + 21]
+
+        example = torch.rand(shape, device=self.device)
+        exported = ModelBackends.load(backend, output_path, name,
+                                      self.device)
+
+        with torch.no_grad():
+            expected = model(example)
+            actual = exported(example)
+
+        if isinstance(expected, torch.Tensor):
+            expected, actual = (expected,), (actual,)
+
+        difference = max((e - a).abs().max().item()
+                         for e, a in zip(expected, actual))
+
+        self.logger.info(f'{name} {backend} max abs difference vs eager: {difference:.2e}')  # noqa: E501
+
+
+export = ExportModels("../api/exported_models")
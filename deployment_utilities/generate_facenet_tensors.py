@@ -1,29 +1,48 @@
 # (C) Markham 2022 - 2024
 # Facial-Recognition-Facenet-Pytorch
-# Example of how to generate reference tensors
+# Example of how to generate reference tensors. Runs are incremental: a
+# manifest in the cache folder records each photo's content hash, size/mtime
+# and the model version, so only new, changed or model-outdated photos are
+# embedded and the tensors of deleted photos are removed. facenet_pytorch
+# is only imported (and the models only loaded) when there's something to
+# embed, i.e., a run with nothing to do skips torchvision and the model
+# load. Set MODEL_WEIGHTS_PATH to load InceptionResnetV1 from a local copy of
+# the weights (deployment_utilities/cache_model_weights.py) instead of the
+# download cache.
 import os
 import sys
 import torch
-from facenet_pytorch import MTCNN, InceptionResnetV1
 from PIL import Image
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'api'))
 
 from common_utils.logging_util import LoggingUtilities  # noqa: E402
 from common_utils.general_utilities import GeneralUtils  # noqa: E402
+from common_utils.enrollment_manifest import EnrollmentManifest  # noqa: E402,E501
 
 
 class CacheTensors():
 
+    MANIFEST_FILE = 'manifest.jsonl'
+
+    # manifest records are made durable every so many photos
+    FLUSH_EVERY = 100
+
     def __init__(self, photo_path: str, cache_path: str,
-                 device=None):
+                 device=None, output_format='pt', dtype='float32'):
 
         self.logger = LoggingUtilities.\
             log_file_logger("tensor_caching")
 
         self.utils = GeneralUtils()
 
+        # 'pt' for pickled PyTorch tensors or 'femb' for the binary embedding
+        # format, dtype (float32, float16 or int8) only applies to the latter
+        self.output_format = output_format
+        self.dtype = dtype
+
         if not device:
             # set device based on best available - e.g., CUDA if
             self.device = self.set_device()
@@ -33,11 +52,32 @@ class CacheTensors():
 
         self.logger.info(f'Running on device: {device}')
 
-        self.mtcnn, self.resnet = self.get_models()
+        os.makedirs(cache_path, exist_ok=True)
+
+        # the output format/dtype are part of the version, as they change
+        # what's in the cache
+        self.manifest = EnrollmentManifest(
+            os.path.join(cache_path, self.MANIFEST_FILE),
+            EnrollmentManifest.current_model_version(
+                'embedding', f'{output_format} {dtype}'))
 
+        self.photo_path = photo_path
         file_list, name_list = GeneralUtils.get_file_list(photo_path)
+        photos = [os.path.relpath(file, photo_path) for file in file_list]
+
+        pending, deleted = self.manifest.plan(photos, photo_path)
+        self.prune(deleted, cache_path)
+
+        pending = set(pending)
+        work = [(file, name) for file, name, photo
+                in zip(file_list, name_list, photos) if photo in pending]
+
+        if work:
+            self.mtcnn, self.resnet = self.get_models()
+            self.generate_tensors([file for file, name in work],
+                                  [name for file, name in work], cache_path)
 
-        self.generate_tensors(file_list, name_list, cache_path)
+        self.manifest.close()
 
     def set_device(self):
 
@@ -51,34 +91,106 @@ class CacheTensors():
 
     def get_models(self):
 
+        from facenet_pytorch import MTCNN, InceptionResnetV1
+        from model_backends import ModelBackends
+
         mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
                       0.709, True, True, None,
                       False, device=self.device).eval()
 
         self.logger.info("MTCNN Loaded")
 
-        # Instantiate Resnet for Facial Geometry (Embeddings)
-        resnet = InceptionResnetV1(pretrained='vggface2',
-                                   classify=True).eval().to(self.device)
+        # Instantiate Resnet for Facial Geometry (Embeddings), without the
+        # classifier layer, i.e., the cached tensors are the 512-d embeddings
+        weights_path = os.environ.get('MODEL_WEIGHTS_PATH')
+
+        if weights_path:
+            resnet = ModelBackends.load_pretrained_resnet(
+                weights_path, self.device, classify=False)
+
+        else:
+            resnet = InceptionResnetV1(pretrained='vggface2',
+                                       classify=False).eval().to(self.device)
+
         self.logger.info("InceptionResnetV1 Loaded")
 
         return mtcnn, resnet
 
+    # delete the cached tensors of photos that no longer exist, unless
+    # another photo has the same name
+    def prune(self, deleted: list, cache_path: str):
+
+        names = {self.manifest.entries[photo]['identity']
+                 for photo in deleted}
+
+        for photo in deleted:
+            self.manifest.remove(photo)
+
+        for name in names - self.manifest.identities():
+            self.remove_tensors(cache_path, name)
+
+        self.manifest.flush()
+
+    def remove_tensors(self, cache_path: str, name: str):
+
+        for extension in ('.pt', '.femb'):
+            tensor_file = os.path.join(cache_path, f'{name}{extension}')
+
+            if os.path.exists(tensor_file):
+                os.remove(tensor_file)
+                self.logger.info(f'Removed stale tensor {tensor_file}')
+
     def generate_tensors(self, photo_files, name_list, save_path):
 
-        for photo, file_name in zip(photo_files, name_list):
+        for count, (photo_file, file_name) in enumerate(zip(photo_files,
+                                                            name_list), 1):
+
+            # stat before reading, so a change made in the meantime is
+            # picked up by the next run
+            photo_name = os.path.relpath(photo_file, self.photo_path)
+            stat = EnrollmentManifest.file_stat(photo_file)
+            sha256 = EnrollmentManifest.file_hash(photo_file)
 
-            photo = Image.open(photo)
+            if count % self.FLUSH_EVERY == 0:
+                self.manifest.flush()
 
-            # face detection
-            cropped_photo = self.mtcnn(photo).to(self.device)
-            # generate tensor
-            embedding = self.resnet(cropped_photo.unsqueeze(0))
+            photo = Image.open(photo_file)
 
-            tensor_name = (f'{file_name}.pt')
+            # no autograd graph needed, we're only running inference
+            with torch.inference_mode():
+                # face detection
+                cropped_photo = self.mtcnn(photo)
+
+                # skip photos without a detectable face rather than crashing
+                # the whole run, see bulk_enrollment.py for large archives
+                if cropped_photo is None:
+                    self.logger.info(f'No face detected in {photo_file}, skipped')  # noqa: E501
+
+                    # a changed photo takes its old tensor with it
+                    previous = self.manifest.entries.get(photo_name, {})
+
+                    if previous.get('status') == 'enrolled':
+                        self.remove_tensors(save_path, file_name)
+
+                    self.manifest.record(photo_name, file_name, sha256, stat,
+                                         'failed')
+                    continue
+
+                # generate tensor
+                embedding = self.resnet(
+                    cropped_photo.unsqueeze(0).to(self.device))
 
             # save tensor
-            self.utils.save_pytorch_tensors(embedding, save_path, tensor_name)
+            if self.output_format == 'femb':
+                self.utils.save_embedding_file(embedding, save_path,
+                                               f'{file_name}.femb',
+                                               self.dtype)
+
+            else:
+                self.utils.save_pytorch_tensors(embedding, save_path,
+                                                f'{file_name}.pt')
+
+            self.manifest.record(photo_name, file_name, sha256, stat)
 
 
 save_tensors = CacheTensors("../benchmarking/test_photos/",
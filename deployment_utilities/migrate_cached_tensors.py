@@ -0,0 +1,124 @@
+# (C) Markham 2022 - 2024
+# Facial-Recognition-Facenet-Pytorch
+# Re-encodes cached reference tensors that hold the 8631-wide VGGFace2
+# classifier logits (i.e., generated with classify=True) as 512-d embeddings.
+# Logits can't be converted back into embeddings, so each tensor is
+# regenerated from its source photo, matched on file name, e.g.,
+# Aaron_Sorkin_0001.pt is regenerated from Aaron_Sorkin_0001.jpg. Tensors that
+# are already 512-d are left as is.
+import os
+import sys
+import torch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from PIL import Image
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from common_utils.logging_util import LoggingUtilities  # noqa: E402
+from common_utils.general_utilities import GeneralUtils  # noqa: E402
+
+EMBEDDING_WIDTH = 512
+
+
+class MigrateTensors():
+
+    def __init__(self, photo_path: str, cache_path: str,
+                 output_path=None, device=None):
+
+        self.logger = LoggingUtilities.\
+            log_file_logger("tensor_migration")
+
+        self.utils = GeneralUtils()
+
+        if not device:
+            # set device based on best available - e.g., CUDA if available
+            self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+        else:
+            self.device = device
+
+        self.logger.info(f'Running on device: {self.device}')
+
+        self.mtcnn, self.resnet = self.get_models()
+
+        # source photos, keyed by file name minus the extension
+        file_list, name_list = GeneralUtils.get_file_list(photo_path)
+        photos = dict(zip(name_list, file_list))
+
+        # write the re-encoded tensors back to the cache unless an output
+        # folder is specified
+        if not output_path:
+            output_path = cache_path
+
+        os.makedirs(output_path, exist_ok=True)
+
+        self.migrate_tensors(photos, cache_path, output_path)
+
+    def get_models(self):
+
+        mtcnn = MTCNN(160, 30, 20, [0.6, 0.7, 0.7],
+                      0.709, True, True, None,
+                      False, device=self.device).eval()
+
+        self.logger.info("MTCNN Loaded")
+
+        # embedding head only, i.e., no classifier layer
+        resnet = InceptionResnetV1(pretrained='vggface2',
+                                   classify=False).eval().to(self.device)
+        self.logger.info("InceptionResnetV1 Loaded")
+
+        return mtcnn, resnet
+
+    def migrate_tensors(self, photos: dict, cache_path: str,
+                        output_path: str):
+
+        tensor_files, tensor_names = GeneralUtils.get_file_list(cache_path)
+
+        migrated = 0
+        skipped = 0
+
+        for tensor_file, name in zip(tensor_files, tensor_names):
+
+            if not tensor_file.endswith('.pt'):
+                continue
+
+            tensor = torch.load(tensor_file, map_location='cpu')
+
+            if tensor.shape[-1] == EMBEDDING_WIDTH:
+
+                # carry already migrated tensors over to the output folder
+                if output_path != cache_path:
+                    self.utils.save_pytorch_tensors(tensor, output_path,
+                                                    f'{name}.pt')
+
+                continue
+
+            if name not in photos:
+                self.logger.warning(f'No source photo found for {tensor_file}, skipping')  # noqa: E501
+                skipped += 1
+                continue
+
+            photo = Image.open(photos[name])
+
+            with torch.inference_mode():
+                cropped_photo = self.mtcnn(photo)
+
+                if cropped_photo is None:
+                    self.logger.warning(f'No face detected in {photos[name]}, skipping')  # noqa: E501
+                    skipped += 1
+                    continue
+
+                embedding = self.resnet(
+                    cropped_photo.to(self.device).unsqueeze(0))
+
+            self.utils.save_pytorch_tensors(embedding, output_path,
+                                            f'{name}.pt')
+            migrated += 1
+
+        self.logger.info(f'Migration complete, {migrated} tensors re-encoded, {skipped} skipped')  # noqa: E501
+
+
+migrate_tensors = MigrateTensors("../benchmarking/test_photos/",
+                                 "facenet_tensor_cache",
+                                 "facenet_tensor_cache_512", "cpu")